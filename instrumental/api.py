@@ -1,20 +1,41 @@
+import functools
+import logging
 import os
+import socket
 import sys
 
+from instrumental.collector import CollectorTransport
 from instrumental.importer import ImportHook
 from instrumental.instrument import AnnotatorFactory
+from instrumental.journal import HitJournal
 from instrumental.metadata import gather_metadata
+from instrumental.monitoring import ExecutionMonitor
 from instrumental.monkey import monkeypatch_imp
 from instrumental.monkey import unmonkeypatch_imp
+from instrumental.process import ChildProcesses
+from instrumental.process import child_label
+from instrumental.shared import SharedHits
+from instrumental.snapshot import Snapshotter
 from instrumental.storage import ResultStore
 from instrumental.recorder import ExecutionRecorder
 
+log = logging.getLogger(__name__)
+
 class Coverage(object):
     
     def __init__(self, config, basedir):
         self._config = config
         self._basedir = basedir
         self._import_hooks = []
+        self._targets = []
+        self._ignores = []
+        self._annotator_factory = None
+        self._metadata_cache = None
+        self._journal = None
+        self._transport = None
+        self._snapshotter = None
+        self._store = None
+        self._children = None
     
     def _maybe_label(self, should_label):
         if should_label:
@@ -23,42 +44,278 @@ class Coverage(object):
     def _get_store(self, config, basedir):
         filename = config.file
         label = self._maybe_label(config.label)
-        return ResultStore(basedir, label, filename)
+        if self.in_child:
+            # A child process of a run saves to a store of its own
+            filename = None
+            label = child_label(self._children.run_label)
+        store = ResultStore(basedir, label, filename)
+        # Saving through the same store again only encodes the modules
+        # that have changed since
+        if self._store is None or self._store.filename != store.filename:
+            self._store = store
+        return self._store
 
     @property
     def recorder(self):
         return ExecutionRecorder.get()
     
     def start(self, targets, ignores):
-        gather_metadata(self._config, self.recorder, targets, ignores)
+        self._targets = targets
+        self._ignores = ignores
+        # Before anything is imported, so that every module recorder is
+        # sharded or counts
+        self.recorder.sharded = self._config.thread_shards
+        self.recorder.counting = self._config.count_hits
+        if self._config.count_hits and self._config.thread_shards:
+            # Counts are kept once for all the threads
+            log.warning('Counting hits; threads record into the same results'
+                        ' rather than into shards')
+            self.recorder.sharded = False
         annotator_factory = AnnotatorFactory(self._config, self.recorder)
+        self._annotator_factory = annotator_factory
+        self._metadata_cache = annotator_factory.metadata_cache
+        if not self._config.lazy_metadata:
+            gather_metadata(self._config, self.recorder, targets, ignores,
+                            metadata_cache=self._metadata_cache)
+        if self._config.count_hits and (self._config.monitor_statements
+                                        or self._config.monitor_decisions):
+            # Monitored lines and branches stop reporting once they're seen
+            log.warning('Counting hits; statements and decisions are'
+                        ' recorded by probes rather than sys.monitoring')
+        elif self._config.monitor_statements or self._config.monitor_decisions:
+            # Without sys.monitoring this leaves the monitor unset and
+            # everything is recorded by probes as usual
+            self.recorder.monitor = ExecutionMonitor.create(
+                self.recorder,
+                statements=self._config.monitor_statements,
+                decisions=self._config.monitor_decisions)
+        if ((self._config.subprocesses or self._config.shared_hits)
+            and self._children is None):
+            self._children = ChildProcesses(self, self._config, self._basedir,
+                                            self._maybe_label(True))
+        if self._children is not None:
+            self._children.start(targets, ignores)
+            if self._config.shared_hits and not self.in_child:
+                # Before anything is imported, so that every module
+                # recorder uses the shared memory
+                SharedHits(self.recorder).allocate()
         monkeypatch_imp(targets, ignores, annotator_factory)
         for target in targets:
             hook = ImportHook(target, ignores, annotator_factory)
             self._import_hooks.append(hook)
             sys.meta_path.insert(0, hook)
+        if self._config.collector:
+            self._start_transport()
+        elif self._config.journal:
+            self._start_journal()
+        if self._config.snapshot_signal or self._config.snapshot_interval:
+            self._start_snapshots(self._config.snapshot_interval)
+            if self._config.snapshot_signal:
+                self._snapshotter.install_signal_handler()
         self.recorder.start()
     
+    def start_child(self, run_label, targets, ignores):
+        """ Start recording in a new interpreter started by the run """
+        self._children = ChildProcesses(self, self._config, self._basedir,
+                                        run_label, root=False)
+        self.start(targets, ignores)
+    
+    def _after_fork(self):
+        """ Carry on recording in a forked child of the run
+            
+            The child saves to its own store, counts hits from zero and
+            opens its own connection to the cache. The threads that journal,
+            send or snapshot results weren't copied into the child, so it
+            starts its own.
+        """
+        self._store = None
+        self._annotator_factory.after_fork()
+        # The parent still has the counts from before the fork
+        self.recorder.clear_counts()
+        if self._journal is not None:
+            self._start_journal()
+        if self._transport is not None:
+            self._transport = None
+            self._start_transport()
+        if self._snapshotter is not None:
+            self._start_snapshots(self._config.snapshot_interval)
+            if self._config.snapshot_signal:
+                self._snapshotter.install_signal_handler()
+    
+    @property
+    def in_child(self):
+        """ Is this a child process of the run that started coverage? """
+        return self._children is not None and self._children.in_child
+    
+    def _start_journal(self):
+        store = self._get_store(self._config, self._basedir)
+        # Journals left by an earlier run would be replayed into this one's
+        # results
+        store.clear_journals()
+        self._journal = HitJournal(self.recorder,
+                                   store.journal_filename(os.getpid()),
+                                   store.metadata_store,
+                                   self._config.journal_interval)
+        self._journal.start()
+    
+    def _start_transport(self):
+        store = self._get_store(self._config, self._basedir)
+        transport = CollectorTransport(self.recorder,
+                                       self._config.collector,
+                                       store.metadata_store,
+                                       self._config.journal_interval)
+        try:
+            transport.start()
+        except socket.error:
+            log.warning('Could not connect to the collector at %r; the'
+                        ' results will be saved to %r',
+                        self._config.collector, store.filename,
+                        exc_info=True)
+            return
+        self._transport = transport
+    
+    def _start_snapshots(self, interval=None):
+        store = self._get_store(self._config, self._basedir)
+        self._snapshotter = Snapshotter(self.recorder, store, interval)
+        self._snapshotter.start()
+    
+    def snapshot(self):
+        """ Save the results so far without stopping
+            
+            The results are copied now and saved by a background thread, so
+            this returns almost at once. Results recorded after this call
+            aren't in the snapshot.
+        """
+        if self._snapshotter is None:
+            self._start_snapshots()
+        self._snapshotter.request()
+    
+    def _stop_snapshots(self):
+        if self._snapshotter is not None:
+            # A snapshot saved after the final results would replace them
+            self._snapshotter.stop()
+            self._snapshotter = None
+    
     @property
     def started(self):
         return self.recorder.recording
     
     def stop(self):
         self.recorder.stop()
+        self._stop_snapshots()
+        if self._children is not None:
+            self._children.stop()
+        if self._journal is not None:
+            self._journal.stop()
+        if self.recorder.monitor is not None:
+            self.recorder.monitor.stop()
+            self.recorder.monitor = None
         for hook in self._import_hooks:
             sys.meta_path.remove(hook)
         unmonkeypatch_imp()
+        self._close_cache()
+    
+    def _close_cache(self):
+        # Writes when the cached entries were used
+        if self._annotator_factory is not None:
+            self._annotator_factory.close()
     
     def start_context(self, label):
-        self.recorder.tag = label
+        """ Tag what the current thread or task records with `label` """
+        self.recorder.set_tag(label)
+        if self.recorder.monitor is not None:
+            # Branches already seen both ways need to report for this tag
+            self.recorder.monitor.restart()
     
     def stop_context(self):
-        self.recorder.tag = None
+        self.recorder.set_tag(None)
+    
+    def context(self, label):
+        """ Tag results with `label` in a with block or decorated function
+            
+            Only the thread or asyncio task that enters the context is
+            tagged, and the previous tag is restored when it exits, so
+            contexts can be nested.
+        """
+        return CoverageContext(self, label)
+    
+    def gather_unimported(self):
+        """ Gather metadata for the targeted modules that weren't imported
+            
+            With lazy metadata, only the modules that were imported have
+            metadata. The rest need it to be reported with no coverage.
+        """
+        gather_metadata(self._config, self.recorder,
+                        self._targets, self._ignores,
+                        missing_only=True,
+                        metadata_cache=self._metadata_cache)
+        if not self.started:
+            self._close_cache()
     
     def save(self):
+        if self._config.lazy_metadata and not self._config.skip_unimported:
+            self.gather_unimported()
+        self._stop_snapshots()
+        if self._transport is not None:
+            # The last send includes the modules gathered just now
+            transport, self._transport = self._transport, None
+            transport.stop()
+            if not transport.failed:
+                return
         store = self._get_store(self._config, self._basedir)
-        store.save(self.recorder)
+        self.recorder.merge_shards()
+        shared = self.recorder.shared
+        if shared is not None and not self.in_child:
+            shared.merge()
+        # A child that has only recorded what the shared memory holds has
+        # nothing of its own to save
+        if not (shared is not None and self.in_child
+                and shared.covers(self.recorder)):
+            store.save(self.recorder)
+        if self._journal is not None:
+            # Everything in the journal has just been saved
+            self._journal.remove()
+            self._journal = None
+        if self._children is not None and not self._children.in_child:
+            self._children.combine(store, self.recorder)
+    
+    def finish(self):
+        """ Stop recording and save the results, unless that's been done """
+        if self.started:
+            self.stop()
+            self.save()
     
     def load(self):
         store = self._get_store(self._config, self._basedir)
         return store.load()
+
+class CoverageContext(object):
+    """ Tags results while it's entered, or while a decorated function runs
+        
+        A decorated coroutine function is only tagged while the coroutine
+        is created. Use a with block inside the coroutine instead. Each
+        thread or task should enter a context of its own (as returned by
+        Coverage.context) rather than share one in a with block.
+    """
+    
+    def __init__(self, coverage, label):
+        self.coverage = coverage
+        self.label = label
+        self._tokens = []
+    
+    def __enter__(self):
+        recorder = self.coverage.recorder
+        self._tokens.append(recorder.set_tag(self.label))
+        if recorder.monitor is not None:
+            recorder.monitor.restart()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.coverage.recorder.reset_tag(self._tokens.pop())
+    
+    def __call__(self, func):
+        @functools.wraps(func)
+        def tagged(*args, **kwargs):
+            with CoverageContext(self.coverage, self.label):
+                return func(*args, **kwargs)
+        return tagged
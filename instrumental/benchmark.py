@@ -0,0 +1,275 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Micro-benchmarks for the cost of instrumentation
+    
+    Run with `python -m instrumental.benchmark [iterations [package]]`
+"""
+import inspect
+import itertools
+import sys
+from timeit import default_timer
+
+from astkit import ast
+
+from instrumental.compat import exec_f
+from instrumental.instrument import AnnotatorFactory
+from instrumental.instrument import CoverageAnnotator
+from instrumental.metadata import MetadataGatheringVisitor
+from instrumental.metadata import SourceFinder
+from instrumental.pragmas import PragmaFinder
+from instrumental.recorder import ExecutionRecorder
+from instrumental.recorder import HitCountModuleRecorder
+from instrumental.recorder import ModuleRecorder
+from instrumental.recorder import ShardedModuleRecorder
+from instrumental.run import parser
+import instrumental.samples.boolean
+
+class GenericModuleRecorder(ModuleRecorder):
+    """ A module recorder that sends every construct through one entry point
+        
+        This is how probes were recorded before there were separate entry
+        points for each kind of construct, and it serves as the baseline.
+    """
+    
+    def record(self, arg, cid, *args):
+        recorder = self.recorder
+        if recorder.recording:
+            construct = self.constructs[cid]
+            condition = construct.condition_for(arg, *args)
+            if condition is not None:
+                tag = recorder._tag.get() if recorder.tagging else None
+                if tag is None:
+                    slot = self.slots[cid] + condition
+                    if not self.hits[slot]:
+                        self.hits[slot] = 1
+                        construct.conditions[condition].add(recorder.DEFAULT_TAG)
+                        self.metadata.changed()
+                else:
+                    results = construct.conditions[condition]
+                    if tag not in results:
+                        results.add(tag)
+                        self.metadata.changed()
+        return arg
+
+class CountingModuleRecorder(ModuleRecorder):
+    """ A module recorder that counts the probes it is asked to record """
+    
+    def __init__(self, recorder, metadata):
+        super(CountingModuleRecorder, self).__init__(recorder, metadata)
+        self.count = 0
+    
+    def record_pin(self, value, cid, pin):
+        self.count += 1
+        return value
+    
+    def record_decision(self, value, cid):
+        self.count += 1
+        return value
+    
+    def record_statement(self, slot):
+        self.count += 1
+
+class UseGenericRecord(ast.NodeTransformer):
+    """ Rewrite kind-specific probes into calls to the generic `record` """
+    
+    def visit_Call(self, call):
+        self.generic_visit(call)
+        if (isinstance(call.func, ast.Attribute)
+            and call.func.attr in ('record_pin', 'record_decision')):
+            call.func.attr = 'record'
+        return call
+
+def load_sample(module, instrument=True, transformer=None, options=()):
+    """ Execute the source of `module` and return the resulting namespace """
+    config, _ = parser.parse_args(list(options))
+    modulename = module.__name__
+    source = inspect.getsource(module)
+    tree = ast.parse(source)
+    if instrument:
+        recorder = ExecutionRecorder.get()
+        pragmas = PragmaFinder().find_pragmas(source)
+        recorder.add_metadata(
+            MetadataGatheringVisitor.analyze(config,
+                                             modulename,
+                                             source,
+                                             pragmas))
+        tree = CoverageAnnotator(config, modulename, recorder).visit(tree)
+        if transformer is not None:
+            tree = transformer.visit(tree)
+    namespace = {'__name__': modulename}
+    exec_f(compile(tree, module.__file__, 'exec'), namespace)
+    return namespace
+
+def time_calls(func, inputs, iterations, repeat=3):
+    """ Return the best time, in seconds, of calling `func` over `inputs` """
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(iterations):
+            for args in inputs:
+                func(*args)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmark_boolean(iterations=20000):
+    """ Compare the per-probe cost of the different styles of probe
+        
+        and_3 from instrumental.samples.boolean is called with every
+        combination of boolean inputs, uninstrumented and instrumented with
+        each style of probe.
+    """
+    module = instrumental.samples.boolean
+    inputs = list(itertools.product([True, False], repeat=3))
+    calls = iterations * len(inputs)
+    
+    ExecutionRecorder.reset()
+    recorder = ExecutionRecorder.get()
+    recorder.start()
+    try:
+        plain = load_sample(module, instrument=False)
+        baseline = time_calls(plain['and_3'], inputs, iterations)
+        
+        specific = load_sample(module)
+        metadata = recorder.metadata[module.__name__]
+        
+        counter = CountingModuleRecorder(recorder, metadata)
+        specific['_xxx_recorder_xxx_'] = counter
+        for args in inputs:
+            specific['and_3'](*args)
+        probes = counter.count * iterations
+        
+        specific['_xxx_recorder_xxx_'] = recorder.module_recorder(module.__name__)
+        specific_time = time_calls(specific['and_3'], inputs, iterations)
+        
+        generic = load_sample(module, transformer=UseGenericRecord())
+        generic['_xxx_recorder_xxx_'] = GenericModuleRecorder(recorder, metadata)
+        generic_time = time_calls(generic['and_3'], inputs, iterations)
+        
+        disarmed = load_sample(module, options=['--disarm-statements'])
+        disarmed_time = time_calls(disarmed['and_3'], inputs, iterations)
+        
+        specific['_xxx_recorder_xxx_'] = ShardedModuleRecorder(recorder,
+                                                               metadata)
+        sharded_time = time_calls(specific['and_3'], inputs, iterations)
+        
+        specific['_xxx_recorder_xxx_'] = HitCountModuleRecorder(recorder,
+                                                                metadata)
+        counting_time = time_calls(specific['and_3'], inputs, iterations)
+    finally:
+        recorder.stop()
+        ExecutionRecorder.reset()
+    
+    results = []
+    for name, elapsed in [('uninstrumented', baseline),
+                          ('generic record()', generic_time),
+                          ('kind-specific', specific_time),
+                          ('disarmed statements', disarmed_time),
+                          ('thread shards', sharded_time),
+                          ('hit counts', counting_time)]:
+        per_call = elapsed / calls
+        per_probe = (elapsed - baseline) / probes
+        results.append((name, per_call, per_probe))
+    return results
+
+def parse_only(config, recorder, modulename, source, filepath):
+    """ Parse a module, which is the floor for instrumenting it """
+    return ast.parse(source)
+
+def instrument_separately(config, recorder, modulename, source, filepath):
+    """ Instrument a module with a separate parse for each step
+        
+        This is how modules were instrumented before the pragmas, the
+        metadata and the annotator shared one tree, and it serves as the
+        baseline.
+    """
+    pragmas = PragmaFinder().find_pragmas(source)
+    recorder.add_metadata(
+        MetadataGatheringVisitor.analyze(config, modulename, source, pragmas))
+    annotator = CoverageAnnotator(config, modulename, recorder)
+    tree = annotator.visit(ast.parse(source))
+    return compile(tree, filepath, 'exec')
+
+def instrument_once(config, recorder, modulename, source, filepath):
+    """ Instrument a module the way the import hook does """
+    factory = AnnotatorFactory(config, recorder)
+    return factory.get_code(modulename, source, filepath)
+
+def benchmark_import(target='instrumental', repeat=3):
+    """ Compare the time taken to instrument every module in a package
+        
+        This is the overhead that instrumentation adds to importing the
+        package. Nothing is cached between runs. Modules that the running
+        Python can't parse (such as compatibility modules for the other
+        major version) are left out.
+    """
+    config, _ = parser.parse_args([])
+    sources = []
+    found = SourceFinder(list(sys.path)).find(target, [])
+    for filepath, modulename in sorted(set(found)):
+        with open(filepath) as source_file:
+            source = source_file.read()
+        try:
+            ast.parse(source)
+        except SyntaxError:
+            continue
+        sources.append((modulename, filepath, source))
+    
+    results = []
+    for name, instrument in [('parse only', parse_only),
+                             ('separate parses', instrument_separately),
+                             ('single parse', instrument_once)]:
+        best = None
+        for _ in range(repeat):
+            ExecutionRecorder.reset()
+            recorder = ExecutionRecorder.get()
+            start = default_timer()
+            for modulename, filepath, source in sources:
+                instrument(config, recorder, modulename, source, filepath)
+            elapsed = default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, best))
+    ExecutionRecorder.reset()
+    return len(sources), results
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    iterations = int(argv[0]) if argv else 20000
+    target = argv[1] if len(argv) > 1 else 'instrumental'
+    results = benchmark_boolean(iterations)
+    sys.stdout.write("%-20s %12s %12s\n" % ('', 'ns/call', 'ns/probe'))
+    for name, per_call, per_probe in results:
+        sys.stdout.write("%-20s %12.1f %12.1f\n" % (name,
+                                                    per_call * 1e9,
+                                                    per_probe * 1e9))
+
+    modules, results = benchmark_import(target)
+    sys.stdout.write("\n%-20s %12s %12s\n" % ('%s (%d modules)' % (target,
+                                                                    modules),
+                                               'ms',
+                                               'ms/module'))
+    for name, elapsed in results:
+        sys.stdout.write("%-20s %12.1f %12.2f\n" % (name,
+                                                    elapsed * 1e3,
+                                                    elapsed * 1e3 / modules))
+
+if __name__ == '__main__':
+    main()
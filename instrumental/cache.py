@@ -0,0 +1,260 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" A single-file cache for metadata and instrumented code
+    
+    Entries are kept in one sqlite database, keyed by a hash of the content
+    they were derived from rather than by file path, so the same module in
+    two checkouts shares an entry when both point at the same cache file.
+    The least recently used entries are evicted once the cache grows past
+    its size limit.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+import instrumental
+from instrumental import pragmas
+from instrumental.metadata import StatementHits
+from instrumental.storage import ObjectDecoder
+from instrumental.storage import ObjectEncoder
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join('.instrumental.cache', 'cache.sqlite')
+
+def open_cache(config):
+    """ Open the cache described by `config`, or return None if it's off """
+    if not config.use_metadata_cache:
+        return None
+    filename = config.cache_file or DEFAULT_CACHE_FILE
+    return CacheDatabase(os.path.abspath(filename),
+                         config.cache_size * 1024 * 1024)
+
+class CacheDatabase(object):
+    """ A size-bounded store of byte strings in a sqlite database
+        
+        Every `get` of an entry marks it as used, and `put` evicts the least
+        recently used entries when the total size of the values is over
+        `max_size`. The times entries were used are written in one go, when
+        entries are evicted or the database is closed, rather than on every
+        `get`. Errors from sqlite are logged and otherwise treated as
+        misses; the cache is never required for correct results.
+    """
+    
+    def __init__(self, filename, max_size):
+        self.filename = filename
+        self.max_size = max_size
+        self._connection = None
+        # The time each entry was used, since they were last written
+        self._used = {}
+        # Connections inherited from before a fork
+        self._inherited = []
+    
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.filename, timeout=30)
+            # Losing the last few entries in a crash only costs a reanalysis
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               ' key TEXT PRIMARY KEY,'
+                               ' value BLOB NOT NULL,'
+                               ' size INTEGER NOT NULL,'
+                               ' used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_used'
+                               ' ON entries (used)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+    
+    def get(self, key):
+        try:
+            connection = self._connect()
+            row = connection.execute('SELECT value FROM entries WHERE key = ?',
+                                     (key,)).fetchone()
+        except sqlite3.Error:
+            log.warning('Could not read from the cache %r', self.filename,
+                        exc_info=True)
+            return None
+        if row is None:
+            return None
+        self._used[key] = time.time()
+        return bytes(row[0])
+    
+    def put(self, key, value):
+        self._used.pop(key, None)
+        try:
+            connection = self._connect()
+            connection.execute('INSERT OR REPLACE INTO entries'
+                               ' (key, value, size, used)'
+                               ' VALUES (?, ?, ?, ?)',
+                               (key, sqlite3.Binary(value), len(value),
+                                time.time()))
+            self._write_used(connection)
+            self._evict(connection)
+            connection.commit()
+        except sqlite3.Error:
+            log.warning('Could not write to the cache %r', self.filename,
+                        exc_info=True)
+    
+    def _write_used(self, connection):
+        if self._used:
+            connection.executemany('UPDATE entries SET used = ? WHERE key = ?',
+                                   [(used, key) for key, used
+                                    in self._used.items()])
+            self._used = {}
+    
+    def _evict(self, connection):
+        total, = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if total <= self.max_size:
+            return
+        evicted = []
+        for key, size in connection.execute(
+            'SELECT key, size FROM entries ORDER BY used').fetchall():
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+    
+    def size(self):
+        """ The total size of the values in the cache """
+        total, = self._connect().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return total
+    
+    def after_fork(self):
+        """ Stop using the parent's connection in a forked child
+            
+            A sqlite connection mustn't be used on both sides of a fork. It
+            isn't closed either, since closing it could roll back what the
+            parent is in the middle of; the child connects again when it
+            next needs to.
+        """
+        if self._connection is not None:
+            self._inherited.append(self._connection)
+            self._connection = None
+    
+    def close(self):
+        if self._used:
+            try:
+                connection = self._connect()
+                self._write_used(connection)
+                connection.commit()
+            except sqlite3.Error:
+                log.warning('Could not write to the cache %r', self.filename,
+                            exc_info=True)
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+def metadata_key(config, modulename, source):
+    """ Compute the cache key for a module's metadata
+        
+        The metadata depends on the module source and name, the
+        instrumental and Python versions (which decide how the source is
+        parsed and analyzed) and the options that select what is instrumented.
+    """
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    key = hashlib.sha1(source)
+    for part in [modulename,
+                 instrumental.__version__,
+                 sys.version,
+                 repr((config.instrument_assertions,
+                       config.instrument_comparisons))]:
+        key.update(part.encode('utf-8'))
+    return 'metadata:' + key.hexdigest()
+
+def encode_pragma(pragma):
+    encoded = dict(pragma.__dict__)
+    encoded['__python_class__'] = pragma.__class__.__name__
+    return encoded
+
+def decode_pragma(d):
+    d = dict(d)
+    klass = getattr(pragmas, d.pop('__python_class__'))
+    pragma = klass.__new__(klass)
+    pragma.__dict__.update(d)
+    return pragma
+
+def encode_metadata(metadata):
+    """ Encode metadata as compressed JSON
+        
+        This is the encoding used for results (see instrumental.storage),
+        plus the statement slot order, the construct ids and the pragmas,
+        which instrumenting the module needs.
+    """
+    encoded = ObjectEncoder().encode_ModuleMetadata(metadata)
+    encoded['lines'] = metadata.lines.items()
+    encoded['construct_ids'] = metadata.construct_ids
+    encoded['pragmas'] = dict((lineno, [encode_pragma(pragma)
+                                        for pragma in line_pragmas])
+                              for lineno, line_pragmas
+                              in metadata.pragmas.items())
+    return zlib.compress(json.dumps(encoded).encode('utf-8'))
+
+def decode_metadata(value):
+    encoded = json.loads(zlib.decompress(value).decode('utf-8'))
+    lines = encoded.pop('lines')
+    encoded['lines'] = {}
+    metadata = ObjectDecoder().decode_ModuleMetadata(encoded)
+    metadata.lines = StatementHits()
+    for lineno, hit in lines:
+        metadata.lines[lineno] = hit
+    metadata.construct_ids = dict((str(label), cid) for label, cid
+                                  in encoded['construct_ids'].items())
+    metadata.pragmas = dict((int(lineno), set(decode_pragma(pragma)
+                                              for pragma in line_pragmas))
+                            for lineno, line_pragmas
+                            in encoded['pragmas'].items())
+    return metadata
+
+class MetadataCache(object):
+    
+    def __init__(self, database, config):
+        self.database = database
+        self.config = config
+    
+    def fetch(self, modulename, source):
+        value = self.database.get(metadata_key(self.config, modulename, source))
+        if value is None:
+            return None
+        try:
+            return decode_metadata(value)
+        except (ValueError, KeyError, TypeError, AttributeError, zlib.error):
+            log.debug('discarding unreadable cached metadata for %r',
+                      modulename)
+            return None
+    
+    def store(self, modulename, source, metadata):
+        try:
+            value = encode_metadata(metadata)
+        except (TypeError, ValueError):
+            # Some literals (bytes, for instance) have no JSON encoding
+            log.debug('not caching metadata for %r', modulename)
+            return
+        self.database.put(metadata_key(self.config, modulename, source), value)
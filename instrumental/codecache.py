@@ -0,0 +1,86 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" A cache for the code objects of instrumented modules
+    
+    Instrumenting a module means parsing it, annotating the tree and
+    compiling the result, which adds up when a test process restarts many
+    times. The compiled code is cached with the metadata (see
+    instrumental.cache), keyed by everything that determines what the
+    instrumented code looks like.
+"""
+import hashlib
+import logging
+import marshal
+import sys
+
+import instrumental
+
+log = logging.getLogger(__name__)
+
+def code_key(source, metadata, options):
+    """ Compute the cache key for a module's instrumented code
+        
+        The key covers the module source, the instrumental and Python
+        versions, the instrumentation options, and the construct ids and
+        statement slots in `metadata`, since those are baked into the probes.
+    """
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    key = hashlib.sha1(source)
+    for part in [instrumental.__version__,
+                 sys.version,
+                 repr(tuple(options)),
+                 repr(sorted(metadata.construct_ids.items())),
+                 repr(metadata.lines.linenos)]:
+        key.update(part.encode('utf-8'))
+    return key.hexdigest()
+
+class DummyCodeCache(object):
+    
+    def fetch(self, filepath, key):
+        return None
+    
+    def store(self, filepath, key, code):
+        pass
+
+class CodeCache(object):
+    """ Stores marshalled code objects in a CacheDatabase
+    
+        Code objects carry the path they were compiled from, so the path is
+        part of the entry's key. The metadata cache is what's shared between
+        checkouts.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+    
+    def _key(self, filepath, key):
+        return 'code:%s:%s' % (key, filepath)
+    
+    def fetch(self, filepath, key):
+        value = self.database.get(self._key(filepath, key))
+        if value is None:
+            return None
+        try:
+            return marshal.loads(value)
+        except (EOFError, ValueError, TypeError):
+            log.debug('discarding unreadable cached code for %r', filepath)
+            return None
+    
+    def store(self, filepath, key, code):
+        self.database.put(self._key(filepath, key), marshal.dumps(code))
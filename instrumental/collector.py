@@ -0,0 +1,193 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Collect the results of many processes in one over a Unix socket
+    
+    A process that would otherwise save its own coverage file can instead
+    send its results to a Collector, which merges the results of every
+    process that connects into one recorder and saves them in one
+    ResultStore. Nothing needs to be combined afterwards.
+    
+    What's sent is a journal (see instrumental.journal): a CollectorTransport
+    is a HitJournal that writes its batches to the collector's socket rather
+    than to a file. The collector drops a batch that a process didn't finish
+    sending before it died, and keeps everything before it.
+"""
+import logging
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+from instrumental.compat import socketserver
+from instrumental.journal import DEFAULT_INTERVAL
+from instrumental.journal import HitJournal
+from instrumental.recorder import ExecutionRecorder
+from instrumental.storage import JOURNAL_BATCH
+from instrumental.storage import JOURNAL_DIRECTORY
+from instrumental.storage import JournalReplayer
+from instrumental.storage import read_journal
+
+log = logging.getLogger(__name__)
+
+class CollectorTransport(HitJournal):
+    """ Sends the results in `recorder` to the collector at `address`
+        
+        The module records refer to static metadata in `metadata_store`,
+        which the collector reads, so the collector must be able to see
+        the same directory. If the connection is lost, `failed` is set and
+        nothing more is sent.
+    """
+    
+    def __init__(self, recorder, address, metadata_store,
+                 interval=DEFAULT_INTERVAL):
+        super(CollectorTransport, self).__init__(recorder, address,
+                                                 metadata_store, interval)
+        self.failed = False
+    
+    @property
+    def address(self):
+        return self.filename
+    
+    def _open(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.address)
+            directory = os.path.abspath(self.metadata_store.directory)
+            directory = directory.encode('utf-8')
+            record = (b'D'
+                      + JOURNAL_DIRECTORY.pack(len(directory))
+                      + directory)
+            connection.sendall(JOURNAL_BATCH.pack(len(record)) + record)
+        except socket.error:
+            connection.close()
+            raise
+        return connection
+    
+    def _write(self, data):
+        if self.failed:
+            return
+        try:
+            self._output.sendall(data)
+        except socket.error:
+            log.warning('Lost the connection to the collector at %r',
+                        self.address, exc_info=True)
+            self.failed = True
+    
+    def remove(self):
+        pass
+
+class CollectorHandler(socketserver.StreamRequestHandler):
+    
+    def handle(self):
+        self.server.collector.receive(self.rfile)
+
+class CollectorServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Collector(object):
+    """ Merges the results sent to `address` and saves them in `store`
+        
+        Each connection is read by its own thread, and the results are
+        replayed into one recorder as each batch arrives.
+    """
+    
+    def __init__(self, address, store):
+        self.address = address
+        self.store = store
+        self.recorder = ExecutionRecorder()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(threading.Lock())
+        self._connections = 0
+        self._server = None
+    
+    def bind(self):
+        """ Listen on the socket, replacing one left by an earlier collector
+            
+            Only the user running the collector can connect to it.
+        """
+        if os.path.exists(self.address):
+            if not stat.S_ISSOCK(os.stat(self.address).st_mode):
+                raise ValueError('%r exists and is not a socket'
+                                 % self.address)
+            os.remove(self.address)
+        umask = os.umask(0o177)
+        try:
+            self._server = CollectorServer(self.address, CollectorHandler)
+        finally:
+            os.umask(umask)
+        self._server.collector = self
+    
+    def serve_forever(self):
+        self._server.serve_forever()
+    
+    def shutdown(self):
+        """ Stop serve_forever, which is running in another thread """
+        self._server.shutdown()
+    
+    def close(self):
+        """ Stop listening and remove the socket """
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.address):
+                os.remove(self.address)
+    
+    def wait(self, timeout=None):
+        """ Wait until no process is connected
+            
+            Returns whether that happened before `timeout` seconds passed.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._idle:
+            while self._connections:
+                if timeout is None:
+                    self._idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._idle.wait(remaining)
+            return not self._connections
+    
+    def receive(self, f):
+        """ Replay the journal sent over one connection """
+        with self._idle:
+            self._connections += 1
+        try:
+            replayer = JournalReplayer(self.recorder,
+                                       self.store.metadata_store)
+            for record in read_journal(f):
+                with self._lock:
+                    replayer.replay(record)
+        except (ValueError, KeyError, IndexError, struct.error,
+                EnvironmentError):
+            log.warning('Dropping the rest of the results from a process',
+                        exc_info=True)
+        finally:
+            with self._idle:
+                self._connections -= 1
+                if not self._connections:
+                    self._idle.notify_all()
+    
+    def save(self):
+        with self._lock:
+            self.store.save(self.recorder)
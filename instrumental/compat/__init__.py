@@ -21,3 +21,31 @@ if sys.version_info[0] < 3:
     from instrumental.compat.py2 import *
 else:
     from instrumental.compat.py3 import *
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    import threading
+    
+    class ContextVar(object):
+        """ A stand-in for contextvars.ContextVar before Python 3.7
+            
+            Values are kept per thread. There's no asyncio to keep them
+            per task for on Python 2.
+        """
+        
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+        
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+        
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+        
+        def reset(self, token):
+            self._local.value = token
@@ -16,6 +16,11 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 import inspect
+import SocketServer as socketserver
+
+# The array type of hit counters (see instrumental.metadata.HitCounts).
+# Python 2 has no 'Q'.
+COUNTER_TYPECODE = 'L'
 
 def exec_f(object_, globals_=None, locals_=None):
     if not globals_ and not locals_:
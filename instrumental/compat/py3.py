@@ -15,6 +15,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import socketserver
+
+# The array type of hit counters (see instrumental.metadata.HitCounts)
+COUNTER_TYPECODE = 'Q'
+
 exec_f = exec
 def execfile(path, globals_=None, locals_=None):
         if globals_ is None:
@@ -20,6 +20,8 @@ from copy import deepcopy
 from astkit import ast
 from astkit.render import SourceCodeRenderer
 
+from instrumental.tags import TagSet
+
 class PragmaCondition(object):
     TAG = 'P'
     
@@ -32,17 +34,78 @@ class UnreachableCondition(object):
     def __str__(self):
         return self.TAG
 
-class LogicalBoolean(object):
+class Construct(object):
+    """ Behaviour shared by all constructs
+        
+        A construct's source is rendered from its node the first time it is
+        asked for. A construct restored from stored results may be given a
+        function that finds its node instead of the node itself, and then the
+        node is only looked for when it's needed.
+    """
+    
+    _node = None
+    _find_node = None
+    _source = None
+    
+    @classmethod
+    def restore(cls, modulename, label, conditions, node=None, find_node=None,
+                **attributes):
+        """ Rebuild a construct from stored results without analyzing it
+            
+            The stored `conditions` already account for literals and
+            pragmas. `attributes` are the other attributes that the kind of
+            construct keeps: the pins and literals of a logical and/or, or the
+            lineno of a decision or comparison.
+        """
+        construct = cls.__new__(cls)
+        construct.modulename = modulename
+        construct.label = label
+        construct.pragmas = []
+        construct.conditions = conditions
+        construct._node = node
+        construct._find_node = find_node
+        construct.__dict__.update(attributes)
+        return construct
+    
+    def _get_node(self):
+        if self._node is None and self._find_node is not None:
+            self._node = self._find_node()
+        return self._node
+    
+    def _set_node(self, node):
+        self._node = node
+    node = property(_get_node, _set_node)
+    
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = SourceCodeRenderer.render(self.node)
+        return self._source
+    
+    def snapshot(self):
+        """ A copy of this construct with a copy of its results
+            
+            The copy can be encoded in another thread while results are
+            still being recorded here. Each TagSet is copied by taking its
+            bits, which another thread can't change halfway through.
+        """
+        construct = self.__class__.__new__(self.__class__)
+        construct.__dict__.update(self.__dict__)
+        construct.conditions = dict((condition, TagSet(results))
+                                    for condition, results
+                                    in list(self.conditions.items()))
+        return construct
+
+class LogicalBoolean(Construct):
     
     def __init__(self, modulename, label, node, pragmas):
         self.modulename = modulename
         self.label = label
         self.node = deepcopy(node)
         self.pragmas = pragmas
-        self.source = SourceCodeRenderer.render(node)
         self.pins = len(node.values)
         self.conditions =\
-            dict((i, set()) for i in range(self.pins + 1))
+            dict((i, TagSet()) for i in range(self.pins + 1))
         self.literals = self._gather_literals(node)
         self._set_unreachable_conditions()
         for pragma in pragmas:
@@ -171,24 +234,33 @@ class LogicalAnd(LogicalBoolean):
                 _conditions.append(i+1)
         return _conditions
     
-    def record(self, value, pin, tag):
-        """ Record that a value was seen for a particular pin """
+    def condition_for(self, value, pin):
+        """ Return the condition indicated by seeing a value for a pin
+            
+            None is returned if the value doesn't determine a condition.
+        """
         # If the pin is not the last pin in the decision and
         # the value seen is False, then we've found the pin
         # that has forced the decision False and we should
         # record that.
         if pin < (self.pins-1):
             if not value:
-                self.conditions[pin+1].add(tag)
+                return pin+1
         
         # If the pin is the last pin then we'll record that
         # it either allowed the decision to be True or it
         # is the pin that has forced the decision False.
         elif pin == (self.pins-1):
             if value:
-                self.conditions[0].add(tag)
+                return 0
             else:
-                self.conditions[self.pins].add(tag)
+                return self.pins
+    
+    def record(self, value, pin, tag):
+        """ Record that a value was seen for a particular pin """
+        condition = self.condition_for(value, pin)
+        if condition is not None:
+            self.conditions[condition].add(tag)
     
     def description(self, n):
         if n == 0:
@@ -240,8 +312,11 @@ class LogicalOr(LogicalBoolean):
             _conditions.append(self.pins)
         return _conditions
     
-    def record(self, value, pin, tag):
-        """ Record that a value was seen for a particular pin """
+    def condition_for(self, value, pin):
+        """ Return the condition indicated by seeing a value for a pin
+            
+            None is returned if the value doesn't determine a condition.
+        """
         
         # If the pin is not the last pin in the decision
         # and the value we see is True, then we've found the
@@ -250,15 +325,21 @@ class LogicalOr(LogicalBoolean):
         # since this is not a significant case.
         if pin < (self.pins-1):
             if value:
-                self.conditions[pin].add(tag)
+                return pin
         
         # If this is the last pin then it either allowed the
         # decision to be False or forced the decision True.
         elif pin == (self.pins-1):
             if value:
-                self.conditions[pin].add(tag)
+                return pin
             else:
-                self.conditions[self.pins].add(tag)
+                return self.pins
+    
+    def record(self, value, pin, tag):
+        """ Record that a value was seen for a particular pin """
+        condition = self.condition_for(value, pin)
+        if condition is not None:
+            self.conditions[condition].add(tag)
         
     def description(self, n):
         acc = ""
@@ -283,7 +364,7 @@ class LogicalOr(LogicalBoolean):
     def was_false(self):
         return self.conditions[self.pins]
     
-class BooleanDecision(object):
+class BooleanDecision(Construct):
     
     def __init__(self, modulename, label, node, pragmas):
         self.modulename = modulename
@@ -291,9 +372,8 @@ class BooleanDecision(object):
         self.node = deepcopy(node)
         self.pragmas = pragmas
         self.lineno = node.lineno
-        self.source = SourceCodeRenderer.render(node)
-        self.conditions = {True: set(),
-                           False: set()}
+        self.conditions = {True: TagSet(),
+                           False: TagSet()}
         for pragma in pragmas:
             if hasattr(pragma, 'selector'):
                 pragma_label = '%s.%s' % (node.lineno, pragma.selector)
@@ -303,8 +383,11 @@ class BooleanDecision(object):
     def is_decision(self):
         return True
     
+    def condition_for(self, expression):
+        return bool(expression)
+    
     def record(self, expression, tag):
-        result = bool(expression)
+        result = self.condition_for(expression)
         self.conditions[result].add(tag)
         return result
     
@@ -365,7 +448,7 @@ class BooleanDecision(object):
         for condition, results in self.conditions.items():
             results.update(other.conditions[condition])
     
-class Comparison(object):
+class Comparison(Construct):
     
     def __init__(self, modulename, label, node, pragmas):
         self.modulename = modulename
@@ -373,9 +456,8 @@ class Comparison(object):
         self.node = deepcopy(node)
         self.pragmas = pragmas
         self.lineno = node.lineno
-        self.source = SourceCodeRenderer.render(node)
-        self.conditions = {True: set(),
-                           False: set()}
+        self.conditions = {True: TagSet(),
+                           False: TagSet()}
         self._set_unreachable_condition()
         
         for pragma in pragmas:
@@ -421,8 +503,11 @@ class Comparison(object):
     def is_decision(self):
         return False
     
+    def condition_for(self, expression):
+        return bool(expression)
+    
     def record(self, expression, tag):
-        result = bool(expression)
+        result = self.condition_for(expression)
         self.conditions[result].add(tag)
         return result
     
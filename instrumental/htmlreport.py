@@ -15,6 +15,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import math
 import os
 import shutil
 import sys
@@ -22,11 +23,26 @@ import sys
 from mako.exceptions import text_error_template
 from mako.lookup import TemplateLookup
 
+def heat(counts):
+    """ Map each line in `counts` to its count and how hot it is
+        
+        Hotness goes from 0 for a line that never ran to 1 for the line that
+        ran the most, on a log scale so that the lines that ran a few times
+        can be told from the ones that didn't.
+    """
+    hottest = max(counts.values()) if counts else 0
+    if not hottest:
+        return dict((lineno, (count, 0.0)) for lineno, count in counts.items())
+    scale = math.log(hottest + 1)
+    return dict((lineno, (count, round(math.log(count + 1) / scale, 2)))
+                for lineno, count in counts.items())
+
 class HTMLCoverageReport(object):
     
-    def __init__(self, summary, sources):
+    def __init__(self, summary, sources, counts=None):
         self.summary = summary
         self.sources = sources
+        self.counts = counts or {}
     
     def write(self, directory):
         sys.stdout.write("writing html coverage report to %s\n" % directory)
@@ -69,10 +85,13 @@ class HTMLCoverageReport(object):
                     condition_list.append(condition)
                 try:
                     source = self.sources[module].decode('utf-8')
+                    counts = self.counts.get(module)
                     module_html = \
-                        module_template.render(module=module_summary,
-                                               source=source,
-                                               conditions=conditions_by_line)
+                        module_template.render(
+                            module=module_summary,
+                            source=source,
+                            conditions=conditions_by_line,
+                            heat=heat(counts) if counts is not None else None)
                 except:
                     sys.stdout.write(text_error_template().render())
                     raise
@@ -21,9 +21,6 @@ import os
 import re
 import sys
 
-from astkit import ast
-from astkit.render import SourceCodeRenderer
-
 from instrumental.compat import exec_f
 
 log = logging.getLogger(__name__)
@@ -49,11 +46,7 @@ class ModuleLoader(object):
         # packages are loaded from __init__.py files
         ispkg = self.fullpath.endswith('__init__.py')
         code_str = self._get_source(self.fullpath)
-        visitor = self.visitor_factory.create(fullname, code_str)
-        code_tree = ast.parse(code_str)
-        new_code_tree = visitor.visit(code_tree)
-        log.debug(SourceCodeRenderer.render(new_code_tree))
-        code = compile(new_code_tree, self.fullpath, 'exec')
+        code = self.visitor_factory.get_code(fullname, code_str, self.fullpath)
         return (ispkg, code)
     
     def load_module(self, fullname):
@@ -27,35 +27,58 @@
     stops when the result of the operation has been determined.
     
 """
+import logging
 import sys
 
 from astkit import ast
 from astkit.render import SourceCodeRenderer
 
+from instrumental import monitoring
 from instrumental import recorder
-from instrumental.metadata import MetadataGatheringVisitor
-from instrumental.pragmas import PragmaFinder
+from instrumental.cache import MetadataCache
+from instrumental.cache import open_cache
+from instrumental.codecache import code_key
+from instrumental.codecache import CodeCache
+from instrumental.codecache import DummyCodeCache
+from instrumental.metadata import analyze_source
+from instrumental.metadata import DummyMetadataCache
 from instrumental.pragmas import PragmaNoCover
 
+log = logging.getLogger(__name__)
+
 def force_location(tree, lineno, col_offset=0):
     for node in ast.walk(tree):
         if hasattr(node, 'lineno'):
             node.lineno = lineno
             node.col_offset = col_offset
+        # Python 3.8 and later compile from the end position too, and the
+        # nodes of the recorder setup still have theirs from recorder.py
+        if hasattr(node, 'end_lineno'):
+            node.end_lineno = lineno
+            node.end_col_offset = col_offset
 
 def has_docstring(defn):
     return ast.get_docstring(defn) is not None
 
+def is_future_import(node):
+    return isinstance(node, ast.ImportFrom) and node.module == '__future__'
+
 def has_future_import(module):
     if not module.body:
         return False
-    return (isinstance(module.body[0], ast.ImportFrom)
-            and module.body[0].module == '__future__')
+    return is_future_import(module.body[0])
+
+# These statements don't compile to any bytecode, so the interpreter never
+# reports executing them and they always need a statement marker
+UNMONITORED_STATEMENTS = tuple(getattr(ast, name)
+                               for name in ('Global', 'Nonlocal')
+                               if hasattr(ast, name))
 
 class InstrumentedNodeFactory(object):
     
-    def __init__(self, recorder):
+    def __init__(self, recorder, disarm_statements=False):
         self._recorder = recorder
+        self._disarm_statements = disarm_statements
     
     def instrument_node(self, modulename, label, node, pragmas, parent):
         return self._recorder.add_BoolOp(modulename, label, node, pragmas, parent)
@@ -67,23 +90,74 @@ class InstrumentedNodeFactory(object):
         return self._recorder.add_comparison(modulename, label, node)
     
     def instrument_statement(self, modulename, node):
-        return self._recorder.add_statement(modulename, node)
+        return self._recorder.add_statement(modulename, node,
+                                            self._disarm_statements)
 
 class AnnotatorFactory(object):
     
     def __init__(self, config, recorder):
         self.config = config
         self.recorder = recorder
+        self.database = database = open_cache(config)
+        if database is not None:
+            self.metadata_cache = MetadataCache(database, config)
+            self.code_cache = CodeCache(database)
+        else:
+            self.metadata_cache = DummyMetadataCache()
+            self.code_cache = DummyCodeCache()
+    
+    def after_fork(self):
+        if self.database is not None:
+            self.database.after_fork()
     
-    def create(self, modulename, module_source):
+    def close(self):
+        if self.database is not None:
+            self.database.close()
+    
+    def create(self, modulename, module_source, tree=None):
         if modulename not in self.recorder.metadata:
-            pragmas = PragmaFinder().find_pragmas(module_source)
-            self.recorder.metadata[modulename] = (
-                MetadataGatheringVisitor.analyze(self.config,
-                                                 modulename,
-                                                 module_source,
-                                                 pragmas))
+            self.recorder.add_metadata(analyze_source(self.config,
+                                                      modulename,
+                                                      module_source,
+                                                      tree))
         return CoverageAnnotator(self.config, modulename, self.recorder)
+    
+    def get_code(self, modulename, module_source, filepath):
+        """ Get the instrumented code object for a module
+            
+            The code is taken from the code cache when nothing that affects
+            the instrumentation has changed, which saves parsing, annotating
+            and compiling the module again. Otherwise the module is parsed
+            once and the same tree is used for the pragmas, the metadata (if
+            it hasn't been gathered yet) and the instrumentation.
+        """
+        code_tree = None
+        if modulename not in self.recorder.metadata:
+            # The metadata wasn't gathered up front (see --lazy-metadata),
+            # so gather it now that the module is being imported
+            metadata = self.metadata_cache.fetch(modulename, module_source)
+            if not metadata:
+                code_tree = ast.parse(module_source)
+                metadata = analyze_source(self.config,
+                                          modulename,
+                                          module_source,
+                                          code_tree)
+                self.metadata_cache.store(modulename, module_source, metadata)
+            self.recorder.add_metadata(metadata)
+        annotator = self.create(modulename, module_source)
+        key = code_key(module_source,
+                       self.recorder.metadata[modulename],
+                       annotator.options())
+        code = self.code_cache.fetch(filepath, key)
+        if code is None:
+            if code_tree is None:
+                code_tree = ast.parse(module_source)
+            new_code_tree = annotator.visit(code_tree)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(SourceCodeRenderer.render(new_code_tree))
+            code = compile(new_code_tree, filepath, 'exec')
+            self.code_cache.store(filepath, key, code)
+        return code
 
 class CoverageAnnotator(ast.NodeTransformer):
     
@@ -91,10 +165,31 @@ class CoverageAnnotator(ast.NodeTransformer):
         self.config = config
         self.modulename = modulename
         self.pragmas = recorder.metadata[modulename].pragmas
-        self.node_factory = InstrumentedNodeFactory(recorder)
+        # A disarmed statement stops calling the recorder, so it can't be
+        # counted
+        self.disarm_statements = (config.disarm_statement_probes
+                                  and not recorder.counting)
+        self.node_factory = InstrumentedNodeFactory(recorder,
+                                                    self.disarm_statements)
+        self.recorder = recorder
+        self.monitor = recorder.monitor
+        self.monitor_statements = (self.monitor is not None
+                                   and self.monitor.statements)
+        self.monitor_decisions = (self.monitor is not None
+                                  and self.monitor.decisions)
         self.modifiers = []
         self.expression_context = [None]
         self._found_labels = []
+        self._monitored_decisions = []
+    
+    def options(self):
+        """ The settings that change how this annotator instruments code """
+        return (self.config.instrument_assertions,
+                self.config.instrument_comparisons,
+                self.disarm_statements,
+                self.monitor is not None,
+                self.monitor_statements,
+                self.monitor_decisions)
     
     def _next_label(self, lineno):
         i = 1
@@ -104,17 +199,72 @@ class CoverageAnnotator(ast.NodeTransformer):
         self._found_labels.append(label)
         return label
     
+    def _statement_marker(self, node):
+        if (self.monitor_statements
+            and not isinstance(node, UNMONITORED_STATEMENTS)
+            and not is_future_import(node)):
+            return None
+        return self.node_factory.instrument_statement(self.modulename, node)
+    
+    def _instrument_test(self, label, node):
+        """ Instrument the test of an if or while statement
+            
+            When decisions are monitored a test that isn't a boolean
+            operation is left alone for now. Its result may be readable from
+            branch events, which is settled once the module has been visited.
+        """
+        if self.monitor_decisions and not isinstance(node.test, ast.BoolOp):
+            self._monitored_decisions.append((label, node))
+        else:
+            node.test = self.node_factory.instrument_test(self.modulename,
+                                                          label,
+                                                          node.test)
+    
+    def _resolve_monitored_decisions(self, module):
+        """ Find the decisions whose results can come from branch events
+            
+            The module is compiled to find the conditional jumps for each
+            monitored test. Tests that don't compile to jumps we can read
+            (constant tests, negations and the like) get their probes after
+            all. Returns (construct id, source span) pairs for the others.
+        """
+        if not self._monitored_decisions:
+            return []
+        jumps = monitoring.find_jumps(compile(module, '<instrumental>', 'exec'))
+        construct_ids = self.recorder.metadata[self.modulename].construct_ids
+        decisions = []
+        for label, node in self._monitored_decisions:
+            span = monitoring.node_span(node.test)
+            if label in construct_ids and monitoring.is_branch(jumps.get(span)):
+                decisions.append((construct_ids[label], span))
+            else:
+                node.test = self.node_factory.instrument_test(self.modulename,
+                                                              label,
+                                                              node.test)
+        return decisions
+    
+    def _with_marker(self, marker, node, after=False):
+        if marker is None:
+            return node
+        elif after:
+            return [node, marker]
+        return [marker, node]
+    
     def _has_pragma(self, lineno, pragma_klass):
         return any(isinstance(pragma, pragma_klass)
                    for pragma in self.pragmas[lineno])
     
     def visit_Module(self, module):
-        recorder_setup = recorder.get_setup()
         docstring = None
         if has_docstring(module):
             docstring = module.body.pop(0)
         self.generic_visit(module)
         
+        decisions = self._resolve_monitored_decisions(module)
+        recorder_setup = recorder.get_setup(self.modulename,
+                                            self.disarm_statements,
+                                            self.monitor is not None,
+                                            decisions)
         if has_future_import(module):
             future_import = module.body.pop(0)
             recorder_setup.insert(0, future_import)
@@ -157,9 +307,9 @@ class CoverageAnnotator(ast.NodeTransformer):
         if PragmaNoCover in self.modifiers:
             result = node
         else:
-            marker = self.node_factory.instrument_statement(self.modulename, node)
+            marker = self._statement_marker(node)
             self.generic_visit(node)
-            result = [marker, node]
+            result = self._with_marker(marker, node)
         
         if self._has_pragma(node.lineno, PragmaNoCover):
             self.modifiers.pop(-1)
@@ -205,8 +355,8 @@ class CoverageAnnotator(ast.NodeTransformer):
             # and put the docstring back
             defn.body = [docstring] + defn.body
             
-            marker = self.node_factory.instrument_statement(self.modulename, defn)
-            result = [marker, defn]
+            marker = self._statement_marker(defn)
+            result = self._with_marker(marker, defn)
         return result
     
     def visit_ClassDef(self, defn):
@@ -262,8 +412,8 @@ class CoverageAnnotator(ast.NodeTransformer):
             result = for_
         else:
             self.generic_visit(for_)
-            marker = self.node_factory.instrument_statement(self.modulename, for_)
-            result = [marker, for_]
+            marker = self._statement_marker(for_)
+            result = self._with_marker(marker, for_)
         
         if self._has_pragma(for_.lineno, PragmaNoCover):
             self.modifiers.pop(-1)
@@ -295,10 +445,10 @@ class CoverageAnnotator(ast.NodeTransformer):
             result = if_
         else:
             label = self._next_label(if_.lineno)
-            if_.test = self.node_factory.instrument_test(self.modulename, label, if_.test)
+            self._instrument_test(label, if_)
             if_ = self.generic_visit(if_)
-            marker = self.node_factory.instrument_statement(self.modulename, if_)
-            result = [marker, if_]
+            marker = self._statement_marker(if_)
+            result = self._with_marker(marker, if_)
         
         if self._has_pragma(if_.lineno, PragmaNoCover):
             self.modifiers.pop(-1)
@@ -315,11 +465,11 @@ class CoverageAnnotator(ast.NodeTransformer):
         if PragmaNoCover in self.modifiers:
             result = import_
         else:
-            marker = self.node_factory.instrument_statement(self.modulename, import_)
+            marker = self._statement_marker(import_)
             if import_.module == '__future__':
-                result = [import_, marker]
+                result = self._with_marker(marker, import_, after=True)
             else:
-                result = [marker, import_]
+                result = self._with_marker(marker, import_)
         
         if self._has_pragma(import_.lineno, PragmaNoCover):
             self.modifiers.pop(-1)
@@ -351,10 +501,10 @@ class CoverageAnnotator(ast.NodeTransformer):
             result = while_
         else:
             label = self._next_label(while_.lineno)
-            while_.test = self.node_factory.instrument_test(self.modulename, label, while_.test)
+            self._instrument_test(label, while_)
             self.generic_visit(while_)
-            marker = self.node_factory.instrument_statement(self.modulename, while_)
-            result = [marker, while_]
+            marker = self._statement_marker(while_)
+            result = self._with_marker(marker, while_)
         
         if self._has_pragma(while_.lineno, PragmaNoCover):
             self.modifiers.pop(-1)
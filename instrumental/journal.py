@@ -0,0 +1,197 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" An append-only journal of the results a process records
+    
+    Results are normally saved once, when the run ends, and a process that
+    crashes or exits with os._exit loses all of them. A HitJournal runs a
+    thread that wakes up every so often and appends whatever has been
+    recorded since it last looked to a file next to the coverage file.
+    ResultStore replays the journals it finds when it loads.
+    
+    The thread finds new results by comparing each module's statement hits
+    and condition results with what it has already written, so recording
+    isn't slowed down. A module's static metadata goes into the store's
+    MetadataStore the first time the module is seen, and the journal refers
+    to it by key.
+"""
+import logging
+import os
+import threading
+
+from instrumental.constructs import PragmaCondition
+from instrumental.constructs import UnreachableCondition
+from instrumental.storage import CompactEncoder
+from instrumental.storage import JOURNAL_BATCH
+from instrumental.storage import JOURNAL_CONDITION
+from instrumental.storage import JOURNAL_MODULE
+from instrumental.storage import JOURNAL_STATEMENT
+from instrumental.storage import JOURNAL_TAG
+from instrumental.storage import RunEncoder
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1.0
+
+def is_static(result):
+    """ Was this condition result decided by analysis? """
+    return result == UnreachableCondition or result == PragmaCondition.TAG
+
+class JournaledModule(object):
+    """ What has been written to the journal for one module """
+    
+    def __init__(self, index, metadata):
+        self.index = index
+        self.metadata = metadata
+        self.lines = bytearray()
+        self.constructs = sorted((cid, metadata.constructs[label])
+                                 for label, cid
+                                 in metadata.construct_ids.items()
+                                 if label in metadata.constructs)
+        self.results = {}
+
+class HitJournal(object):
+    """ Appends the results in `recorder` to `filename` as they come in
+        
+        `interval` is the number of seconds between flushes. The journal is
+        flushed once more when it's stopped.
+    """
+    
+    def __init__(self, recorder, filename, metadata_store,
+                 interval=DEFAULT_INTERVAL):
+        self.recorder = recorder
+        self.filename = filename
+        self.metadata_store = metadata_store
+        self.interval = interval
+        self._modules = {}
+        self._tags = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._output = None
+    
+    def _open(self):
+        # Unbuffered, so that each batch is written in one call and a
+        # forked child has nothing of its parent's left to write
+        return open(self.filename, 'ab', 0)
+    
+    def _write(self, data):
+        self._output.write(data)
+    
+    def start(self):
+        self._output = self._open()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='instrumental-journal')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                log.warning('Could not write to the journal %r',
+                            self.filename, exc_info=True)
+    
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._output is not None:
+                self._output.close()
+                self._output = None
+    
+    def remove(self):
+        """ Remove the journal, once its results have been saved """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+    
+    def flush(self):
+        """ Append the results recorded since the last flush """
+        with self._lock:
+            if self._output is None:
+                return
+            self.recorder.merge_shards()
+            records = []
+            for modulename, metadata in list(self.recorder.metadata.items()):
+                module = self._modules.get(modulename)
+                if module is None or module.metadata is not metadata:
+                    module = self._add_module(modulename, metadata, records)
+                self._collect_statements(module, records)
+                self._collect_conditions(module, records)
+            if records:
+                batch = b''.join(records)
+                self._write(JOURNAL_BATCH.pack(len(batch)) + batch)
+    
+    def _add_module(self, modulename, metadata, records):
+        encoded = CompactEncoder().encode_ModuleMetadata(metadata, None)
+        key = RunEncoder(self.metadata_store).encode_module(
+            modulename, metadata.source, encoded)['static']
+        module = JournaledModule(len(self._modules), metadata)
+        self._modules[modulename] = module
+        name = modulename.encode('utf-8')
+        key = key.encode('ascii')
+        records.append(b'M'
+                       + JOURNAL_MODULE.pack(module.index, len(name), len(key))
+                       + name
+                       + key)
+        return module
+    
+    def _tag_id(self, tag, records):
+        tag_id = self._tags.get(tag)
+        if tag_id is None:
+            tag_id = len(self._tags)
+            self._tags[tag] = tag_id
+            encoded = tag if isinstance(tag, bytes) else tag.encode('utf-8')
+            records.append(b'T'
+                           + JOURNAL_TAG.pack(tag_id, len(encoded))
+                           + encoded)
+        return tag_id
+    
+    def _collect_statements(self, module, records):
+        hits = module.metadata.lines.hits
+        if hits == module.lines:
+            return
+        hits = bytearray(hits)
+        written = module.lines
+        for slot, hit in enumerate(hits):
+            if hit and not (slot < len(written) and written[slot]):
+                records.append(b'S' + JOURNAL_STATEMENT.pack(module.index,
+                                                             slot))
+        module.lines = hits
+    
+    def _collect_conditions(self, module, records):
+        for cid, construct in module.constructs:
+            for condition, results in list(construct.conditions.items()):
+                written = module.results.get((cid, condition), frozenset())
+                if len(results) == len(written):
+                    continue
+                results = frozenset(results)
+                for result in results - written:
+                    if is_static(result):
+                        continue
+                    records.append(b'C'
+                                   + JOURNAL_CONDITION.pack(
+                                       module.index,
+                                       cid,
+                                       int(condition),
+                                       self._tag_id(result, records)))
+                module.results[(cid, condition)] = results
@@ -1,50 +1,302 @@
+from array import array
 from copy import deepcopy
 import fnmatch
 import itertools
+import multiprocessing
 import os
-import pickle
 import re
 import sys
-import time
 
 from astkit import ast
 
 from instrumental import constructs
-from instrumental import util
+from instrumental.compat import COUNTER_TYPECODE
 from instrumental.pragmas import PragmaFinder
 from instrumental.pragmas import PragmaNoCover
 
 def has_docstring(defn):
     return ast.get_docstring(defn) is not None
 
-def gather_metadata(config, recorder, targets, ignores):
+def gather_metadata(config, recorder, targets, ignores, missing_only=False,
+                    metadata_cache=None):
+    """ Gather metadata for every module that matches `targets`
+        
+        With `missing_only`, modules the recorder already has metadata for
+        (because they were imported, for instance) are left alone. Modules
+        that aren't in `metadata_cache` are analyzed by a pool of
+        `config.metadata_workers` processes when there's more than one.
+    """
     finder = SourceFinder(sys.path)
-    if config.use_metadata_cache:
-        metadata_cache = FileBackedMetadataCache()
-    else:
+    if metadata_cache is None:
         metadata_cache = DummyMetadataCache()
+    found = []
+    stale = []
+    seen = set()
     for target in targets:
         for source_spec in finder.find(target, ignores):
             filepath, modulename = source_spec
-            metadata = metadata_cache.fetch(filepath)
+            if modulename in seen:
+                continue
+            seen.add(modulename)
+            if missing_only and modulename in recorder.metadata:
+                continue
+            with open(filepath, "r") as source_file:
+                source = source_file.read()
+            metadata = metadata_cache.fetch(modulename, source)
             if not metadata:
-                source = open(filepath, "r").read()
-                pragmas = PragmaFinder().find_pragmas(source)
-                metadata = MetadataGatheringVisitor.analyze(config,
-                                                            modulename,
-                                                            source,
-                                                            pragmas)
-                metadata_cache.store(filepath, metadata)
-            recorder.add_metadata(metadata)
+                stale.append((config, modulename, source))
+            found.append((modulename, source, metadata))
+    
+    analyzed = iter(analyze_modules(stale, config.metadata_workers))
+    for modulename, source, metadata in found:
+        if not metadata:
+            metadata = next(analyzed)
+            metadata_cache.store(modulename, source, metadata)
+        recorder.add_metadata(metadata)
+
+def analyze_module(args):
+    """ Gather the metadata for a module
+        
+        `args` is a (config, modulename, source) tuple so that this can be
+        mapped over a process pool.
+    """
+    config, modulename, source = args
+    return analyze_source(config, modulename, source)
+
+def analyze_modules(specs, workers=1):
+    """ Map `analyze_module` over `specs`, in parallel if `workers` > 1
+        
+        The metadata is returned in the same order as `specs`.
+    """
+    if workers <= 1 or len(specs) <= 1:
+        return [analyze_module(spec) for spec in specs]
+    pool = multiprocessing.Pool(min(workers, len(specs)))
+    try:
+        results = pool.map(analyze_module, specs)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+def analyze_source(config, modulename, source, tree=None):
+    """ Find the pragmas in a module and gather its metadata
+        
+        The source is parsed once, unless the caller passes the parsed
+        `tree`, and the same tree is used to apply the pragmas and to gather
+        the metadata. Neither step modifies it, so it can be instrumented
+        afterwards.
+    """
+    if tree is None:
+        tree = ast.parse(source)
+    pragmas = PragmaFinder().find_pragmas(source, tree)
+    return MetadataGatheringVisitor.analyze(config,
+                                            modulename,
+                                            source,
+                                            pragmas,
+                                            tree)
+
+class StatementHits(object):
+    """ Records which of a module's statements have been executed
+        
+        Each statement line is assigned a slot the first time it is added and
+        whether or not the statement was executed is stored in a bytearray
+        indexed by that slot. The object otherwise behaves like the dict of
+        line numbers to booleans that was used before so that the reporting
+        code doesn't need to know the difference.
+    """
+    
+    def __init__(self, lines=None):
+        self.slots = {}
+        self.linenos = []
+        self.hits = bytearray()
+        if lines:
+            for lineno in sorted(lines):
+                self[lineno] = lines[lineno]
+    
+    def add(self, lineno):
+        """ Return the slot for `lineno`, assigning one if necessary """
+        slot = self.slots.get(lineno)
+        if slot is None:
+            slot = len(self.linenos)
+            self.slots[lineno] = slot
+            self.linenos.append(lineno)
+            self.hits.append(0)
+        return slot
+    
+    def mark(self, lineno):
+        slot = self.slots.get(lineno)
+        if slot is not None:
+            self.hits[slot] = 1
+    
+    def copy(self):
+        lines = StatementHits()
+        lines.slots = dict(self.slots)
+        lines.linenos = list(self.linenos)
+        lines.hits = bytearray(self.hits)
+        return lines
+    
+    def merge(self, other):
+        if self.linenos == other.linenos:
+            self.hits[:] = bytearray(mine | theirs
+                                     for mine, theirs
+                                     in zip(self.hits, other.hits))
+        else:
+            for lineno in self.linenos:
+                if other[lineno]:
+                    self.hits[self.slots[lineno]] = 1
+    
+    def __setitem__(self, lineno, hit):
+        self.hits[self.add(lineno)] = 1 if hit else 0
+    
+    def __getitem__(self, lineno):
+        return bool(self.hits[self.slots[lineno]])
+    
+    def __contains__(self, lineno):
+        return lineno in self.slots
+    
+    def __iter__(self):
+        return iter(self.linenos)
+    
+    def __len__(self):
+        return len(self.linenos)
+    
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return 'StatementHits(%r)' % dict(self.items())
+    
+    def get(self, lineno, default=None):
+        if lineno in self.slots:
+            return self[lineno]
+        return default
+    
+    def keys(self):
+        return list(self.linenos)
+    
+    def values(self):
+        return [bool(hit) for hit in self.hits]
+    
+    def items(self):
+        return list(zip(self.linenos, self.values()))
+
+# Counters stop at the largest count they can hold rather than wrap around
+MAX_COUNT = 2 ** (8 * array(COUNTER_TYPECODE).itemsize) - 1
+
+def add_counts(mine, theirs):
+    """ Add the counts in `theirs` to `mine`, stopping at MAX_COUNT """
+    if len(mine) < len(theirs):
+        mine.extend([0] * (len(theirs) - len(mine)))
+    for slot, count in enumerate(theirs):
+        if count:
+            mine[slot] = min(mine[slot] + count, MAX_COUNT)
+
+class HitCounts(object):
+    """ How many times each statement and condition slot of a module was hit
+        
+        The counts are kept in arrays of unsigned 64 bit integers indexed
+        the same way as the statement hits (by statement slot) and the
+        module recorder's condition hits (by construct id and condition).
+    """
+    
+    def __init__(self, nlines=0, nconditions=0):
+        self.lines = array(COUNTER_TYPECODE, [0]) * nlines
+        self.conditions = array(COUNTER_TYPECODE, [0]) * nconditions
+    
+    def resize(self, nlines, nconditions):
+        """ Make room for slots added since the counts were made """
+        if len(self.lines) < nlines:
+            self.lines.extend([0] * (nlines - len(self.lines)))
+        if len(self.conditions) < nconditions:
+            self.conditions.extend([0] * (nconditions - len(self.conditions)))
+    
+    def copy(self):
+        counts = HitCounts()
+        counts.lines = array(COUNTER_TYPECODE, self.lines)
+        counts.conditions = array(COUNTER_TYPECODE, self.conditions)
+        return counts
+    
+    def merge(self, other):
+        add_counts(self.lines, other.lines)
+        add_counts(self.conditions, other.conditions)
+    
+    def clear(self):
+        self.lines[:] = array(COUNTER_TYPECODE, [0]) * len(self.lines)
+        self.conditions[:] = (array(COUNTER_TYPECODE, [0])
+                              * len(self.conditions))
+    
+    def any(self):
+        return any(self.lines) or any(self.conditions)
+    
+    def line_counts(self, lines):
+        """ Map the line numbers of `lines`, a StatementHits, to counts """
+        return dict((lineno, self.lines[slot])
+                    for lineno, slot in lines.slots.items()
+                    if slot < len(self.lines))
+    
+    def __eq__(self, other):
+        return (isinstance(other, HitCounts)
+                and self.lines == other.lines
+                and self.conditions == other.conditions)
+    
+    def __ne__(self, other):
+        return not self == other
+
+# Handed out to ModuleMetadata whenever it changes, so that no two states
+# of any module share a generation
+_generations = itertools.count()
 
 class ModuleMetadata(object):
     
+    # How many times each statement and condition was hit, if hits were
+    # being counted
+    counts = None
+    
     def __init__(self, modulename, source, pragmas):
         self.modulename = modulename
         self.source = source
-        self.lines = {}
+        self.lines = StatementHits()
         self.constructs = {}
+        self.construct_ids = {}
         self.pragmas = pragmas
+        self.generation = next(_generations)
+    
+    def __setstate__(self, state):
+        # Metadata pickled before statement hits were stored in a
+        # StatementHits object will have a plain dict here
+        lines = state.pop('lines', None)
+        self.__dict__.update(state)
+        if lines is not None:
+            self.lines = lines
+        if 'construct_ids' not in state:
+            self.construct_ids = dict((label, i) for i, label
+                                      in enumerate(sorted(self.constructs)))
+        # A copy is a different module as far as a store is concerned
+        self.generation = next(_generations)
+    
+    def _get_lines(self):
+        return self._lines
+    
+    def _set_lines(self, lines):
+        if not isinstance(lines, StatementHits):
+            lines = StatementHits(lines)
+        self._lines = lines
+    lines = property(_get_lines, _set_lines)
     
     def next_label(self, lineno):
         i = 1
@@ -52,15 +304,56 @@ class ModuleMetadata(object):
             i += 1
         return '%s.%s' % (lineno, i)
     
+    def add_construct(self, label, construct):
+        """ Add a construct, giving it the next dense integer id
+            
+            The id is what instrumented code uses to refer to the construct
+            when it records a result.
+        """
+        self.constructs[label] = construct
+        if label not in self.construct_ids:
+            self.construct_ids[label] = len(self.construct_ids)
+        return self.construct_ids[label]
+    
+    def changed(self):
+        """ Note that a result has been recorded here
+            
+            Anything that records a result calls this, so a store that has
+            kept what it wrote for the module can tell from `generation`
+            whether it needs to write it again.
+        """
+        self.generation = next(_generations)
+    
+    def snapshot(self):
+        """ A copy of this metadata with a copy of the results so far """
+        # Taken first, so that a result recorded while copying leaves this
+        # metadata at a later generation than the copy
+        generation = self.generation
+        snapshot = ModuleMetadata(self.modulename, self.source, self.pragmas)
+        snapshot.lines = self.lines.copy()
+        snapshot.construct_ids = dict(self.construct_ids)
+        for label, construct in list(self.constructs.items()):
+            snapshot.constructs[label] = construct.snapshot()
+        if self.counts is not None:
+            snapshot.counts = self.counts.copy()
+        snapshot.generation = generation
+        return snapshot
+    
     def merge(self, other):
         if self.modulename != other.modulename:
             raise ValueError('Cannot merge metadata for different modules')
         
-        for lineno in self.lines:
-            self.lines[lineno] = self.lines[lineno] or other.lines[lineno]
+        self.lines.merge(other.lines)
         
         for label, construct in self.constructs.items():
             self.constructs[label].merge(other.constructs[label])
+        
+        if other.counts is not None:
+            if self.counts is None:
+                self.counts = other.counts.copy()
+            else:
+                self.counts.merge(other.counts)
+        self.changed()
 
 class BooleanEvaluator(ast.NodeVisitor):
     
@@ -152,8 +445,10 @@ class BooleanEvaluator(ast.NodeVisitor):
 class MetadataGatheringVisitor(ast.NodeVisitor):
     
     @classmethod
-    def analyze(cls, config, modulename, source, pragmas):
-        module_ast = ast.parse(source)
+    def analyze(cls, config, modulename, source, pragmas, tree=None):
+        module_ast = tree
+        if module_ast is None:
+            module_ast = ast.parse(source)
         metadata = ModuleMetadata(modulename, source, pragmas)
         visitor = cls(config, metadata, pragmas)
         visitor.visit(module_ast)
@@ -214,16 +509,18 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
         return construct
     
     def visit_Module(self, module):
+        body = module.body
         if has_docstring(module):
-            module.body.pop(0)
-        self.generic_visit(module)
+            body = body[1:]
+        for stmt in body:
+            self.visit(stmt)
     
     def visit_Assert(self, assert_):
         if self.config.instrument_assertions:
             if isinstance(assert_.test, ast.BoolOp):
                 label = self.metadata.next_label(assert_.lineno)
                 construct = self._make_decision(label, assert_.test)
-                self.metadata.constructs[label] = construct
+                self.metadata.add_construct(label, construct)
                 self._context.append(construct)
             self.generic_visit(assert_)
             if isinstance(assert_.test, ast.BoolOp):
@@ -233,7 +530,7 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
         if isinstance(assign.value, ast.BoolOp):
             label = self.metadata.next_label(assign.lineno)
             construct = self._make_decision(label, assign.value)
-            self.metadata.constructs[label] = construct
+            self.metadata.add_construct(label, construct)
             self._context.append(construct)
         self.generic_visit(assign)
         if isinstance(assign.value, ast.BoolOp):
@@ -243,7 +540,7 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
     def visit_BoolOp(self, boolop):
         label = self.metadata.next_label(boolop.lineno)
         construct = self._make_boolop_construct(label, boolop)
-        self.metadata.constructs[label] = construct
+        self.metadata.add_construct(label, construct)
         self._context.append(construct)
         self.generic_visit(boolop)
         self._context.pop()
@@ -252,7 +549,7 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
         if self.config.instrument_comparisons:
             label = self.metadata.next_label(compare.lineno)
             construct = self._make_comparison(label, compare)
-            self.metadata.constructs[label] = construct
+            self.metadata.add_construct(label, construct)
             self._context.append(construct)
         self.generic_visit(compare)
         if self.config.instrument_comparisons:
@@ -265,7 +562,7 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
             self.metadata.lines[if_.lineno] = False
             label = self.metadata.next_label(if_.lineno)
             construct = self._make_decision(label, if_.test)
-            self.metadata.constructs[str(label)] = construct
+            self.metadata.add_construct(str(label), construct)
             self._context.append(construct)
             self.generic_visit(if_)
             self._context.pop()
@@ -276,7 +573,7 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
         if self.gather:
             label = self.metadata.next_label(ifexp.lineno)
             construct = self._make_decision(label, ifexp.test)
-            self.metadata.constructs[str(label)] = construct
+            self.metadata.add_construct(str(label), construct)
             self._context.append(construct)
         self.generic_visit(ifexp)
         if self.gather:
@@ -289,7 +586,7 @@ class MetadataGatheringVisitor(ast.NodeVisitor):
             self.metadata.lines[while_.lineno] = False
             label = self.metadata.next_label(while_.lineno)
             construct = self._make_decision(label, while_.test)
-            self.metadata.constructs[str(label)] = construct
+            self.metadata.add_construct(str(label), construct)
             self._context.append(construct)
             self.generic_visit(while_)
             self._context.pop()
@@ -347,65 +644,13 @@ class SourceFinder(object):
                     yield filepath
 
 
-class BaseMetadataCache(object):
-    
-    def initialize(self):
-        self._init_storage()
-    
-    def store(self, filepath, meta):
-        now = util.now()
-        record = {'timestamp': now,
-                  'metadata': meta}
-        self._store(filepath, record)
-    
-    def fetch(self, filepath):
-        file_mtime = os.stat(filepath).st_mtime
-        cached_record = self._fetch(filepath)
-        if not cached_record:
-            return
-        timestamp = time.mktime(cached_record['timestamp'].timetuple())
-        if file_mtime < timestamp:
-            return cached_record['metadata']
-
-class DummyMetadataCache(BaseMetadataCache):
-    
-    def _init_storage(self):
-        pass
+class DummyMetadataCache(object):
     
-    def _store(self, filepath, record):
-        pass
-    
-    def _fetch(self, filepath):
+    def fetch(self, modulename, source):
         return None
-
-class FileBackedMetadataCache(BaseMetadataCache):
     
-    def __init__(self):
-        super(FileBackedMetadataCache, self).__init__()
-        self._working_directory = os.path.join(os.getcwd(), '.instrumental.cache')
-        
-    def _init_storage(self):
-        if not os.path.exists(self._working_directory):
-            os.mkdir(self._working_directory)
-    
-    def _store(self, filepath, record):
-        if filepath.startswith('/'):
-            filepath = filepath[1:]
-        cache_file_path = os.path.join(self._working_directory, filepath)
-        if not os.path.exists(os.path.dirname(cache_file_path)):
-            os.makedirs(os.path.dirname(cache_file_path))
-        with open(cache_file_path, 'wb') as cache_file:
-            pickle.dump(record, cache_file)
-    
-    def _fetch(self, filepath):
-        if filepath.startswith('/'):
-            filepath = filepath[1:]
-        cache_file_path = os.path.join(self._working_directory, filepath)
-        if not os.path.exists(cache_file_path):
-            return None
-        with open(cache_file_path, 'rb') as cache_file:
-            record = pickle.load(cache_file)
-        return record
+    def store(self, modulename, source, metadata):
+        pass
 
 
 if __name__ == '__main__': # pragma: no cover
@@ -0,0 +1,214 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Statement and decision coverage using sys.monitoring (PEP 669)
+    
+    On Python 3.12 and later the interpreter can report LINE and BRANCH
+    events for selected code objects. A callback that returns DISABLE switches
+    off the event for that location, so a line costs something only the first
+    time it is executed and a branch only until both of its outcomes have
+    been seen.
+"""
+import dis
+import logging
+import sys
+
+log = logging.getLogger(__name__)
+
+# Conditional jumps whose outcome tells us the value of the test. The value
+# is the truth of the test when the jump is taken.
+BRANCH_JUMPS = {'POP_JUMP_IF_FALSE': False,
+                'POP_JUMP_IF_TRUE': True,
+                }
+
+def available():
+    """ Is sys.monitoring supported by the running interpreter? """
+    return hasattr(sys, 'monitoring')
+
+def iter_code(code):
+    """ Yield a code object and all of the code objects nested in it """
+    stack = [code]
+    while stack:
+        code = stack.pop()
+        yield code
+        stack.extend(const for const in code.co_consts
+                     if isinstance(const, type(code)))
+
+def node_span(node):
+    """ The source span of an AST node as the interpreter reports it """
+    return (node.lineno, node.end_lineno, node.col_offset, node.end_col_offset)
+
+def find_jumps(code):
+    """ Find the conditional jumps in `code` (and its nested code)
+        
+        Returns a dict mapping the source span of each jump to a list of
+        (code, instruction) pairs.
+    """
+    jumps = {}
+    for code in iter_code(code):
+        for instruction in dis.get_instructions(code):
+            if instruction.opname.startswith('POP_JUMP_'):
+                span = tuple(instruction.positions)
+                jumps.setdefault(span, []).append((code, instruction))
+    return jumps
+
+def is_branch(jumps):
+    """ Can the outcome of a test be read from this list of jumps? """
+    return bool(jumps) and all(instruction.opname in BRANCH_JUMPS
+                               for _, instruction in jumps)
+
+class ExecutionMonitor(object):
+    """ Records statements and decisions from sys.monitoring events
+        
+        Instrumented modules register their code objects when they are
+        executed (see ExecutionRecorder.monitor_module). Each LINE event for
+        a line with a statement slot marks that slot in the module's
+        statement hits. Each BRANCH event for a decision's test is recorded
+        as that decision's result.
+    """
+    
+    TOOL_NAME = 'instrumental'
+    
+    @classmethod
+    def create(cls, recorder, statements=True, decisions=False):
+        """ Start a monitor, or return None if sys.monitoring can't be used
+            
+            When None is returned the caller should fall back to statement
+            markers and decision probes.
+        """
+        if not available():
+            log.debug('sys.monitoring is not available; using statement'
+                      ' markers and decision probes')
+            return None
+        monitor = cls(recorder, statements, decisions)
+        try:
+            monitor.start()
+        except ValueError:
+            log.warning('The sys.monitoring coverage tool id is in use by %r;'
+                        ' using statement markers and decision probes',
+                        sys.monitoring.get_tool(sys.monitoring.COVERAGE_ID))
+            return None
+        return monitor
+    
+    def __init__(self, recorder, statements=True, decisions=False):
+        self.recorder = recorder
+        self.statements = statements
+        self.decisions = decisions
+        self.tool_id = sys.monitoring.COVERAGE_ID
+        self._lines = {}
+        self._branches = {}
+        self._events = 0
+        self.started = False
+    
+    def _callbacks(self):
+        events = sys.monitoring.events
+        callbacks = []
+        if self.statements:
+            callbacks.append((events.LINE, self._line))
+        if self.decisions:
+            callbacks.append((events.BRANCH, self._branch))
+        return callbacks
+    
+    def start(self):
+        monitoring = sys.monitoring
+        monitoring.use_tool_id(self.tool_id, self.TOOL_NAME)
+        for event, callback in self._callbacks():
+            monitoring.register_callback(self.tool_id, event, callback)
+            self._events |= event
+        self.restart()
+        self.started = True
+    
+    def restart(self):
+        """ Re-enable the events disabled since the monitor started
+            
+            Locations disabled during an earlier run, or before the current
+            tag was set, need to report again.
+        """
+        sys.monitoring.restart_events()
+    
+    def stop(self):
+        if not self.started:
+            return
+        monitoring = sys.monitoring
+        for code in self._lines:
+            monitoring.set_local_events(self.tool_id, code, 0)
+        for event, _ in self._callbacks():
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+        self._lines.clear()
+        self._branches.clear()
+        self._events = 0
+        self.started = False
+    
+    def add_code(self, code, lines, module_recorder=None, decisions=()):
+        """ Monitor `code`, and the code nested in it
+            
+            `lines` is the module's StatementHits. `decisions` is a sequence
+            of (construct id, source span) pairs for the decisions whose
+            results should be taken from BRANCH events. They're recorded
+            through `module_recorder`, which is also told about new
+            statement hits.
+        """
+        if self.decisions and decisions:
+            jumps = find_jumps(code)
+            for cid, span in decisions:
+                for jump_code, instruction in jumps.get(tuple(span), []):
+                    self._branches[(jump_code, instruction.offset)] = (
+                        module_recorder,
+                        cid,
+                        instruction.argval,
+                        BRANCH_JUMPS[instruction.opname])
+        for code in iter_code(code):
+            self._lines[code] = (lines, module_recorder)
+            sys.monitoring.set_local_events(self.tool_id, code, self._events)
+    
+    def _line(self, code, lineno):
+        try:
+            lines, module_recorder = self._lines[code]
+        except KeyError:
+            return sys.monitoring.DISABLE
+        slot = lines.slots.get(lineno)
+        if slot is None:
+            return sys.monitoring.DISABLE
+        if not self.recorder.recording:
+            # Leave the event enabled so that the line is recorded if it
+            # runs again once recording has started
+            return None
+        lines.hits[slot] = 1
+        if module_recorder is not None:
+            module_recorder.metadata.changed()
+        return sys.monitoring.DISABLE
+    
+    def _branch(self, code, offset, destination):
+        branch = self._branches.get((code, offset))
+        if branch is None:
+            return sys.monitoring.DISABLE
+        if not self.recorder.recording:
+            return None
+        module_recorder, cid, target, taken_value = branch
+        if destination == target:
+            module_recorder.record_decision(taken_value, cid)
+        else:
+            module_recorder.record_decision(not taken_value, cid)
+        # Once both outcomes are in there's nothing left to learn from this
+        # jump, unless results are being tagged. Disabling the jump would
+        # disable it for every thread, so any tag anywhere keeps it enabled.
+        if not self.recorder.tagging:
+            slot = module_recorder.slots[cid]
+            if module_recorder.hits[slot] and module_recorder.hits[slot + 1]:
+                return sys.monitoring.DISABLE
+        return None
@@ -23,8 +23,6 @@ import sys
 
 log = logging.getLogger(__name__)
 
-from astkit import ast
-
 from instrumental.compat import exec_f
 
 _imp_load_module = imp.load_module
@@ -52,10 +50,7 @@ def load_module_factory(targets, ignores, visitor_factory):
                 source = open(os.path.join(pathname, '__init__.py'), 'r').read()
             else:
                 source = fh.read()
-            visitor = visitor_factory.create(name, source)
-            code_tree = ast.parse(source)
-            new_code_tree = visitor.visit(code_tree)
-            code = compile(new_code_tree, pathname, 'exec')
+            code = visitor_factory.get_code(name, source, pathname)
             mod = sys.modules.setdefault(name, imp.new_module(name))
             if ispkg:
                 mod.__file__ = os.path.join(pathname, '__init__.py')
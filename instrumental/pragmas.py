@@ -97,15 +97,18 @@ class PragmaApplier(ast.NodeVisitor):
         
     """
     
-    def __init__(self, pragmas, source):
+    def __init__(self, pragmas, source, tree=None):
         self._base_pragmas = pragmas.copy()
         self._source = source
+        self._tree = tree
         self._statement_end_linenos = []
     
     def apply(self):
         self._pragmas = self._base_pragmas.copy()
         
-        node = ast.parse(self._source)
+        node = self._tree
+        if node is None:
+            node = ast.parse(self._source)
         
         # fix the else cases
         self.visit(node)
@@ -117,13 +120,9 @@ class PragmaApplier(ast.NodeVisitor):
                 if pragma.block]
     
     def _block_pragmas_for_range(self, start, end):
-        line_range = range(start, end)
-        pragma_lines = [lineno for lineno in self._pragmas
-                        if self._block_pragmas(self._pragmas[lineno])]
         pragmas = set()
-        for lineno in line_range:
-            if lineno in pragma_lines:
-                pragmas.update(self._block_pragmas(self._pragmas[lineno]))
+        for lineno in range(start, end):
+            pragmas.update(self._block_pragmas(self._pragmas.get(lineno, ())))
         return pragmas
     
     def _add_pragmas_to_body(self, pragmas, body):
@@ -181,7 +180,12 @@ class PragmaFinder(object):
     def __init__(self):
         pass
     
-    def find_pragmas(self, source):
+    def find_pragmas(self, source, tree=None):
+        """ Find the pragmas in `source`
+            
+            `tree` is the parsed source, if the caller already has it. It
+            isn't modified.
+        """
         pragmas = {}
         lines = source.splitlines()
         for lineno in range(1, len(lines)+1):
@@ -202,7 +206,7 @@ class PragmaFinder(object):
                                 selected_lineno = int(selector_lineno)
                         pragmas[selected_lineno].add(pragma(pragma_match))
         
-        applier = PragmaApplier(pragmas, source)
+        applier = PragmaApplier(pragmas, source, tree)
         pragmas = applier.apply()
         
         return pragmas
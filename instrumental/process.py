@@ -0,0 +1,240 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Record the coverage of the processes a program starts
+    
+    A process forked from an instrumented program inherits its recorder but
+    not the threads that journal or snapshot its results, and left alone it
+    would save over its parent's coverage file, if it saved at all. A
+    process that starts a new interpreter (subprocess, or multiprocessing's
+    spawn and forkserver start methods) isn't instrumented at all.
+    
+    ChildProcesses fixes both. Forked children get a store of their own
+    and fresh threads from fork hooks. New interpreters find the run's
+    configuration in an environment variable and a sitecustomize module on
+    PYTHONPATH that starts coverage from it. Each child saves to a file
+    labeled with the process that started the run and its own pid, and the
+    process that started the run adds their results to its own when it
+    saves.
+"""
+import atexit
+import json
+import logging
+import multiprocessing.util
+import os
+import shutil
+import tempfile
+
+from instrumental.storage import ResultStore
+
+log = logging.getLogger(__name__)
+
+ENVIRONMENT_VARIABLE = 'INSTRUMENTAL_SUBPROCESS'
+
+SHIM = '''\
+# Written by instrumental so that this process records its coverage as part
+# of the run that started it (see instrumental.process)
+import os
+import sys
+
+def _instrumental_bootstrap():
+    this = sys.modules[__name__]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    # Run the sitecustomize module that this one hides, if there is one
+    sys.path[:] = [path for path in sys.path
+                   if os.path.abspath(path or os.curdir) != directory]
+    del sys.modules[__name__]
+    try:
+        import sitecustomize
+    except ImportError:
+        sys.modules[__name__] = this
+    if os.environ.get(%(variable)r):
+        if %(path)r not in sys.path:
+            sys.path.append(%(path)r)
+        from instrumental.process import bootstrap
+        bootstrap()
+
+_instrumental_bootstrap()
+'''
+
+# The ChildProcesses whose coverage a fork should carry on. Fork hooks can't
+# be removed once they're registered, so they're registered once and look
+# here.
+_current = None
+_hooks_registered = False
+
+def _after_fork():
+    if _current is not None:
+        _current.after_fork()
+
+def _after_multiprocessing_fork(children):
+    children.after_fork()
+    # multiprocessing leaves its children through os._exit once their
+    # finalizers have run, so atexit would never save their results
+    multiprocessing.util.Finalize(None, children.coverage.finish,
+                                  exitpriority=0)
+
+def _register_hooks():
+    global _hooks_registered
+    if _hooks_registered:
+        return
+    register_at_fork = getattr(os, 'register_at_fork', None)
+    if register_at_fork is not None:
+        register_at_fork(after_in_child=_after_fork)
+    _hooks_registered = True
+
+def child_label(run_label):
+    """ The label of this process's store in the run `run_label` """
+    return '%s.p%s' % (run_label, os.getpid())
+
+def encode_config(config):
+    """ Encode the options in `config` for the environment variable """
+    from instrumental.run import parser
+    return dict((option.dest, getattr(config, option.dest))
+                for option in parser.option_list
+                if option.dest and hasattr(config, option.dest))
+
+def decode_config(encoded):
+    from instrumental.run import parser
+    config = parser.get_default_values()
+    config.__dict__.update(encoded)
+    return config
+
+class ChildProcesses(object):
+    """ Makes the processes started under `coverage` record coverage too
+        
+        `run_label` identifies the run. It's the label of the process that
+        started the run (the root), which every process in the run shares.
+    """
+    
+    def __init__(self, coverage, config, basedir, run_label, root=True):
+        self.coverage = coverage
+        self.config = config
+        self.basedir = basedir
+        self.run_label = run_label
+        self.root = root
+        self.pid = os.getpid()
+        self._shim_directory = None
+        self._environment = None
+    
+    @property
+    def in_child(self):
+        return not self.root or os.getpid() != self.pid
+    
+    def start(self, targets, ignores):
+        global _current
+        _current = self
+        _register_hooks()
+        multiprocessing.util.register_after_fork(self,
+                                                 _after_multiprocessing_fork)
+        if self.root:
+            self._set_environment(targets, ignores)
+    
+    def _set_environment(self, targets, ignores):
+        self._shim_directory = tempfile.mkdtemp(prefix='instrumental-')
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.path.join(self._shim_directory,
+                               'sitecustomize.py'), 'w') as f:
+            f.write(SHIM % {'variable': ENVIRONMENT_VARIABLE,
+                            'path': package})
+        self._environment = dict((name, os.environ.get(name))
+                                 for name in [ENVIRONMENT_VARIABLE,
+                                              'PYTHONPATH'])
+        os.environ[ENVIRONMENT_VARIABLE] = json.dumps(
+            {'config': encode_config(self.config),
+             'basedir': os.path.abspath(self.basedir),
+             'targets': list(targets),
+             'ignores': list(ignores),
+             'run': self.run_label})
+        pythonpath = self._environment['PYTHONPATH']
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            [self._shim_directory] + ([pythonpath] if pythonpath else []))
+    
+    def after_fork(self):
+        """ Carry on recording in a forked child, as a child """
+        if os.getpid() == self.pid:
+            return
+        self.pid = os.getpid()
+        self.root = False
+        # The shim directory and environment belong to the root process
+        self._shim_directory = None
+        self._environment = None
+        self.coverage._after_fork()
+    
+    def stop(self):
+        global _current
+        if _current is self:
+            _current = None
+        if self._environment is not None and not self.in_child:
+            for name, value in self._environment.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            self._environment = None
+        if self._shim_directory is not None and not self.in_child:
+            shutil.rmtree(self._shim_directory, ignore_errors=True)
+            self._shim_directory = None
+    
+    def child_stores(self):
+        """ The stores the children of this run have saved to so far
+            
+            A child that died with only a journal still has a store.
+        """
+        run_filename = ResultStore(self.basedir, self.run_label).filename
+        prefix = os.path.basename(run_filename)[:-len('cov')] + 'p'
+        names = set()
+        for name in os.listdir(self.basedir or os.curdir):
+            if name.startswith(prefix) and '.cov' in name:
+                names.add(name[:name.index('.cov') + len('.cov')])
+        return [ResultStore(self.basedir, None, name)
+                for name in sorted(names)]
+    
+    def combine(self, store, recorder):
+        """ Add the results of the children to `recorder` and save it
+            
+            The children's files are removed once their results are in
+            `recorder`, so that saving `recorder` again keeps them.
+        """
+        children = self.child_stores()
+        if not children:
+            return
+        for child in children:
+            recorder.merge(child.load())
+        store.save(recorder)
+        for child in children:
+            if os.path.exists(child.filename):
+                os.remove(child.filename)
+            child.clear_journals()
+
+def bootstrap():
+    """ Start coverage in a new interpreter, as a child of the run
+        
+        This is called by the sitecustomize shim when the environment
+        variable is set. The results are saved when the interpreter exits.
+    """
+    from instrumental.api import Coverage
+    try:
+        run = json.loads(os.environ[ENVIRONMENT_VARIABLE])
+        config = decode_config(run['config'])
+        coverage = Coverage(config, run['basedir'])
+        coverage.start_child(run['run'], run['targets'], run['ignores'])
+    except Exception:
+        log.warning('Could not start recording the coverage of this process',
+                    exc_info=True)
+        return
+    atexit.register(coverage.finish)
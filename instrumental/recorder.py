@@ -19,24 +19,337 @@ from copy import copy
 from copy import deepcopy
 import inspect
 import sys
+import threading
 
 from astkit import ast
 
+from instrumental.compat import ContextVar
+from instrumental.metadata import HitCounts
 from instrumental.pragmas import PragmaFinder
 
 def __setup_recorder(): # pragma: no cover
     from instrumental.recorder import ExecutionRecorder
-    _xxx_recorder_xxx_ = ExecutionRecorder.get()
+    _xxx_recorder_xxx_ = ExecutionRecorder.get().module_recorder(modulename)
 
-def get_setup():
-    source = inspect.getsource(__setup_recorder)
+def __setup_statement_hits(): # pragma: no cover
+    _xxx_lines_xxx_ = _xxx_recorder_xxx_.lines
+
+def __setup_monitor(): # pragma: no cover
+    ExecutionRecorder.get().monitor_module(modulename, decisions)
+
+def _get_function_body(func):
+    source = inspect.getsource(func)
     mod = ast.parse(source)
     defn = mod.body[0]
-    setup = defn.body[:]
-    for stmt in setup:
+    body = defn.body[:]
+    for stmt in body:
         stmt.lineno -= 1
+    return body
+
+def _set_modulename(call, modulename):
+    name_arg = call.args[0]
+    call.args[0] = ast.copy_location(ast.Str(s=modulename), name_arg)
+
+def get_setup(modulename, disarm_statements=False, monitor=False,
+              decisions=()):
+    """ Get the statements that set up recording in an instrumented module
+        
+        If `monitor` is set the module registers its code with the
+        recorder's monitor, which takes the results of `decisions`, a
+        sequence of (construct id, source span) pairs, from branch events.
+    """
+    setup = _get_function_body(__setup_recorder)
+    _set_modulename(setup[-1].value, modulename)
+    if monitor:
+        monitor_setup = _get_function_body(__setup_monitor)
+        _set_modulename(monitor_setup[-1].value, modulename)
+        decisions_arg = monitor_setup[-1].value.args[1]
+        monitor_setup[-1].value.args[1] = ast.copy_location(
+            ast.parse(repr(tuple(decisions)), mode='eval').body,
+            decisions_arg)
+        setup.extend(monitor_setup)
+    if disarm_statements:
+        setup.extend(_get_function_body(__setup_statement_hits))
     return setup
 
+class ModuleRecorder(object):
+    """ Records execution results for the constructs in a single module
+        
+        Instrumented modules bind one of these to _xxx_recorder_xxx_ when
+        they are executed. Probes refer to constructs by the integer ids
+        assigned while gathering metadata and to statements by their slots,
+        so recording a result is a matter of indexing into flat tables.
+        
+        The first time a condition is seen with the default tag it's noted
+        in a bytearray with one slot per construct condition. Seeing the
+        same condition again costs only a check of that slot. The current
+        tag is only looked up once some code has set one. Anything recorded
+        for the first time moves the module's metadata to a new generation
+        (see ModuleMetadata.changed).
+    """
+    
+    def __init__(self, recorder, metadata):
+        self.recorder = recorder
+        self.metadata = metadata
+        self.lines = metadata.lines.hits
+        self.constructs = [None] * len(metadata.construct_ids)
+        for label, cid in metadata.construct_ids.items():
+            self.constructs[cid] = metadata.constructs.get(label)
+        self.slots = []
+        nslots = 0
+        for construct in self.constructs:
+            self.slots.append(nslots)
+            if construct is not None:
+                nslots += len(construct.conditions)
+        self.hits = bytearray(nslots)
+        if recorder.shared is not None:
+            self.hits = recorder.shared.condition_hits(metadata, self.hits)
+    
+    def record_pin(self, value, cid, pin):
+        """ Record the value of one input (pin) to a logical and/or """
+        recorder = self.recorder
+        if recorder.recording:
+            construct = self.constructs[cid]
+            condition = construct.condition_for(value, pin)
+            if condition is not None:
+                tag = recorder._tag.get() if recorder.tagging else None
+                if tag is None:
+                    slot = self.slots[cid] + condition
+                    if not self.hits[slot]:
+                        self.hits[slot] = 1
+                        construct.conditions[condition].add(recorder.DEFAULT_TAG)
+                        self.metadata.changed()
+                else:
+                    results = construct.conditions[condition]
+                    if tag not in results:
+                        results.add(tag)
+                        self.metadata.changed()
+        return value
+    
+    def record_decision(self, value, cid):
+        """ Record the result of a decision or comparison """
+        recorder = self.recorder
+        if recorder.recording:
+            condition = bool(value)
+            tag = recorder._tag.get() if recorder.tagging else None
+            if tag is None:
+                slot = self.slots[cid] + condition
+                if not self.hits[slot]:
+                    self.hits[slot] = 1
+                    self.constructs[cid].conditions[condition].add(recorder.DEFAULT_TAG)
+                    self.metadata.changed()
+            else:
+                results = self.constructs[cid].conditions[condition]
+                if tag not in results:
+                    results.add(tag)
+                    self.metadata.changed()
+        return value
+    
+    def record_statement(self, slot):
+        if self.recorder.recording and not self.lines[slot]:
+            self.lines[slot] = 1
+            self.metadata.changed()
+
+class HitCountModuleRecorder(ModuleRecorder):
+    """ A module recorder that also counts every statement and condition hit
+        
+        The counts go into the module's HitCounts. A counter that reaches
+        the largest count it can hold stays there. Since every hit changes
+        a count, every hit moves the metadata to a new generation.
+    """
+    
+    def __init__(self, recorder, metadata):
+        super(HitCountModuleRecorder, self).__init__(recorder, metadata)
+        if metadata.counts is None:
+            metadata.counts = HitCounts()
+        metadata.counts.resize(len(self.lines), len(self.hits))
+        self.line_counts = metadata.counts.lines
+        self.condition_counts = metadata.counts.conditions
+    
+    def record_pin(self, value, cid, pin):
+        """ Record the value of one input (pin) to a logical and/or """
+        recorder = self.recorder
+        if recorder.recording:
+            construct = self.constructs[cid]
+            condition = construct.condition_for(value, pin)
+            if condition is not None:
+                slot = self.slots[cid] + condition
+                try:
+                    self.condition_counts[slot] += 1
+                except OverflowError:
+                    pass
+                tag = recorder._tag.get() if recorder.tagging else None
+                if tag is None:
+                    if not self.hits[slot]:
+                        self.hits[slot] = 1
+                        construct.conditions[condition].add(recorder.DEFAULT_TAG)
+                else:
+                    construct.conditions[condition].add(tag)
+                self.metadata.changed()
+        return value
+    
+    def record_decision(self, value, cid):
+        """ Record the result of a decision or comparison """
+        recorder = self.recorder
+        if recorder.recording:
+            condition = bool(value)
+            slot = self.slots[cid] + condition
+            try:
+                self.condition_counts[slot] += 1
+            except OverflowError:
+                pass
+            tag = recorder._tag.get() if recorder.tagging else None
+            if tag is None:
+                if not self.hits[slot]:
+                    self.hits[slot] = 1
+                    self.constructs[cid].conditions[condition].add(recorder.DEFAULT_TAG)
+            else:
+                self.constructs[cid].conditions[condition].add(tag)
+            self.metadata.changed()
+        return value
+    
+    def record_statement(self, slot):
+        if self.recorder.recording:
+            self.lines[slot] = 1
+            try:
+                self.line_counts[slot] += 1
+            except OverflowError:
+                pass
+            self.metadata.changed()
+
+class ThreadShard(object):
+    """ What one thread has recorded for one module
+        
+        Tagged results are appended to a list the first time the thread sees
+        them, so that merging can read the new ones while the thread keeps
+        recording.
+    """
+    
+    def __init__(self, nlines, nslots):
+        self.thread = threading.current_thread()
+        self.lines = bytearray(nlines)
+        self.hits = bytearray(nslots)
+        self.seen = set()
+        self.tagged = []
+        self.merged = 0
+
+class ShardedModuleRecorder(ModuleRecorder):
+    """ A module recorder that gives each thread a shard of its own
+        
+        Probes only write to the calling thread's shard, so threads never
+        share what they write to and no lock is taken while recording. This
+        matters on free-threaded builds of Python, where nothing serializes
+        the updates to shared results. The shards are or'ed into the
+        module's results by `merge`, which is called when the results are
+        saved or copied.
+    """
+    
+    def __init__(self, recorder, metadata):
+        super(ShardedModuleRecorder, self).__init__(recorder, metadata)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        # Held for the whole of a merge, so that merges from the journal, a
+        # snapshot and saving don't interleave
+        self._merge_lock = threading.Lock()
+        # The construct and condition of each slot
+        self._conditions = [(construct, condition)
+                            for construct in self.constructs
+                            if construct is not None
+                            for condition in range(len(construct.conditions))]
+    
+    def _new_shard(self):
+        shard = ThreadShard(len(self.lines), len(self.hits))
+        self._local.shard = shard
+        with self._shards_lock:
+            self._shards.append(shard)
+        return shard
+    
+    def record_pin(self, value, cid, pin):
+        """ Record the value of one input (pin) to a logical and/or """
+        recorder = self.recorder
+        if recorder.recording:
+            condition = self.constructs[cid].condition_for(value, pin)
+            if condition is not None:
+                try:
+                    shard = self._local.shard
+                except AttributeError:
+                    shard = self._new_shard()
+                tag = recorder._tag.get() if recorder.tagging else None
+                slot = self.slots[cid] + condition
+                if tag is None:
+                    shard.hits[slot] = 1
+                elif (slot, tag) not in shard.seen:
+                    shard.seen.add((slot, tag))
+                    shard.tagged.append((slot, tag))
+        return value
+    
+    def record_decision(self, value, cid):
+        """ Record the result of a decision or comparison """
+        recorder = self.recorder
+        if recorder.recording:
+            try:
+                shard = self._local.shard
+            except AttributeError:
+                shard = self._new_shard()
+            tag = recorder._tag.get() if recorder.tagging else None
+            slot = self.slots[cid] + bool(value)
+            if tag is None:
+                shard.hits[slot] = 1
+            elif (slot, tag) not in shard.seen:
+                shard.seen.add((slot, tag))
+                shard.tagged.append((slot, tag))
+        return value
+    
+    def record_statement(self, slot):
+        if self.recorder.recording:
+            try:
+                shard = self._local.shard
+            except AttributeError:
+                shard = self._new_shard()
+            shard.lines[slot] = 1
+    
+    def merge(self):
+        """ Or the results in the threads' shards into the module's """
+        with self._merge_lock:
+            self._merge()
+    
+    def _merge(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        lines = self.lines
+        hits = self.hits
+        default_tag = self.recorder.DEFAULT_TAG
+        changed = False
+        finished = []
+        for shard in shards:
+            # A thread that has finished won't record any more, so its
+            # shard can go once it has been merged
+            if not shard.thread.is_alive():
+                finished.append(shard)
+            for slot, hit in enumerate(shard.lines):
+                if hit and not lines[slot]:
+                    lines[slot] = 1
+                    changed = True
+            for slot, hit in enumerate(shard.hits):
+                if hit and not hits[slot]:
+                    hits[slot] = 1
+                    construct, condition = self._conditions[slot]
+                    construct.conditions[condition].add(default_tag)
+                    changed = True
+            end = len(shard.tagged)
+            for slot, tag in shard.tagged[shard.merged:end]:
+                construct, condition = self._conditions[slot]
+                construct.conditions[condition].add(tag)
+                changed = True
+            shard.merged = end
+        if changed:
+            self.metadata.changed()
+        if finished:
+            with self._shards_lock:
+                self._shards = [shard for shard in self._shards
+                                if shard not in finished]
+
 class ExecutionRecorder(object):
     DEFAULT_TAG = 'X'
     
@@ -54,8 +367,40 @@ class ExecutionRecorder(object):
     def __init__(self):
         self.metadata = {}
         self.recording = False
-        self.tag = None
-        self._tagging = False
+        # Each recorder has its own variable so that a tag set on one
+        # doesn't leak into another recorder running in the same context
+        self._tag = ContextVar('instrumental_tag_%x' % id(self), default=None)
+        self.tagging = False
+        self._module_recorders = {}
+        self.monitor = None
+        self.shared = None
+        self.sharded = False
+        self.counting = False
+    
+    @property
+    def tag(self):
+        """ The tag for results recorded in the current thread or task """
+        return self._tag.get()
+    
+    @tag.setter
+    def tag(self, tag):
+        self.set_tag(tag)
+    
+    def set_tag(self, tag):
+        """ Tag the results recorded in the current thread or task
+            
+            The tag is kept in a context variable, so other threads and
+            asyncio tasks keep their own tags. Returns a token that
+            `reset_tag` takes to restore the previous tag.
+        """
+        if tag is not None:
+            # Once set this stays on, since other contexts may still have
+            # a tag. Probes check it before looking the tag up.
+            self.tagging = True
+        return self._tag.set(tag)
+    
+    def reset_tag(self, token):
+        self._tag.reset(token)
     
     def start(self):
         self.recording = True
@@ -66,31 +411,92 @@ class ExecutionRecorder(object):
     def add_metadata(self, metadata):
         self.metadata[metadata.modulename] = metadata
     
+    def snapshot(self):
+        """ Copy the results recorded so far into a new recorder
+            
+            Only the results are copied, so this is cheap enough to do
+            while the program is running. The copy can then be saved in
+            another thread.
+        """
+        self.merge_shards()
+        if self.shared is not None:
+            # Take in what the other processes have recorded
+            self.shared.merge()
+        snapshot = ExecutionRecorder()
+        for metadata in list(self.metadata.values()):
+            snapshot.add_metadata(metadata.snapshot())
+        return snapshot
+    
+    def module_recorder(self, modulename):
+        """ Return the recorder used by instrumented code in `modulename`
+            
+            If `counting` is set every hit is also counted (see
+            HitCountModuleRecorder). Otherwise, if `sharded` is set each
+            thread records into a shard of its own (see
+            ShardedModuleRecorder).
+        """
+        metadata = self.metadata[modulename]
+        module_recorder = self._module_recorders.get(modulename)
+        if (module_recorder is None
+            or module_recorder.metadata is not metadata
+            or len(module_recorder.constructs) != len(metadata.construct_ids)):
+            if self.counting:
+                module_recorder = HitCountModuleRecorder(self, metadata)
+            elif self.sharded:
+                module_recorder = ShardedModuleRecorder(self, metadata)
+            else:
+                module_recorder = ModuleRecorder(self, metadata)
+            self._module_recorders[modulename] = module_recorder
+        return module_recorder
+    
+    def clear_counts(self):
+        """ Start the hit counts from zero, as a forked child does """
+        for metadata in list(self.metadata.values()):
+            if metadata.counts is not None:
+                metadata.counts.clear()
+    
+    def merge_shards(self):
+        """ Bring the results in the threads' shards into the metadata """
+        if self.sharded:
+            for module_recorder in list(self._module_recorders.values()):
+                if isinstance(module_recorder, ShardedModuleRecorder):
+                    module_recorder.merge()
+    
+    def monitor_module(self, modulename, decisions=()):
+        """ Have the monitor watch the calling module's code
+            
+            This is called from the setup code of an instrumented module, so
+            the caller's frame is executing the module's code object.
+        """
+        if self.monitor is not None:
+            code = sys._getframe(1).f_code
+            self.monitor.add_code(code,
+                                  self.metadata[modulename].lines,
+                                  self.module_recorder(modulename),
+                                  decisions)
+    
+    def _construct_id(self, modulename, label, node):
+        cid = self.metadata[modulename].construct_ids.get(label)
+        if cid is not None:
+            return ast.Num(n=cid, lineno=node.lineno, col_offset=node.col_offset)
+    
     @staticmethod
-    def get_recorder_call():
+    def get_recorder_call(method):
         kall = ast.Call()
         kall.func = ast.Attribute(value=ast.Name(id="_xxx_recorder_xxx_",
                                                  ctx=ast.Load()),
-                                  attr="record",
+                                  attr=method,
                                   ctx=ast.Load())
         kall.keywords = []
         return kall
     
-    def record(self, arg, modulename, label, *args, **kwargs):
-        if self.recording and label in self.metadata[modulename].constructs:
-            kwargs['tag'] = (self.tag 
-                             if self.tag is not None 
-                             else self.DEFAULT_TAG)
-            self.metadata[modulename].constructs[label].record(arg, 
-                                                               *args, **kwargs)
-        return arg
-    
     def add_BoolOp(self, modulename, label, node, pragmas, parent):
+        cid = self._construct_id(modulename, label, node)
+        if cid is None:
+            return node
         # Now wrap the individual values in recorder calls
-        base_call = self.get_recorder_call()
-        base_call.args = \
-            [ast.Str(s=modulename, lineno=node.lineno, col_offset=node.col_offset),
-             ast.Str(s=label, lineno=node.lineno, col_offset=node.col_offset)]
+        base_call = self.get_recorder_call('record_pin')
+        base_call.args = [cid]
         for i, value in enumerate(node.values):
             recorder_call = deepcopy(base_call)
             recorder_call.args.insert(0, node.values[i])
@@ -100,45 +506,62 @@ class ExecutionRecorder(object):
         return node
     
     def add_test(self, modulename, label, node):
-        base_call = ast.copy_location(self.get_recorder_call(),
+        cid = self._construct_id(modulename, label, node)
+        if cid is None:
+            return node
+        base_call = ast.copy_location(self.get_recorder_call('record_decision'),
                                       node)
-        base_call.args = \
-            [node,
-             ast.Str(s=modulename, lineno=node.lineno, col_offset=node.col_offset),
-             ast.Str(s=label, lineno=node.lineno, col_offset=node.col_offset)]
+        base_call.args = [node, cid]
         ast.fix_missing_locations(base_call)
         return base_call
     
     def add_comparison(self, modulename, label, node):
-        base_call = ast.copy_location(self.get_recorder_call(),
+        cid = self._construct_id(modulename, label, node)
+        if cid is None:
+            return node
+        base_call = ast.copy_location(self.get_recorder_call('record_decision'),
                                       node)
-        base_call.args = \
-            [node,
-             ast.Str(s=modulename, lineno=node.lineno, col_offset=node.col_offset),
-             ast.Str(s=label, lineno=node.lineno, col_offset=node.col_offset)]
+        base_call.args = [node, cid]
         ast.fix_missing_locations(base_call)
         return base_call
     
     @staticmethod
-    def get_statement_recorder_call(modulename, lineno):
+    def get_statement_recorder_call(slot):
         kall = ast.Call()
         kall.func = ast.Attribute(value=ast.Name(id="_xxx_recorder_xxx_",
                                                  ctx=ast.Load()),
                                   attr="record_statement",
                                   ctx=ast.Load())
-        kall.args = [ast.Str(s=modulename),
-                     ast.Num(n=lineno),
-                     ]
+        kall.args = [ast.Num(n=slot)]
         kall.keywords = []
         kall_stmt = ast.Expr(value=kall)
         return kall_stmt
     
-    def record_statement(self, modulename, lineno):
-        if self.recording and lineno in self.metadata[modulename].lines:
-            self.metadata[modulename].lines[lineno] = True
+    @classmethod
+    def get_disarming_statement_recorder(cls, slot):
+        """ Get a statement recorder that isn't called once the line is hit
+            
+            The marker checks the module's statement hits (bound to
+            _xxx_lines_xxx_ by the setup code) before calling the recorder,
+            so a line that has already been recorded costs a single lookup.
+        """
+        hit = ast.Subscript(value=ast.Name(id="_xxx_lines_xxx_",
+                                           ctx=ast.Load()),
+                            slice=ast.Index(value=ast.Num(n=slot)),
+                            ctx=ast.Load())
+        guard = ast.If(test=ast.UnaryOp(op=ast.Not(), operand=hit),
+                       body=[cls.get_statement_recorder_call(slot)],
+                       orelse=[])
+        return guard
     
-    def add_statement(self, modulename, node):
-        marker = self.get_statement_recorder_call(modulename, node.lineno)
+    def add_statement(self, modulename, node, disarm=False):
+        slot = self.metadata[modulename].lines.slots.get(node.lineno)
+        if slot is None:
+            return None
+        if disarm:
+            marker = self.get_disarming_statement_recorder(slot)
+        else:
+            marker = self.get_statement_recorder_call(slot)
         marker = ast.copy_location(marker, node)
         ast.fix_missing_locations(marker)
         return marker
@@ -93,12 +93,16 @@ class ExecutionReport(object):
         conditions = {}
         statements = {}
         sources = {}
+        counts = {}
         for modulename in self.metadata:
             conditions[modulename] = self.metadata[modulename].constructs
             statements[modulename] = self.metadata[modulename].lines
             sources[modulename] = self.metadata[modulename].source
+            md = self.metadata[modulename]
+            if md.counts is not None:
+                counts[modulename] = md.counts.line_counts(md.lines)
         summary = ExecutionSummary(conditions, statements, self.options)
-        html_report = HTMLCoverageReport(summary, sources)
+        html_report = HTMLCoverageReport(summary, sources, counts)
         html_report.write(os.path.join(self.working_directory, directory))
     
 class Chunk(object):
@@ -77,8 +77,111 @@ parser.add_option('--ignore-assertions',
 parser.add_option('--use-metadata-cache',
                   dest='use_metadata_cache',
                   action='store_true', default=False,
-                  help=('Use a metadata cache to (possibly) speed up'
-                        ' execution of the target program'))
+                  help=('Cache metadata and instrumented code to'
+                        ' (possibly) speed up execution of the target'
+                        ' program'))
+parser.add_option('--cache-file',
+                  dest='cache_file', default=None,
+                  help=('The file to keep the metadata cache in. Point'
+                        ' several checkouts at the same file to share'
+                        ' cached metadata. Defaults to'
+                        ' .instrumental.cache/cache.sqlite'))
+parser.add_option('--cache-size',
+                  dest='cache_size',
+                  type='int', default=64,
+                  help=('The size, in megabytes, past which the least'
+                        ' recently used entries are evicted from the'
+                        ' metadata cache'))
+parser.add_option('--metadata-workers',
+                  dest='metadata_workers',
+                  type='int', default=1,
+                  help=('The number of processes to use to gather metadata'
+                        ' about target modules that aren\'t in the metadata'
+                        ' cache'))
+parser.add_option('--lazy-metadata',
+                  dest='lazy_metadata',
+                  action='store_true', default=False,
+                  help=('Gather metadata about a target module when it is'
+                        ' imported rather than before the program starts.'
+                        ' Modules that are never imported are analyzed when'
+                        ' the results are saved'))
+parser.add_option('--skip-unimported',
+                  dest='skip_unimported',
+                  action='store_true', default=False,
+                  help=('With --lazy-metadata, leave target modules that'
+                        ' were never imported out of the results'))
+parser.add_option('--journal',
+                  dest='journal',
+                  action='store_true', default=False,
+                  help=('Append results to a journal next to the coverage'
+                        ' file while the program runs, so that they survive'
+                        ' a crash'))
+parser.add_option('--journal-interval',
+                  dest='journal_interval',
+                  type='float', default=1.0,
+                  help=('The number of seconds between writes to the'
+                        ' journal or sends to the collector'))
+parser.add_option('--subprocesses',
+                  dest='subprocesses',
+                  action='store_true', default=False,
+                  help=('Also record the processes the program starts, by'
+                        ' forking or by running Python, and combine their'
+                        ' results with its own'))
+parser.add_option('--shared-hits',
+                  dest='shared_hits',
+                  action='store_true', default=False,
+                  help=('Like --subprocesses, but keep statement and'
+                        ' condition hits in memory shared with forked'
+                        ' children, so that most children have nothing to'
+                        ' save or combine'))
+parser.add_option('--thread-shards',
+                  dest='thread_shards',
+                  action='store_true', default=False,
+                  help=('Have each thread record into results of its own,'
+                        ' which are merged when they are saved, so that'
+                        ' threads never write to the same results'))
+parser.add_option('--count-hits',
+                  dest='count_hits',
+                  action='store_true', default=False,
+                  help=('Count how many times each statement and condition'
+                        ' is hit, and show the statement counts in the html'
+                        ' report. Statements are then never disarmed or'
+                        ' monitored, and threads do not record into'
+                        ' shards'))
+parser.add_option('--snapshot-signal',
+                  dest='snapshot_signal',
+                  action='store_true', default=False,
+                  help=('Save the results so far, without stopping, whenever'
+                        ' the program receives SIGUSR1'))
+parser.add_option('--snapshot-interval',
+                  dest='snapshot_interval',
+                  type='float', default=None, metavar='SECONDS',
+                  help=('Save the results so far, without stopping, every'
+                        ' SECONDS seconds'))
+parser.add_option('--collector',
+                  dest='collector',
+                  default=None, metavar='SOCKET',
+                  help=('Send results to the collector listening on this'
+                        ' Unix socket (see `instrumental-tools collect`)'
+                        ' instead of saving them'))
+parser.add_option('--disarm-statements',
+                  dest='disarm_statement_probes',
+                  action='store_true', default=False,
+                  help=('Skip the statement recorder for lines that have'
+                        ' already been recorded, so covered code runs with'
+                        ' almost no statement overhead'))
+parser.add_option('--monitor-statements',
+                  dest='monitor_statements',
+                  action='store_true', default=False,
+                  help=('Record executed statements with sys.monitoring'
+                        ' (Python 3.12+) instead of statement markers.'
+                        ' Markers are still used on older Pythons'))
+parser.add_option('--monitor-decisions',
+                  dest='monitor_decisions',
+                  action='store_true', default=False,
+                  help=('Record the results of if and while tests from'
+                        ' sys.monitoring branch events (Python 3.12+)'
+                        ' instead of decision probes where possible'))
 parser.add_option('--ignore-comparisons',
                   dest='instrument_comparisons',
                   action='store_false', default=True,
@@ -140,11 +243,13 @@ def main(argv=None):
         if coverage.started:
             coverage.stop()
             coverage.save()
-        if any([opts.summary,
-                opts.report,
-                opts.statements,
-                opts.xml,
-                opts.html]):
+        # A forked child of the program has saved its results for the
+        # program to combine, and reporting them is up to the program
+        if not coverage.in_child and any([opts.summary,
+                                          opts.report,
+                                          opts.statements,
+                                          opts.xml,
+                                          opts.html]):
             sys.stdout.write("\n")
             recorder = coverage.load()
             report = ExecutionReport(cwd, recorder.metadata, opts)
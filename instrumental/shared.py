@@ -0,0 +1,156 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Statement and condition hits in memory shared with forked children
+    
+    Normally each process of a run (see instrumental.process) saves its own
+    results, and they're combined afterwards. With shared hits, the process
+    that starts the run maps one block of shared memory before it forks any
+    children and moves each module's statement hits and default condition
+    slots (see ModuleRecorder) into it. Marking a hit is a write of a 1 to a
+    byte, so it doesn't matter which process writes it first or how often,
+    and every process sees the hits of all the others.
+    
+    Only what fits in a byte is shared. Tagged condition results, and the
+    results for modules analyzed after the memory was mapped, still have to
+    be saved by the child that recorded them.
+"""
+import ctypes
+import mmap
+
+from instrumental.constructs import PragmaCondition
+from instrumental.constructs import UnreachableCondition
+
+class SharedRegion(object):
+    """ The shared hits of one module """
+    
+    def __init__(self, metadata, lines, conditions):
+        self.metadata = metadata
+        self.lines = lines
+        self.conditions = conditions
+        # The hits as they were at the last merge
+        self.merged = None
+
+def condition_slots(metadata):
+    """ List the (construct, condition) of each of a module's condition slots
+        
+        The slots are in the order ModuleRecorder gives them.
+    """
+    constructs = [None] * len(metadata.construct_ids)
+    for label, cid in metadata.construct_ids.items():
+        constructs[cid] = metadata.constructs.get(label)
+    slots = []
+    for construct in constructs:
+        if construct is not None:
+            slots.extend((construct, condition)
+                         for condition in sorted(construct.conditions))
+    return slots
+
+class SharedHits(object):
+    """ Keeps the hits of the modules in `recorder` in shared memory
+        
+        The memory is anonymous, so it's shared with the processes forked
+        after it's allocated and nothing else.
+    """
+    
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.regions = {}
+        self._memory = None
+    
+    def allocate(self):
+        """ Move the hits of every module the recorder has into shared memory
+            
+            Module recorders built after this record into the shared
+            memory too.
+        """
+        modules = []
+        size = 0
+        for modulename, metadata in sorted(self.recorder.metadata.items()):
+            nslots = len(condition_slots(metadata))
+            modules.append((modulename, metadata, nslots))
+            size += len(metadata.lines.hits) + nslots
+        self._memory = mmap.mmap(-1, max(size, 1))
+        offset = 0
+        for modulename, metadata, nslots in modules:
+            lines = self._array(offset, metadata.lines.hits)
+            offset += len(lines)
+            conditions = self._array(offset, bytearray(nslots))
+            offset += len(conditions)
+            metadata.lines.hits = lines
+            self.regions[modulename] = SharedRegion(metadata, lines,
+                                                    conditions)
+        self.recorder.shared = self
+        return self
+    
+    def _array(self, offset, hits):
+        array = (ctypes.c_ubyte * len(hits)).from_buffer(self._memory, offset)
+        array[:] = hits
+        return array
+    
+    def condition_hits(self, metadata, hits):
+        """ The condition slots a module recorder for `metadata` should use
+            
+            `hits` is the recorder's own, empty, slots. They're returned if
+            the module has no shared region, or if its metadata has changed
+            since the region was allocated.
+        """
+        region = self.regions.get(metadata.modulename)
+        if (region is None or region.metadata is not metadata
+            or len(region.conditions) != len(hits)):
+            return hits
+        return region.conditions
+    
+    def merge(self):
+        """ Add the condition hits of every process to the constructs here
+            
+            Statement hits aren't copied: the statement hits of each module
+            are the shared ones. Any module whose hits have changed since
+            the last merge, in this process or another, is marked as changed.
+        """
+        tag = self.recorder.DEFAULT_TAG
+        for region in self.regions.values():
+            hits = bytearray(region.conditions)
+            merged = (bytearray(region.lines), hits)
+            if merged == region.merged:
+                continue
+            region.merged = merged
+            for hit, (construct, condition) in zip(
+                hits, condition_slots(region.metadata)):
+                if hit:
+                    construct.conditions[condition].add(tag)
+            region.metadata.changed()
+    
+    def covers(self, recorder):
+        """ Is everything `recorder` has recorded in the shared memory?
+            
+            If it is, a child doesn't need to save its results.
+        """
+        shared = set([recorder.DEFAULT_TAG, UnreachableCondition,
+                      PragmaCondition.TAG])
+        for modulename, metadata in list(recorder.metadata.items()):
+            region = self.regions.get(modulename)
+            if region is None or region.metadata is not metadata:
+                return False
+            if metadata.counts is not None and metadata.counts.any():
+                # Counts aren't shared
+                return False
+            for construct in list(metadata.constructs.values()):
+                for results in list(construct.conditions.values()):
+                    if not shared.issuperset(list(results)):
+                        return False
+        return True
@@ -0,0 +1,118 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Save the results of a running program without stopping it
+    
+    A long-running program such as a service only saves its results when it
+    exits. A Snapshotter saves them while it runs: when asked to, on a
+    signal, or every so often. Taking a snapshot only copies the results
+    (see ExecutionRecorder.snapshot), and the copy is encoded and written by
+    a background thread, so the program carries on almost at once.
+"""
+import logging
+import signal
+import threading
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+class Snapshotter(object):
+    """ Saves snapshots of the results in `recorder` to `store`
+        
+        If `interval` is given a snapshot is also saved every `interval`
+        seconds. Only the latest snapshot that is waiting to be written is
+        kept, so asking for snapshots faster than they can be written
+        doesn't pile them up.
+    """
+    
+    def __init__(self, recorder, store, interval=None):
+        self.recorder = recorder
+        self.store = store
+        self.interval = interval
+        self._pending = None
+        self._requested = False
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._signal = None
+        self._previous_handler = None
+    
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='instrumental-snapshot')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def install_signal_handler(self, signum=SNAPSHOT_SIGNAL):
+        """ Take a snapshot whenever the process receives `signum`
+            
+            Signal handlers can only be installed from the main thread.
+            Returns whether the handler was installed.
+        """
+        if signum is None:
+            log.warning('Snapshots on a signal are not supported here')
+            return False
+        try:
+            self._previous_handler = signal.signal(signum, self._handle)
+        except ValueError:
+            log.warning('Could not install the snapshot signal handler'
+                        ' outside the main thread')
+            return False
+        self._signal = signum
+        return True
+    
+    def _handle(self, signum, frame):
+        # The program may be in the middle of recording or merging, so the
+        # snapshot is taken by the snapshot thread rather than in here
+        self._requested = True
+        self._wake.set()
+    
+    def request(self):
+        """ Take a snapshot now and have it saved in the background """
+        self._pending = self.recorder.snapshot()
+        self._wake.set()
+    
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            snapshot, self._pending = self._pending, None
+            requested, self._requested = self._requested, False
+            if snapshot is None and (requested or not self._stopping):
+                # A signal asked for one, or the interval passed
+                snapshot = self.recorder.snapshot()
+            if snapshot is not None:
+                try:
+                    self.store.save(snapshot)
+                except Exception:
+                    log.warning('Could not save a snapshot to %r',
+                                self.store.filename, exc_info=True)
+            if self._stopping:
+                return
+    
+    def stop(self):
+        """ Stop taking snapshots, once the one requested last is saved """
+        if self._signal is not None:
+            signal.signal(self._signal, self._previous_handler)
+            self._signal = None
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
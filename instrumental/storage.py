@@ -1,8 +1,15 @@
 import base64
+import hashlib
 import json
+import multiprocessing
 import os
 import pickle
+import shutil
+import stat
+import struct
 import sys
+import tempfile
+from functools import partial
 
 from astkit import ast
 
@@ -10,16 +17,84 @@ from instrumental.constructs import (
     BooleanDecision,
     Comparison,
     LogicalAnd,
+    LogicalBoolean,
     LogicalOr,
+    PragmaCondition,
     UnreachableCondition,
     )
+from instrumental.metadata import HitCounts
 from instrumental.metadata import ModuleMetadata
+from instrumental.metadata import StatementHits
+from instrumental.metadata import add_counts
 from instrumental.recorder import ExecutionRecorder
+from instrumental.tags import TagSet
+from instrumental.tags import TagTable
+
+# The version written by CompactSerializer. Files without one were written
+# by JSONSerializer.
+FORMAT_VERSION = 2
+
+CONSTRUCT_KINDS = dict((klass.__name__, klass)
+                       for klass in [BooleanDecision,
+                                     Comparison,
+                                     LogicalAnd,
+                                     LogicalOr])
+
+# The version written by ResultStore, whose files keep the static metadata
+# in a MetadataStore next to them. Version 3 kept a list of tag names for
+# each condition slot rather than their ids in the run's tag table.
+RUN_FORMAT_VERSION = 4
+RUN_FORMAT_VERSIONS = (3, RUN_FORMAT_VERSION)
+
+METADATA_DIRECTORY = '.instrumental.metadata'
+
+# The number of files combined into one at each step of ResultStore.combine
+COMBINE_FAN_IN = 16
+
+# A process journaling its results (see instrumental.journal) appends them
+# to the coverage filename, this suffix and its pid
+JOURNAL_SUFFIX = '.journal.'
+
+# A journal is a sequence of batches, each of which is its length followed by
+# its records, so that a batch cut short by a crash can be told apart and
+# dropped. A record is its one byte kind followed by one of these.
+JOURNAL_BATCH = struct.Struct('<I')
+# module index, length of the module name, length of the static metadata key
+JOURNAL_MODULE = struct.Struct('<III')
+# tag id, length of the tag
+JOURNAL_TAG = struct.Struct('<II')
+# module index, statement slot
+JOURNAL_STATEMENT = struct.Struct('<II')
+# module index, construct id, condition, tag id
+JOURNAL_CONDITION = struct.Struct('<IIHI')
+# length of the path to the MetadataStore the module records refer to
+JOURNAL_DIRECTORY = struct.Struct('<I')
+
+# The mode open() gives a new file. mkstemp makes files only their owner can
+# read, so files written through one are given this instead.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+def replace_file(temp, path):
+    """ Rename `temp` to `path`, with the mode `path` has or would get """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = FILE_MODE
+    os.chmod(temp, mode)
+    os.rename(temp, path)
+
+# Condition results that are decided by analysis rather than by a run, as
+# they're encoded by CompactEncoder
+STATIC_RESULTS = ('__unreachable__', PragmaCondition.TAG)
 
 class ResultStore(object):
     """ Storage for an instrumental run, including metadata and results
         
-        
+        The static metadata of each module is kept in a MetadataStore in
+        the same directory, and the file itself only holds what was hit.
+        Files written in the older formats can still be loaded.
     """
     
     def __init__(self, base, label=None, filename=None):
@@ -28,20 +103,220 @@ class ResultStore(object):
         elif not filename:
             filename = '.instrumental.cov'
         self._filename = os.path.join(base, filename)
+        self.metadata_store = MetadataStore(os.path.join(base,
+                                                         METADATA_DIRECTORY))
+        self._sections = {}
+        # Saving again only adds to the table, so the ids in the JSON kept
+        # for unchanged modules stay good
+        self._tags = TagTable()
     
     @property
     def filename(self):
         return self._filename
     
     def save(self, recorder):
-        with open(self.filename, 'w') as f:
-            JSONSerializer.dump(recorder, f)
-            # pickle.dump(recorder, f)
+        """ Save the results in `recorder`
+            
+            The JSON for each module is kept after it's written, along with
+            the module's generation. When the same store saves again, only
+            the modules that have changed since (see ModuleMetadata.changed)
+            are encoded; the rest of the file is the JSON from before. The
+            tag table is written once, after the modules.
+        """
+        encoder = RunEncoder(self.metadata_store, self._tags)
+        sections = {}
+        for modulename, md in list(recorder.metadata.items()):
+            # Read before encoding, so that anything recorded meanwhile is
+            # encoded next time
+            generation = md.generation
+            section = self._sections.get(modulename)
+            if section is None or section[0] != generation:
+                encoded = encoder.encode_metadata(modulename, md)
+                section = (generation, json.dumps(encoded, sort_keys=True))
+            sections[modulename] = section
+        self._sections = sections
+        # This is what json.dump writes for the whole run, with sort_keys
+        self._write_text(''.join(
+            ['{"__python_class__": "ExecutionRecorder", "format": ',
+             json.dumps(RUN_FORMAT_VERSION),
+             ', "metadata": {',
+             ', '.join('%s: %s' % (json.dumps(modulename),
+                                   sections[modulename][1])
+                       for modulename in sorted(sections)),
+             '}, "tags": ',
+             json.dumps(self._tags.tags),
+             '}']))
     
     def load(self):
+        """ Load the results here, and replay any journals kept next to them
+            
+            If the run that journaled its results never saved them, there
+            are only journals to load.
+        """
+        journals = self.journal_filenames()
+        if journals and not os.path.exists(self.filename):
+            recorder = ExecutionRecorder()
+        else:
+            recorder = self._decode(self._read())
+        for filename in journals:
+            replay_journal(filename, recorder, self.metadata_store)
+        return recorder
+    
+    def journal_filename(self, pid):
+        return ''.join([self.filename, JOURNAL_SUFFIX, str(pid)])
+    
+    def journal_filenames(self):
+        directory, name = os.path.split(self.filename)
+        prefix = name + JOURNAL_SUFFIX
+        if not os.path.isdir(directory or os.curdir):
+            return []
+        return sorted(os.path.join(directory, filename)
+                      for filename in os.listdir(directory or os.curdir)
+                      if filename.startswith(prefix))
+    
+    def clear_journals(self):
+        for filename in self.journal_filenames():
+            os.remove(filename)
+    
+    def combine(self, stores, workers=1, fan_in=COMBINE_FAN_IN):
+        """ Save the combined results of `stores` here
+            
+            The stores are combined as a tree: they're split into groups of
+            `fan_in` files, each group is combined into a temporary file,
+            and the temporary files are combined the same way until one
+            group is left, which is combined into this store. The groups at
+            each level are combined in parallel when `workers` > 1.
+            
+            Only one combined result and one input are in memory at a time
+            in each process, and the groups and the order within each group
+            are fixed by the order of `stores`, so the result doesn't depend
+            on how the work is scheduled.
+        """
+        filenames = [store.filename for store in stores]
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        temp_directory = tempfile.mkdtemp(dir=directory)
+        try:
+            level = 0
+            while True:
+                groups = [filenames[i:i + fan_in]
+                          for i in range(0, len(filenames), fan_in)] or [[]]
+                if len(groups) == 1:
+                    outfiles = [self.filename]
+                else:
+                    outfiles = [os.path.join(temp_directory,
+                                             '%s.%s.cov' % (level, i))
+                                for i in range(len(groups))]
+                map_combine([(group,
+                              outfile,
+                              self.metadata_store.directory)
+                             for group, outfile in zip(groups, outfiles)],
+                            workers)
+                if len(groups) == 1:
+                    break
+                # The temporary files refer to static metadata that has
+                # already been copied into this store
+                filenames = outfiles
+                level += 1
+        finally:
+            shutil.rmtree(temp_directory)
+    
+    def read_run(self, metadata_store):
+        """ Read the results here as an encoded run (see RunEncoder)
+            
+            The static metadata the run refers to is copied into
+            `metadata_store`. Files in older formats are loaded and encoded
+            again.
+        """
+        if self.journal_filenames():
+            return RunEncoder(metadata_store).encode(self.load())
+        d = self._read()
+        if d.get('format') != RUN_FORMAT_VERSION:
+            return RunEncoder(metadata_store).encode(self._decode(d))
+        for module in d['metadata'].values():
+            metadata_store.copy_from(self.metadata_store, module['static'])
+        return d
+    
+    def _read(self):
         with open(self.filename, 'r') as f:
-            # return pickle.load(f)
-            return JSONSerializer.load(f)
+            return json.load(f)
+    
+    def _write(self, d):
+        self._write_text(json.dumps(d, sort_keys=True))
+    
+    def _write_text(self, text):
+        # The file is replaced in one step, so that a snapshot (see
+        # instrumental.snapshot) can be read while the next one is written
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        replace_file(temp, self.filename)
+    
+    def _decode(self, d):
+        if d.get('format') in RUN_FORMAT_VERSIONS:
+            return RunDecoder(self.metadata_store).decode(d)
+        return CompactSerializer.decode(d)
+
+class MetadataStore(object):
+    """ A content-addressed directory of static module metadata
+        
+        Each entry is the JSON for one module's source, statement lines and
+        constructs, named by its hash. Runs of the same code share their
+        entries, so an entry is only written once. Entries are written to a
+        temporary file and renamed into place, which makes it safe for
+        several processes to save at the same time.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._entries = {}
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+    
+    def _write(self, key, encoded):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(encoded)
+        replace_file(temp, path)
+    
+    @staticmethod
+    def key(static):
+        """ The key `static` is stored under, without storing it """
+        return source_hash(json.dumps(static, sort_keys=True))
+    
+    def put(self, static):
+        """ Store `static` if it isn't already, and return its key """
+        encoded = json.dumps(static, sort_keys=True)
+        key = source_hash(encoded)
+        if key not in self._entries:
+            self._write(key, encoded)
+            self._entries[key] = static
+        return key
+    
+    def get(self, key):
+        static = self._entries.get(key)
+        if static is None:
+            with open(self._path(key), 'r') as f:
+                static = json.load(f)
+            self._entries[key] = static
+        return static
+    
+    def copy_from(self, other, key):
+        """ Copy the entry for `key` from `other`, if it's somewhere else """
+        if (os.path.abspath(other.directory) == os.path.abspath(self.directory)
+            or os.path.exists(self._path(key))):
+            return
+        with open(other._path(key), 'r') as f:
+            self._write(key, f.read())
 
 # NOTE: If JSON serialization becomes unusable for some reason, we can always
 #       continure down the path this silly TextSerializer lays out. But we
@@ -154,6 +429,38 @@ class JSONSerializer(object):
     def loads(self, string):
         return ObjectDecoder().decode(json.loads(string))
 
+class CompactSerializer(object):
+    """ Reads and writes results in the compact format
+        
+        Files written by JSONSerializer, which have no format number, are
+        still read.
+    """
+    
+    @classmethod
+    def dump(self, obj, f):
+        f.write(CompactSerializer.dumps(obj))
+    
+    @classmethod
+    def dumps(self, obj):
+        return json.dumps(CompactEncoder().encode(obj))
+    
+    @classmethod
+    def load(self, f):
+        return CompactSerializer.loads(f.read())
+    
+    @classmethod
+    def loads(self, string):
+        return CompactSerializer.decode(json.loads(string))
+    
+    @classmethod
+    def decode(self, d):
+        format = d.get('format')
+        if format is None:
+            return ObjectDecoder().decode(d)
+        if format != FORMAT_VERSION:
+            raise ValueError('Unsupported coverage file format: %r' % format)
+        return CompactDecoder().decode(d)
+
 class ObjectEncoder(object):
     
     @classmethod
@@ -174,7 +481,7 @@ class ObjectEncoder(object):
         return {'__python_class__': 'ModuleMetadata',
                 'modulename': md.modulename,
                 'source': md.source,
-                'lines': md.lines,
+                'lines': dict(md.lines.items()),
                 'constructs': dict((label, self.encode(construct))
                                    for label, construct
                                    in md.constructs.items())}
@@ -258,7 +565,7 @@ class ObjectDecoder(object):
     def decode_conditions(self, conditions):
         decoded = {}
         for condition, results in conditions.items():
-            decoded_results = set()
+            decoded_results = TagSet()
             for result in results:
                 if result == '__unreachable__':
                     result = UnreachableCondition
@@ -266,37 +573,37 @@ class ObjectDecoder(object):
             decoded[int(condition)] = decoded_results
         return decoded
     
+    def _decode_logical(self, klass, d):
+        node = self.decode_Node(d['node'])
+        logical = klass.restore(d['modulename'],
+                                d['label'],
+                                self.decode_conditions(d['conditions']),
+                                node=node,
+                                pins=len(node.values))
+        logical.literals = logical._gather_literals(node)
+        return logical
+    
     def decode_LogicalOr(self, d):
-        or_ = LogicalOr(d['modulename'],
-                        d['label'],
-                        self.decode_Node(d['node']),
-                        [])
-        or_.conditions = self.decode_conditions(d['conditions'])
-        return or_
+        return self._decode_logical(LogicalOr, d)
     
     def decode_LogicalAnd(self, d):
-        and_ = LogicalAnd(d['modulename'],
-                        d['label'],
-                        self.decode_Node(d['node']),
-                        [])
-        and_.conditions = self.decode_conditions(d['conditions'])
-        return and_
+        return self._decode_logical(LogicalAnd, d)
     
     def decode_BooleanDecision(self, d):
-        decision = BooleanDecision(d['modulename'],
-                                   d['label'],
-                                   self.decode_Node(d['node']),
-                                   [])
-        decision.conditions = self.decode_conditions(d['conditions'])
-        return decision
+        node = self.decode_Node(d['node'])
+        return BooleanDecision.restore(d['modulename'],
+                                       d['label'],
+                                       self.decode_conditions(d['conditions']),
+                                       node=node,
+                                       lineno=node.lineno)
     
     def decode_Comparison(self, d):
-        comparison = Comparison(d['modulename'],
-                                d['label'],
-                                self.decode_Node(d['node']),
-                                [])
-        comparison.conditions = self.decode_conditions(d['conditions'])
-        return comparison
+        node = self.decode_Node(d['node'])
+        return Comparison.restore(d['modulename'],
+                                  d['label'],
+                                  self.decode_conditions(d['conditions']),
+                                  node=node,
+                                  lineno=node.lineno)
     
     def decode_Node(self, d):
         node = getattr(ast, d['__python_class__'])()
@@ -307,3 +614,528 @@ class ObjectDecoder(object):
                 value = self.decode_Node(value)
             setattr(node, key, value)
         return node
+
+def source_hash(source):
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+def _position(node):
+    return (node.__class__.__name__,
+            getattr(node, 'lineno', None),
+            getattr(node, 'col_offset', None),
+            getattr(node, 'end_lineno', None),
+            getattr(node, 'end_col_offset', None))
+
+def _inner_count(node, position):
+    """ How many expressions inside `node` are at `position` """
+    count = 0
+    stack = list(ast.iter_child_nodes(node))
+    while stack:
+        child = stack.pop()
+        if isinstance(child, ast.expr) and _position(child) == position:
+            count += 1
+        stack.extend(ast.iter_child_nodes(child))
+    return count
+
+def node_span(node):
+    """ The kind and position of a node, which is how constructs find theirs
+        
+        The end of the node is only known on Python 3.8 and later. Before
+        that an expression can start where one inside it does, as `a and b`
+        does in `a and b or c`, so the last item is how many expressions of
+        the same kind and position are inside the node.
+    """
+    position = _position(node)
+    return position + (_inner_count(node, position),)
+
+def find_nodes(source):
+    """ Map the position of each expression in `source` to its nodes
+        
+        Nodes that share a position are listed outermost first.
+    """
+    if not isinstance(source, str):
+        # Python 2 won't parse a unicode string with a coding declaration
+        source = source.encode('utf-8')
+    nodes = {}
+    stack = [ast.parse(source)]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.expr):
+            nodes.setdefault(_position(node), []).append(node)
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+    return nodes
+
+class ModuleNodes(object):
+    """ Finds the nodes of a module's constructs by their spans
+        
+        The module source is parsed the first time a node is asked for.
+    """
+    
+    def __init__(self, modulename, source):
+        self.modulename = modulename
+        self.source = source
+        self._nodes = None
+    
+    def find(self, span):
+        if self._nodes is None:
+            self._nodes = find_nodes(self.source)
+        position = tuple(span[:5])
+        candidates = self._nodes.get(position, [])
+        if len(span) > 5:
+            candidates = [node for node in candidates
+                          if _inner_count(node, position) == span[5]]
+        # Spans written without the count get the outermost node
+        if not candidates:
+            raise ValueError('There is no %s at %s:%s:%s'
+                             % (span[0], self.modulename, span[1], span[2]))
+        return candidates[0]
+
+def encode_results(results):
+    # A journal encodes results while they're being recorded in another
+    # thread, and list() copies them without letting that thread run
+    return sorted('__unreachable__' if result == UnreachableCondition
+                  else result
+                  for result in list(results))
+
+def decode_results(results):
+    return TagSet(UnreachableCondition if result == '__unreachable__'
+               else result
+               for result in results)
+
+class CompactEncoder(object):
+    """ Encodes an ExecutionRecorder in the compact format
+        
+        Each module's source is stored once, under its hash. Constructs are
+        stored in construct id order as their kind and the span of their
+        node, which is found again in the source if a report needs it, and
+        their conditions are a list in condition order. Statement hits are
+        the module's slot order and its hits bytearray.
+    """
+    
+    def encode(self, recorder):
+        result = {'__python_class__': 'ExecutionRecorder',
+                  'format': FORMAT_VERSION,
+                  'sources': {},
+                  'metadata': {}}
+        for modulename, md in recorder.metadata.items():
+            digest = source_hash(md.source)
+            result['sources'][digest] = md.source
+            result['metadata'][modulename] = (
+                self.encode_ModuleMetadata(md, digest))
+        return result
+    
+    def encode_ModuleMetadata(self, md, digest):
+        ids = md.construct_ids
+        labels = sorted(md.constructs,
+                        key=lambda label: (ids.get(label, len(ids)), label))
+        # The hits may be in shared memory (see instrumental.shared)
+        hits = base64.b64encode(bytearray(md.lines.hits)).decode('ascii')
+        return {'source': digest,
+                'lines': list(md.lines.linenos),
+                'hits': hits,
+                'constructs': [self.encode_construct(md.constructs[label])
+                               for label in labels]}
+    
+    def encode_construct(self, construct):
+        # Constructs read from a compact file keep their span, so their
+        # nodes don't have to be found again to write them out
+        span = getattr(construct, 'span', None)
+        if span is None:
+            span = list(node_span(construct.node))
+        encoded = {'kind': construct.__class__.__name__,
+                   'label': construct.label,
+                   'span': span,
+                   'conditions': [encode_results(construct.conditions[n])
+                                  for n in sorted(construct.conditions)]}
+        if isinstance(construct, LogicalBoolean):
+            encoded['pins'] = construct.pins
+            encoded['literals'] = dict((str(pin), bool(literal))
+                                       for pin, literal
+                                       in construct.literals.items())
+        return encoded
+
+class CompactDecoder(object):
+    
+    def decode(self, d):
+        recorder = ExecutionRecorder()
+        for modulename, md in d['metadata'].items():
+            source = d['sources'][md['source']]
+            recorder.add_metadata(
+                self.decode_ModuleMetadata(modulename, source, md))
+        return recorder
+    
+    def decode_ModuleMetadata(self, modulename, source, d):
+        md = ModuleMetadata(modulename, source, [])
+        lines = StatementHits()
+        for lineno in d['lines']:
+            lines.add(lineno)
+        lines.hits[:] = bytearray(base64.b64decode(d['hits']))
+        md.lines = lines
+        nodes = ModuleNodes(modulename, source)
+        for encoded in d['constructs']:
+            construct = self.decode_construct(modulename, nodes, encoded)
+            md.add_construct(construct.label, construct)
+        return md
+    
+    def decode_construct(self, modulename, nodes, d):
+        klass = CONSTRUCT_KINDS[d['kind']]
+        span = d['span']
+        if issubclass(klass, LogicalBoolean):
+            attributes = {'pins': d['pins'],
+                          'literals': dict((int(pin), literal)
+                                           for pin, literal
+                                           in d['literals'].items())}
+            conditions = range(d['pins'] + 1)
+        else:
+            attributes = {'lineno': span[1]}
+            conditions = [False, True]
+        return klass.restore(modulename,
+                             d['label'],
+                             dict((condition, decode_results(results))
+                                  for condition, results
+                                  in zip(conditions, d['conditions'])),
+                             find_node=partial(nodes.find, span),
+                             span=span,
+                             **attributes)
+
+def or_bitmaps(mine, theirs):
+    """ Or together two base64 encoded bitmaps of the same length """
+    combined = bytearray(a | b for a, b
+                         in zip(bytearray(base64.b64decode(mine)),
+                                bytearray(base64.b64decode(theirs))))
+    return base64.b64encode(bytes(combined)).decode('ascii')
+
+def merge_run(combined, run):
+    """ Merge an encoded run (see RunEncoder) into `combined`
+        
+        A module must have the same static metadata in both. The tags of
+        `run` are added to the tag table of `combined`, and its tag ids are
+        translated to the ids there.
+    """
+    table = TagTable(combined.get('tags', ()))
+    run_table = TagTable(run.get('tags', ()))
+    for modulename, module in run['metadata'].items():
+        mine = combined['metadata'].get(modulename)
+        tags = dict((slot, table.ids(run_table.names(ids)))
+                    for slot, ids in module['tags'].items())
+        if mine is None:
+            mine = combined['metadata'][modulename] = {
+                'static': module['static'],
+                'lines': module['lines'],
+                'conditions': module['conditions'],
+                'tags': tags}
+            if 'counts' in module:
+                mine['counts'] = {'lines': list(module['counts']['lines']),
+                                  'conditions':
+                                      list(module['counts']['conditions'])}
+        elif mine['static'] != module['static']:
+            raise ValueError('Cannot combine results for different versions'
+                             ' of %s' % modulename)
+        else:
+            mine['lines'] = or_bitmaps(mine['lines'], module['lines'])
+            mine['conditions'] = or_bitmaps(mine['conditions'],
+                                            module['conditions'])
+            for slot, ids in tags.items():
+                mine['tags'][slot] = sorted(set(mine['tags'].get(slot, ()))
+                                            | set(ids))
+            if 'counts' in module:
+                counts = mine.setdefault('counts', {'lines': [],
+                                                    'conditions': []})
+                add_counts(counts['lines'], module['counts']['lines'])
+                add_counts(counts['conditions'],
+                           module['counts']['conditions'])
+    combined['tags'] = table.tags
+    return combined
+
+def combine_files(args):
+    """ Combine result files into one, reading them one at a time
+        
+        `args` is a tuple of the filenames to combine, the file to write and
+        the directory of the MetadataStore that the result refers to.
+    """
+    filenames, outfile, metadata_directory = args
+    metadata_store = MetadataStore(metadata_directory)
+    combined = {'__python_class__': 'ExecutionRecorder',
+                'format': RUN_FORMAT_VERSION,
+                'metadata': {},
+                'tags': []}
+    for filename in filenames:
+        store = ResultStore(os.path.dirname(filename), None,
+                            os.path.basename(filename))
+        merge_run(combined, store.read_run(metadata_store))
+    ResultStore(os.path.dirname(outfile), None,
+                os.path.basename(outfile))._write(combined)
+
+def map_combine(tasks, workers=1):
+    """ Map `combine_files` over `tasks`, in parallel if `workers` > 1 """
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            combine_files(task)
+        return
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        pool.map(combine_files, tasks, chunksize=1)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+class RunEncoder(object):
+    """ Encodes the results of a run, keeping the static metadata apart
+        
+        The static metadata of a module is its compact encoding (see
+        CompactEncoder) with only the condition results that analysis
+        decided, and it goes into `metadata_store`. What's left for each
+        module is the key of that entry, a bitmap of the statements hit, a
+        bitmap of the condition slots hit with the default tag and any other
+        tags by slot. Those tags are sorted lists of their ids in `tags`, a
+        TagTable, which is written once for the whole run. If hits were
+        counted, the module's statement and condition counts are lists in
+        slot order.
+    """
+    
+    def __init__(self, metadata_store, tags=None):
+        self.metadata_store = metadata_store
+        if tags is None:
+            tags = TagTable()
+        self.tags = tags
+    
+    def encode(self, recorder):
+        result = {'__python_class__': 'ExecutionRecorder',
+                  'format': RUN_FORMAT_VERSION,
+                  'metadata': {}}
+        for modulename, md in recorder.metadata.items():
+            result['metadata'][modulename] = self.encode_metadata(modulename,
+                                                                  md)
+        result['tags'] = self.tags.tags
+        return result
+    
+    def encode_metadata(self, modulename, md):
+        encoded = CompactEncoder().encode_ModuleMetadata(md, None)
+        module = self.encode_module(modulename, md.source, encoded)
+        if md.counts is not None:
+            module['counts'] = {'lines': list(md.counts.lines),
+                                'conditions': list(md.counts.conditions)}
+        return module
+    
+    def static_key(self, modulename, md):
+        """ The key of `md`'s static metadata, without storing it """
+        encoded = CompactEncoder().encode_ModuleMetadata(md, None)
+        static, _ = self._split(modulename, md.source, encoded)
+        return self.metadata_store.key(static)
+    
+    def encode_module(self, modulename, source, encoded):
+        static, module = self._split(modulename, source, encoded)
+        module['static'] = self.metadata_store.put(static)
+        return module
+    
+    def _split(self, modulename, source, encoded):
+        """ Split a module's compact encoding into its static metadata and
+            its results
+        """
+        hits = bytearray()
+        tags = {}
+        constructs = []
+        for construct in encoded['constructs']:
+            static_conditions = []
+            for results in construct['conditions']:
+                slot = len(hits)
+                hits.append(ExecutionRecorder.DEFAULT_TAG in results)
+                static_conditions.append([result for result in results
+                                          if result in STATIC_RESULTS])
+                others = [result for result in results
+                          if not (result in STATIC_RESULTS
+                                  or result == ExecutionRecorder.DEFAULT_TAG)]
+                if others:
+                    tags[str(slot)] = self.tags.ids(others)
+            static = dict(construct)
+            static['conditions'] = static_conditions
+            constructs.append(static)
+        static = {'modulename': modulename,
+                  'source': source,
+                  'lines': encoded['lines'],
+                  'constructs': constructs}
+        results = {'lines': encoded['hits'],
+                   'conditions': base64.b64encode(bytes(hits)).decode('ascii'),
+                   'tags': tags}
+        return static, results
+
+class RunDecoder(object):
+    
+    def __init__(self, metadata_store):
+        self.metadata_store = metadata_store
+    
+    def decode(self, d):
+        recorder = ExecutionRecorder()
+        # Version 3 wrote the names of the tags rather than a table of them
+        tags = TagTable(d['tags']) if 'tags' in d else None
+        for modulename, module in d['metadata'].items():
+            recorder.add_metadata(self.decode_module(modulename, module, tags))
+        return recorder
+    
+    def decode_module(self, modulename, module, tags=None):
+        static = self.metadata_store.get(module['static'])
+        md = CompactDecoder().decode_ModuleMetadata(
+            modulename, static['source'], self.join(static, module, tags))
+        if 'counts' in module:
+            md.counts = HitCounts()
+            add_counts(md.counts.lines, module['counts']['lines'])
+            add_counts(md.counts.conditions, module['counts']['conditions'])
+        return md
+    
+    def decode_unhit_module(self, modulename, key):
+        """ Decode the static metadata under `key`, with nothing hit """
+        static = self.metadata_store.get(key)
+        conditions = sum(len(construct['conditions'])
+                         for construct in static['constructs'])
+        return self.decode_module(
+            modulename,
+            {'static': key,
+             'lines': base64.b64encode(bytes(bytearray(len(static['lines'])))),
+             'conditions': base64.b64encode(bytes(bytearray(conditions))),
+             'tags': {}})
+    
+    def join(self, static, module, tags=None):
+        """ Put a module's static metadata and results back together
+            
+            `tags` is the TagTable of the run, or None if the module's tags
+            are names rather than ids. The result is the module's compact
+            encoding.
+        """
+        hits = bytearray(base64.b64decode(module['conditions']))
+        slot_tags = module['tags']
+        constructs = []
+        slot = 0
+        for construct in static['constructs']:
+            conditions = []
+            for results in construct['conditions']:
+                results = list(results)
+                if hits[slot]:
+                    results.append(ExecutionRecorder.DEFAULT_TAG)
+                ids = slot_tags.get(str(slot), ())
+                if tags is None:
+                    results.extend(ids)
+                else:
+                    results.extend(tags.names(ids))
+                conditions.append(results)
+                slot += 1
+            joined = dict(construct)
+            joined['conditions'] = conditions
+            constructs.append(joined)
+        return {'lines': static['lines'],
+                'hits': module['lines'],
+                'constructs': constructs}
+
+def read_journal(f):
+    """ Yield the records in a journal
+        
+        Records are tuples of their kind ('M', 'T', 'S', 'C' or 'D') and
+        the fields for that kind. An incomplete batch at the end of the
+        journal is ignored.
+    """
+    while True:
+        header = f.read(JOURNAL_BATCH.size)
+        if len(header) < JOURNAL_BATCH.size:
+            return
+        length, = JOURNAL_BATCH.unpack(header)
+        batch = f.read(length)
+        if len(batch) < length:
+            return
+        offset = 0
+        while offset < length:
+            kind = batch[offset:offset + 1].decode('ascii')
+            offset += 1
+            if kind == 'M':
+                index, name_length, key_length = \
+                    JOURNAL_MODULE.unpack_from(batch, offset)
+                offset += JOURNAL_MODULE.size
+                modulename = batch[offset:offset + name_length].decode('utf-8')
+                offset += name_length
+                key = batch[offset:offset + key_length].decode('ascii')
+                offset += key_length
+                yield kind, index, str(modulename), key
+            elif kind == 'T':
+                tag_id, tag_length = JOURNAL_TAG.unpack_from(batch, offset)
+                offset += JOURNAL_TAG.size
+                tag = batch[offset:offset + tag_length].decode('utf-8')
+                offset += tag_length
+                yield kind, tag_id, tag
+            elif kind == 'S':
+                yield (kind,) + JOURNAL_STATEMENT.unpack_from(batch, offset)
+                offset += JOURNAL_STATEMENT.size
+            elif kind == 'C':
+                yield (kind,) + JOURNAL_CONDITION.unpack_from(batch, offset)
+                offset += JOURNAL_CONDITION.size
+            elif kind == 'D':
+                path_length, = JOURNAL_DIRECTORY.unpack_from(batch, offset)
+                offset += JOURNAL_DIRECTORY.size
+                path = batch[offset:offset + path_length].decode('utf-8')
+                offset += path_length
+                yield kind, path
+            else:
+                raise ValueError('Unknown journal record %r' % kind)
+
+class JournalReplayer(object):
+    """ Adds the records of one journal to `recorder`
+        
+        Module indexes and tag ids are only meaningful within the journal
+        that defined them, so each journal needs its own replayer. Modules
+        the recorder doesn't have are decoded from the static metadata the
+        journal refers to, which is in `metadata_store` unless the journal
+        names another one. So are modules whose static metadata differs
+        from the journal's: their results are for another version of the
+        module, and the journal's replace them.
+    """
+    
+    def __init__(self, recorder, metadata_store):
+        self.recorder = recorder
+        self.decoder = RunDecoder(metadata_store)
+        self.modules = {}
+        self.tags = {}
+    
+    def replay(self, record):
+        kind = record[0]
+        if kind == 'M':
+            _, index, modulename, key = record
+            md = self.recorder.metadata.get(modulename)
+            if md is not None and self._static_key(modulename, md) != key:
+                md = None
+            if md is None:
+                md = self.decoder.decode_unhit_module(modulename, key)
+                self.recorder.add_metadata(md)
+            labels = dict((cid, label)
+                          for label, cid in md.construct_ids.items())
+            self.modules[index] = (md, labels)
+        elif kind == 'T':
+            _, tag_id, tag = record
+            self.tags[tag_id] = tag
+        elif kind == 'S':
+            _, index, slot = record
+            md, _ = self.modules[index]
+            md.lines.hits[slot] = 1
+            md.changed()
+        elif kind == 'C':
+            _, index, cid, condition, tag_id = record
+            md, labels = self.modules[index]
+            construct = md.constructs[labels[cid]]
+            construct.conditions[condition].add(self.tags[tag_id])
+            md.changed()
+        else:
+            _, path = record
+            self.decoder = RunDecoder(MetadataStore(path))
+
+    def _static_key(self, modulename, md):
+        # Only the key is wanted: replaying a journal writes nothing
+        encoder = RunEncoder(self.decoder.metadata_store)
+        return encoder.static_key(modulename, md)
+
+def replay_journal(filename, recorder, metadata_store):
+    """ Add the results in a journal to `recorder` """
+    replayer = JournalReplayer(recorder, metadata_store)
+    with open(filename, 'rb') as f:
+        for record in read_journal(f):
+            replayer.replay(record)
@@ -0,0 +1,179 @@
+# 
+# Copyright (C) 2012  Matthew J Desmarais
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+""" Tags kept as bits of integers rather than as sets of strings
+    
+    The results of a condition are the tags it was recorded with, and with
+    a tag for every test case they add up: each condition would keep a set
+    that refers to the names of every test that hit it. Instead each tag is
+    interned once in a TagTable, which gives it a small integer id, and
+    each condition keeps the ids it was hit with as bits, in words of
+    WORD_BITS. A TagSet behaves like a set of the tag names, so reports and
+    the rest of the code don't need to know.
+"""
+import threading
+
+try:
+    from collections.abc import MutableSet
+    from collections.abc import Set
+except ImportError:
+    from collections import MutableSet
+    from collections import Set
+
+class TagTable(object):
+    """ Gives each tag a small integer id, in the order they're seen """
+    
+    def __init__(self, tags=()):
+        self.tags = []
+        self._ids = {}
+        self._lock = threading.Lock()
+        for tag in tags:
+            self.id(tag)
+    
+    def __len__(self):
+        return len(self.tags)
+    
+    def id(self, tag):
+        tag_id = self._ids.get(tag)
+        if tag_id is None:
+            with self._lock:
+                tag_id = self._ids.get(tag)
+                if tag_id is None:
+                    tag_id = len(self.tags)
+                    self.tags.append(tag)
+                    self._ids[tag] = tag_id
+        return tag_id
+    
+    def ids(self, tags):
+        """ The ids of `tags`, in order and without repeats """
+        return sorted(set(self.id(tag) for tag in tags))
+    
+    def names(self, ids):
+        """ The tags with `ids` """
+        return [self.tags[tag_id] for tag_id in ids]
+    
+# The tags of the results in this process
+tag_table = TagTable()
+
+# The ids of a TagSet are kept as the bits of words of WORD_BITS each, so a
+# set holding a high id doesn't need an integer that big
+WORD_BITS = 64
+
+# Adding a tag reads and then writes a word, which another thread mustn't do
+# to the same set in between. Sets share a few locks, picked by their id, and
+# adding a tag that's already there doesn't take one.
+_locks = [threading.Lock() for _ in range(32)]
+
+def _lock_for(tagset):
+    return _locks[(id(tagset) >> 4) % len(_locks)]
+
+def _words(ids):
+    words = {}
+    for tag_id in ids:
+        index = tag_id // WORD_BITS
+        words[index] = words.get(index, 0) | 1 << tag_id % WORD_BITS
+    return words
+
+class TagSet(MutableSet):
+    """ A set of tags, kept as bits of the ids in `tag_table` """
+    
+    __slots__ = ('words',)
+    
+    def __init__(self, tags=()):
+        if isinstance(tags, TagSet):
+            self.words = dict(tags.words)
+        else:
+            self.words = _words(tag_table.id(tag) for tag in tags)
+    
+    @classmethod
+    def _from_iterable(cls, tags):
+        return cls(tags)
+    
+    def __contains__(self, tag):
+        tag_id = tag_table._ids.get(tag)
+        if tag_id is None:
+            return False
+        word = self.words.get(tag_id // WORD_BITS, 0)
+        return bool(word >> tag_id % WORD_BITS & 1)
+    
+    def __iter__(self):
+        tags = tag_table.tags
+        for index in sorted(self.words):
+            word = self.words[index]
+            tag_id = index * WORD_BITS
+            while word:
+                if word & 1:
+                    yield tags[tag_id]
+                word >>= 1
+                tag_id += 1
+    
+    def __len__(self):
+        return sum(bin(word).count('1') for word in self.words.values())
+    
+    def __eq__(self, other):
+        if isinstance(other, TagSet):
+            return self.words == other.words
+        return Set.__eq__(self, other)
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return 'TagSet(%r)' % (list(self),)
+    
+    def __reduce__(self):
+        # Ids are only meaningful in this process, so the names are pickled
+        return (TagSet, (list(self),))
+    
+    def add(self, tag):
+        tag_id = tag_table.id(tag)
+        index = tag_id // WORD_BITS
+        bit = 1 << tag_id % WORD_BITS
+        if not self.words.get(index, 0) & bit:
+            with _lock_for(self):
+                self.words[index] = self.words.get(index, 0) | bit
+    
+    def discard(self, tag):
+        tag_id = tag_table._ids.get(tag)
+        if tag_id is None:
+            return
+        index = tag_id // WORD_BITS
+        bit = 1 << tag_id % WORD_BITS
+        with _lock_for(self):
+            word = self.words.get(index, 0) & ~bit
+            if word:
+                self.words[index] = word
+            else:
+                self.words.pop(index, None)
+    
+    def update(self, tags):
+        if isinstance(tags, TagSet):
+            words = tags.words
+        else:
+            words = _words(tag_table.id(tag) for tag in tags)
+        for index, word in words.items():
+            if word & ~self.words.get(index, 0):
+                with _lock_for(self):
+                    self.words[index] = self.words.get(index, 0) | word
+    
+    def copy(self):
+        return TagSet(self)
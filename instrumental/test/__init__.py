@@ -26,6 +26,23 @@ class DummyConfig(object):
     instrument_assertions = True
     instrument_comparisons = True
     use_metadata_cache = False
+    cache_file = None
+    cache_size = 64
+    metadata_workers = 1
+    lazy_metadata = False
+    skip_unimported = False
+    journal = False
+    journal_interval = 1.0
+    collector = None
+    snapshot_signal = False
+    snapshot_interval = None
+    subprocesses = False
+    shared_hits = False
+    thread_shards = False
+    count_hits = False
+    disarm_statement_probes = False
+    monitor_statements = False
+    monitor_decisions = False
 
 class InstrumentationTestCase(object):
     
@@ -64,13 +81,19 @@ class InstrumentationTestCase(object):
         assert module.body[starting_lineno+1].targets[0].id == '_xxx_recorder_xxx_'
         assert isinstance(module.body[starting_lineno+1].value, ast.Call)
         assert isinstance(module.body[starting_lineno+1].value.func, ast.Attribute)
-        assert isinstance(module.body[starting_lineno+1].value.func.value, ast.Name)
-        assert module.body[starting_lineno+1].value.func.value.id == 'ExecutionRecorder'
-        assert module.body[starting_lineno+1].value.func.attr == 'get'
-        assert not module.body[starting_lineno+1].value.args
+        assert module.body[starting_lineno+1].value.func.attr == 'module_recorder'
+        assert isinstance(module.body[starting_lineno+1].value.args[0], ast.Str)
         assert not module.body[starting_lineno+1].value.keywords
-        assert not module.body[starting_lineno+1].value.starargs
-        assert not module.body[starting_lineno+1].value.kwargs
+        get_call = module.body[starting_lineno+1].value.func.value
+        assert isinstance(get_call, ast.Call)
+        assert isinstance(get_call.func, ast.Attribute)
+        assert isinstance(get_call.func.value, ast.Name)
+        assert get_call.func.value.id == 'ExecutionRecorder'
+        assert get_call.func.attr == 'get'
+        assert not get_call.args
+        assert not get_call.keywords
+        assert not get_call.starargs
+        assert not get_call.kwargs
     
     def _assert_record_statement(self, statement, modname, lineno):
         assert isinstance(statement, ast.Expr), statement.__dict__
@@ -79,10 +102,10 @@ class InstrumentationTestCase(object):
         assert isinstance(statement.value.func.value, ast.Name)
         assert statement.value.func.value.id == '_xxx_recorder_xxx_'
         assert statement.value.func.attr == 'record_statement'
-        assert isinstance(statement.value.args[0], ast.Str)
-        assert statement.value.args[0].s == modname
-        assert isinstance(statement.value.args[1], ast.Num)
-        assert statement.value.args[1].n == lineno
+        assert isinstance(statement.value.args[0], ast.Num)
+        slot = self.recorder.metadata[modname].lines.slots[lineno]
+        assert statement.value.args[0].n == slot
+        assert len(statement.value.args) == 1
 
 def setup():
     if os.path.exists('.instrumental.cache'):
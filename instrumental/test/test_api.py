@@ -0,0 +1,318 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from instrumental.api import Coverage
+from instrumental.recorder import ExecutionRecorder
+from instrumental.test import DummyConfig
+
+IMPORTED = 'instrumental.test.samples.docstring'
+UNIMPORTED = 'instrumental.test.samples.pragmas.simple'
+FORK_IMPORTED = 'instrumental.test.samples.simple'
+
+class DummyStoreConfig(DummyConfig):
+    file = None
+    label = False
+
+class CoverageTestCase(object):
+    """ Runs a Coverage that saves to a temporary directory
+        
+        Subclasses change the options they test in `_configure`.
+    """
+    
+    def setup(self):
+        ExecutionRecorder.reset()
+        self.basedir = tempfile.mkdtemp()
+        self.config = DummyStoreConfig()
+        self._configure(self.config)
+        self.coverage = Coverage(self.config, self.basedir)
+        sys.modules.pop(IMPORTED, None)
+    
+    def _configure(self, config):
+        pass
+    
+    def teardown(self):
+        if self.coverage.started:
+            self.coverage.stop()
+        sys.modules.pop(IMPORTED, None)
+        ExecutionRecorder.reset()
+        shutil.rmtree(self.basedir)
+    
+    def _run(self, targets=(IMPORTED,)):
+        """ Import IMPORTED while recording `targets` """
+        self.coverage.start(list(targets), [])
+        __import__(IMPORTED)
+        self.coverage.stop()
+        return self.coverage.recorder
+
+class TestLazyMetadata(CoverageTestCase):
+    
+    def _configure(self, config):
+        config.lazy_metadata = True
+    
+    def test_metadata_is_gathered_on_import(self):
+        recorder = self._run([IMPORTED, UNIMPORTED])
+        assert IMPORTED in recorder.metadata, recorder.metadata
+        assert UNIMPORTED not in recorder.metadata, recorder.metadata
+        assert recorder.metadata[IMPORTED].lines[3]
+    
+    def test_eager_metadata(self):
+        self.config.lazy_metadata = False
+        recorder = self._run([IMPORTED, UNIMPORTED])
+        assert IMPORTED in recorder.metadata, recorder.metadata
+        assert UNIMPORTED in recorder.metadata, recorder.metadata
+    
+    def test_gather_unimported(self):
+        recorder = self._run([IMPORTED, UNIMPORTED])
+        imported_metadata = recorder.metadata[IMPORTED]
+        
+        self.coverage.gather_unimported()
+        assert UNIMPORTED in recorder.metadata, recorder.metadata
+        assert not any(recorder.metadata[UNIMPORTED].lines.values())
+        assert recorder.metadata[IMPORTED] is imported_metadata
+    
+    def test_save_includes_unimported(self):
+        self._run([IMPORTED, UNIMPORTED])
+        self.coverage.save()
+        
+        recorder = self.coverage.load()
+        assert IMPORTED in recorder.metadata, recorder.metadata
+        assert UNIMPORTED in recorder.metadata, recorder.metadata
+    
+    def test_save_skips_unimported(self):
+        self.config.skip_unimported = True
+        self._run([IMPORTED, UNIMPORTED])
+        self.coverage.save()
+        
+        recorder = self.coverage.load()
+        assert IMPORTED in recorder.metadata, recorder.metadata
+        assert UNIMPORTED not in recorder.metadata, recorder.metadata
+
+class TestJournal(CoverageTestCase):
+    
+    def _configure(self, config):
+        config.journal = True
+        config.journal_interval = 60
+    
+    def test_results_survive_without_save(self):
+        self._run()
+        
+        recorder = self.coverage.load()
+        assert recorder.metadata[IMPORTED].lines[3]
+    
+    def test_save_removes_journal(self):
+        self._run()
+        self.coverage.save()
+        
+        store = self.coverage._get_store(self.config, self.basedir)
+        assert store.journal_filenames() == []
+        assert self.coverage.load().metadata[IMPORTED].lines[3]
+
+class TestCollectorUnavailable(CoverageTestCase):
+    
+    def _configure(self, config):
+        config.collector = os.path.join(self.basedir, 'missing.sock')
+    
+    def test_saves_locally(self):
+        self._run()
+        self.coverage.save()
+        
+        assert self.coverage.load().metadata[IMPORTED].lines[3]
+
+class TestSnapshot(CoverageTestCase):
+    
+    def test_snapshot_while_recording(self):
+        self.coverage.start([IMPORTED], [])
+        __import__(IMPORTED)
+        self.coverage.snapshot()
+        self.coverage.stop()
+        
+        assert self.coverage.load().metadata[IMPORTED].lines[3]
+
+class TestThreadShards(CoverageTestCase):
+    
+    def _configure(self, config):
+        config.thread_shards = True
+    
+    def test_threads_results_are_saved(self):
+        self.coverage.start([IMPORTED], [])
+        thread = threading.Thread(target=call_test_func)
+        thread.start()
+        thread.join()
+        self.coverage.stop()
+        self.coverage.save()
+        
+        lines = self.coverage.load().metadata[IMPORTED].lines
+        assert lines[4] and lines[5]
+        assert not lines[7]
+    
+    def test_not_sharded_when_counting(self):
+        self.config.count_hits = True
+        self.coverage.start([IMPORTED], [])
+        assert self.coverage.recorder.counting
+        assert not self.coverage.recorder.sharded
+
+class TestContext(CoverageTestCase):
+    
+    def test_context_restores_previous_tag(self):
+        with self.coverage.context('outer'):
+            with self.coverage.context('inner'):
+                assert self.coverage.recorder.tag == 'inner'
+            assert self.coverage.recorder.tag == 'outer'
+        assert self.coverage.recorder.tag is None
+    
+    def test_decorator(self):
+        @self.coverage.context('decorated')
+        def get_tag():
+            return self.coverage.recorder.tag
+        assert get_tag() == 'decorated'
+        assert get_tag.__name__ == 'get_tag'
+        assert self.coverage.recorder.tag is None
+    
+    def test_threads_keep_their_own_tags(self):
+        seen = {}
+        started = threading.Barrier(2) if hasattr(threading, 'Barrier') else None
+        def tagged(label):
+            with self.coverage.context(label):
+                if started is not None:
+                    started.wait()
+                seen[label] = self.coverage.recorder.tag
+        threads = [threading.Thread(target=tagged, args=(label,))
+                   for label in ('first', 'second')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert seen == {'first': 'first', 'second': 'second'}
+        assert self.coverage.recorder.tag is None
+
+def call_test_func():
+    __import__(IMPORTED)
+    sys.modules[IMPORTED].test_func(True, True)
+
+class TestSubprocesses(CoverageTestCase):
+    
+    targets = [IMPORTED]
+    
+    def setup(self):
+        super(TestSubprocesses, self).setup()
+        self.coverage.start(self.targets, [])
+        __import__(IMPORTED)
+    
+    def _configure(self, config):
+        config.subprocesses = True
+    
+    def _finish(self):
+        self.coverage.stop()
+        self.coverage.save()
+        assert sorted(os.listdir(self.basedir)) == ['.instrumental.cov',
+                                                    '.instrumental.metadata']
+        return self.coverage.load().metadata[IMPORTED]
+    
+    def test_forked_child(self):
+        child = multiprocessing.Process(target=call_test_func)
+        child.start()
+        child.join()
+        
+        got_metadata = self._finish()
+        assert got_metadata.lines[5]
+        assert not got_metadata.lines[7]
+    
+    def test_plain_fork(self):
+        if not hasattr(os, 'fork'):
+            return
+        pid = os.fork()
+        if pid == 0:
+            try:
+                call_test_func()
+                self.coverage.stop()
+                self.coverage.save()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        
+        got_metadata = self._finish()
+        assert got_metadata.lines[5]
+        assert not got_metadata.lines[7]
+    
+    def test_child_results_saved_again(self):
+        child = multiprocessing.Process(target=call_test_func)
+        child.start()
+        child.join()
+        self._finish()
+        
+        self.coverage.save()
+        got_metadata = self.coverage.load().metadata[IMPORTED]
+        assert got_metadata.lines[5]
+    
+    def test_spawned_child(self):
+        subprocess.check_call([sys.executable, '-c',
+                               'import sys;'
+                               ' from instrumental.test.test_api'
+                               ' import call_test_func;'
+                               ' call_test_func()'])
+        
+        got_metadata = self._finish()
+        assert got_metadata.lines[5]
+        assert not got_metadata.lines[7]
+        assert 'INSTRUMENTAL_SUBPROCESS' not in os.environ
+
+def import_in_child(parent_connection):
+    from instrumental import process
+    database = process._current.coverage._annotator_factory.database
+    __import__(FORK_IMPORTED)
+    sys.modules[FORK_IMPORTED].backwards('ab')
+    assert id(database._connection) != parent_connection
+
+class TestForkedMetadataCache(TestSubprocesses):
+    
+    targets = [IMPORTED, FORK_IMPORTED]
+    
+    def setup(self):
+        self.cachedir = tempfile.mkdtemp()
+        sys.modules.pop(FORK_IMPORTED, None)
+        super(TestForkedMetadataCache, self).setup()
+    
+    def _configure(self, config):
+        config.subprocesses = True
+        config.lazy_metadata = True
+        config.use_metadata_cache = True
+        config.cache_file = os.path.join(self.cachedir, 'cache.sqlite')
+    
+    def teardown(self):
+        super(TestForkedMetadataCache, self).teardown()
+        sys.modules.pop(FORK_IMPORTED, None)
+        shutil.rmtree(self.cachedir)
+    
+    def test_import_in_forked_child(self):
+        database = self.coverage._annotator_factory.database
+        assert database._connection is not None
+        child = multiprocessing.Process(target=import_in_child,
+                                        args=(id(database._connection),))
+        child.start()
+        child.join()
+        assert child.exitcode == 0
+        
+        self.coverage.stop()
+        self.coverage.save()
+        got_metadata = self.coverage.load().metadata[FORK_IMPORTED]
+        assert got_metadata.lines[2]
+
+class TestSharedHits(TestSubprocesses):
+    
+    def _configure(self, config):
+        config.shared_hits = True
+    
+    def test_forked_child_saves_nothing(self):
+        child = multiprocessing.Process(target=call_test_func)
+        child.start()
+        child.join()
+        
+        assert os.listdir(self.basedir) == []
+        got_metadata = self._finish()
+        assert got_metadata.lines[5]
+        assert got_metadata.constructs['4.2'].conditions[0] == set(['X'])
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+
+from instrumental.cache import CacheDatabase
+from instrumental.codecache import code_key
+from instrumental.codecache import CodeCache
+from instrumental.instrument import AnnotatorFactory
+from instrumental.instrument import CoverageAnnotator
+from instrumental.metadata import MetadataGatheringVisitor
+from instrumental.pragmas import PragmaFinder
+from instrumental.recorder import ExecutionRecorder
+from instrumental.test import DummyConfig
+
+SOURCE = """\
+def f(a, b):
+    if a and b:
+        return 1
+    return 2
+"""
+
+class TestCodeKey(object):
+    
+    def setup(self):
+        pragmas = PragmaFinder().find_pragmas(SOURCE)
+        self.metadata = MetadataGatheringVisitor.analyze(DummyConfig(),
+                                                         'somemodule',
+                                                         SOURCE, pragmas)
+    
+    def test_same_inputs_same_key(self):
+        assert (code_key(SOURCE, self.metadata, (True, True)) ==
+                code_key(SOURCE, self.metadata, (True, True)))
+    
+    def test_source_changes_key(self):
+        assert (code_key(SOURCE, self.metadata, (True, True)) !=
+                code_key(SOURCE + "\n", self.metadata, (True, True)))
+    
+    def test_options_change_key(self):
+        assert (code_key(SOURCE, self.metadata, (True, True)) !=
+                code_key(SOURCE, self.metadata, (True, False)))
+    
+    def test_metadata_changes_key(self):
+        key = code_key(SOURCE, self.metadata, (True, True))
+        self.metadata.lines.add(100)
+        assert key != code_key(SOURCE, self.metadata, (True, True))
+
+class TestCodeCache(object):
+    
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = CacheDatabase(os.path.join(self.directory,
+                                                   'cache.sqlite'),
+                                      1024 * 1024)
+        self.filepath = os.path.join(os.getcwd(), 'path/to/module.py')
+    
+    def teardown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_fetch_missing(self):
+        cache = CodeCache(self.database)
+        assert cache.fetch(self.filepath, 'key') is None
+    
+    def test_store_and_fetch(self):
+        cache = CodeCache(self.database)
+        code = compile(SOURCE, self.filepath, 'exec')
+        cache.store(self.filepath, 'key', code)
+        
+        cached = cache.fetch(self.filepath, 'key')
+        assert cached == code
+        assert cached.co_filename == self.filepath
+        assert cache.fetch(self.filepath, 'other key') is None
+        assert cache.fetch('/other/module.py', 'key') is None
+    
+    def test_unreadable_entry(self):
+        cache = CodeCache(self.database)
+        cache.store(self.filepath, 'key', compile('', self.filepath, 'exec'))
+        self.database.put(cache._key(self.filepath, 'key'), b'garbage')
+        assert cache.fetch(self.filepath, 'key') is None
+
+class TestCachedInstrumentation(object):
+    CACHE_PATH = '.instrumental.cache'
+    
+    def setup(self):
+        ExecutionRecorder.reset()
+        self.config = DummyConfig()
+        self.config.use_metadata_cache = True
+        self.filepath = os.path.join(os.getcwd(), 'path/to/module.py')
+        self._visit = CoverageAnnotator.visit
+    
+    def teardown(self):
+        CoverageAnnotator.visit = self._visit
+        ExecutionRecorder.reset()
+        if os.path.exists(self.CACHE_PATH):
+            shutil.rmtree(self.CACHE_PATH)
+    
+    def test_warm_run_skips_instrumentation(self):
+        factory = AnnotatorFactory(self.config, ExecutionRecorder.get())
+        code = factory.get_code('somemodule', SOURCE, self.filepath)
+        
+        def visit(self, node):
+            raise AssertionError('cached code should have been used')
+        CoverageAnnotator.visit = visit
+        
+        ExecutionRecorder.reset()
+        factory = AnnotatorFactory(self.config, ExecutionRecorder.get())
+        assert factory.get_code('somemodule', SOURCE, self.filepath) == code
+    
+    def test_options_change_instrumentation(self):
+        factory = AnnotatorFactory(self.config, ExecutionRecorder.get())
+        code = factory.get_code('somemodule', SOURCE, self.filepath)
+        
+        ExecutionRecorder.reset()
+        self.config.disarm_statement_probes = True
+        factory = AnnotatorFactory(self.config, ExecutionRecorder.get())
+        assert factory.get_code('somemodule', SOURCE, self.filepath) != code
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from instrumental.collector import Collector
+from instrumental.collector import CollectorTransport
+from instrumental.journal import HitJournal
+from instrumental.metadata import analyze_source
+from instrumental.recorder import ExecutionRecorder
+from instrumental.storage import JOURNAL_BATCH
+from instrumental.storage import ResultStore
+from instrumental.test import DummyConfig
+
+SOURCE = """\
+def f(a, b):
+    if a and b:
+        return a
+    return b
+"""
+
+def make_recorder():
+    recorder = ExecutionRecorder()
+    recorder.add_metadata(analyze_source(DummyConfig(), 'somemodule', SOURCE))
+    return recorder
+
+def hit(recorder, lineno, condition, tag):
+    metadata = recorder.metadata['somemodule']
+    metadata.lines[lineno] = True
+    metadata.constructs['2.2'].conditions[condition].add(tag)
+    metadata.changed()
+
+class TestCollector(object):
+    
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'collector.sock')
+        os.mkdir(os.path.join(self.directory, 'worker'))
+        os.mkdir(os.path.join(self.directory, 'collector'))
+        self.worker_store = ResultStore(os.path.join(self.directory,
+                                                     'worker'))
+        self.store = ResultStore(os.path.join(self.directory, 'collector'))
+        self.collector = Collector(self.address, self.store)
+        self.collector.bind()
+        self.thread = threading.Thread(target=self.collector.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def teardown(self):
+        self.collector.shutdown()
+        self.collector.close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+    
+    def _transport(self, recorder):
+        transport = CollectorTransport(recorder,
+                                       self.address,
+                                       self.worker_store.metadata_store,
+                                       interval=60)
+        transport.start()
+        return transport
+    
+    def _wait_for_line(self, lineno):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            metadata = self.collector.recorder.metadata.get('somemodule')
+            if metadata is not None and metadata.lines[lineno]:
+                return
+            time.sleep(0.01)
+        raise AssertionError('line %s never arrived' % lineno)
+    
+    def test_collect(self):
+        recorder = make_recorder()
+        transport = self._transport(recorder)
+        hit(recorder, 3, 1, 'X')
+        transport.flush()
+        hit(recorder, 4, 0, 'sometag')
+        transport.stop()
+        
+        other = make_recorder()
+        transport = self._transport(other)
+        hit(other, 2, 2, 'Y')
+        transport.stop()
+        
+        self._wait_for_line(4)
+        self._wait_for_line(2)
+        assert self.collector.wait(10)
+        self.collector.save()
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: True, 3: True, 4: True}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(['sometag']), 1: set(['X']), 2: set(['Y'])}
+    
+    def test_incomplete_batch_dropped(self):
+        filename = os.path.join(self.directory, 'sent')
+        recorder = make_recorder()
+        journal = HitJournal(recorder, filename,
+                             self.store.metadata_store, interval=60)
+        journal.start()
+        hit(recorder, 3, 1, 'X')
+        journal.stop()
+        with open(filename, 'ab') as f:
+            f.write(JOURNAL_BATCH.pack(100) + b'S')
+        
+        with open(filename, 'rb') as f:
+            self.collector.receive(f)
+        
+        got_metadata = self.collector.recorder.metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: False}
+        assert self.collector.wait(0)
+    
+    def test_unknown_record_dropped(self):
+        filename = os.path.join(self.directory, 'sent')
+        with open(filename, 'wb') as f:
+            f.write(JOURNAL_BATCH.pack(1) + b'?')
+        
+        with open(filename, 'rb') as f:
+            self.collector.receive(f)
+        
+        assert self.collector.recorder.metadata == {}
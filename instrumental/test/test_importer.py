@@ -22,6 +22,9 @@ class FakeVisitorFactory(object):
     def create(self, name, source):
         visitor = FakeVisitor()
         return visitor
+    
+    def get_code(self, name, source, filepath):
+        return compile(source, filepath, 'exec')
 
 class TestModuleLoader(object):
     
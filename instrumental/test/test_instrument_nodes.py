@@ -4,6 +4,8 @@ import sys
 from astkit import ast
 from astkit.render import SourceCodeRenderer as renderer
 
+from instrumental import monitoring
+from instrumental.compat import exec_f
 from instrumental.test import DummyConfig
 from instrumental.test import InstrumentationTestCase
 from instrumental.test import load_module
@@ -216,13 +218,12 @@ class TestInstrumentNodesPython2(InstrumentationTestCase):
         assert isinstance(inst_module.body[3].test.func, ast.Attribute)
         assert isinstance(inst_module.body[3].test.func.value, ast.Name)
         assert inst_module.body[3].test.func.value.id == '_xxx_recorder_xxx_'
-        assert inst_module.body[3].test.func.attr == 'record'
+        assert inst_module.body[3].test.func.attr == 'record_decision'
         assert isinstance(inst_module.body[3].test.args[0], ast.Name)
         assert inst_module.body[3].test.args[0].id == 'True'
-        assert isinstance(inst_module.body[3].test.args[1], ast.Str)
-        assert inst_module.body[3].test.args[1].s == 'test_module'
-        assert isinstance(inst_module.body[3].test.args[2], ast.Str)
-        assert inst_module.body[3].test.args[2].s == '1.1'
+        assert isinstance(inst_module.body[3].test.args[1], ast.Num)
+        cid = self.recorder.metadata['test_module'].construct_ids['1.1']
+        assert inst_module.body[3].test.args[1].n == cid
         assert not inst_module.body[3].test.keywords
         assert not hasattr(inst_module.body[3].test, 'starargs')
         assert not hasattr(inst_module.body[3].test, 'kwargs')
@@ -242,13 +243,12 @@ class TestInstrumentNodesPython2(InstrumentationTestCase):
         assert isinstance(inst_module.body[3].test.func, ast.Attribute)
         assert isinstance(inst_module.body[3].test.func.value, ast.Name)
         assert inst_module.body[3].test.func.value.id == '_xxx_recorder_xxx_'
-        assert inst_module.body[3].test.func.attr == 'record'
+        assert inst_module.body[3].test.func.attr == 'record_decision'
         assert isinstance(inst_module.body[3].test.args[0], ast.Name)
         assert inst_module.body[3].test.args[0].id == 'True'
-        assert isinstance(inst_module.body[3].test.args[1], ast.Str)
-        assert inst_module.body[3].test.args[1].s == 'test_module'
-        assert isinstance(inst_module.body[3].test.args[2], ast.Str)
-        assert inst_module.body[3].test.args[2].s == '1.1'
+        assert isinstance(inst_module.body[3].test.args[1], ast.Num)
+        cid = self.recorder.metadata['test_module'].construct_ids['1.1']
+        assert inst_module.body[3].test.args[1].n == cid
         assert not inst_module.body[3].test.keywords
         assert not hasattr(inst_module.body[3].test, 'starargs')
         assert not hasattr(inst_module.body[3].test, 'kwargs')
@@ -317,13 +317,12 @@ class TestInstrumentNodesPython2(InstrumentationTestCase):
         assert isinstance(inst_module.body[3].test.func, ast.Attribute)
         assert isinstance(inst_module.body[3].test.func.value, ast.Name)
         assert inst_module.body[3].test.func.value.id == '_xxx_recorder_xxx_'
-        assert inst_module.body[3].test.func.attr == 'record'
+        assert inst_module.body[3].test.func.attr == 'record_decision'
         assert isinstance(inst_module.body[3].test.args[0], ast.Name)
         assert inst_module.body[3].test.args[0].id == 'i'
-        assert isinstance(inst_module.body[3].test.args[1], ast.Str)
-        assert inst_module.body[3].test.args[1].s == 'test_module'
-        assert isinstance(inst_module.body[3].test.args[2], ast.Str)
-        assert inst_module.body[3].test.args[2].s == '1.1'
+        assert isinstance(inst_module.body[3].test.args[1], ast.Num)
+        cid = self.recorder.metadata['test_module'].construct_ids['1.1']
+        assert inst_module.body[3].test.args[1].n == cid
         assert not inst_module.body[3].test.keywords
         assert not hasattr(inst_module.body[3].test, 'starargs')
         assert not hasattr(inst_module.body[3].test, 'kwargs')
@@ -360,13 +359,12 @@ class TestInstrumentNodesPython2(InstrumentationTestCase):
         assert isinstance(inst_module.body[3].test.func, ast.Attribute)
         assert isinstance(inst_module.body[3].test.func.value, ast.Name)
         assert inst_module.body[3].test.func.value.id == '_xxx_recorder_xxx_'
-        assert inst_module.body[3].test.func.attr == 'record'
+        assert inst_module.body[3].test.func.attr == 'record_decision'
         assert isinstance(inst_module.body[3].test.args[0], ast.Name)
         assert inst_module.body[3].test.args[0].id == 'i'
-        assert isinstance(inst_module.body[3].test.args[1], ast.Str)
-        assert inst_module.body[3].test.args[1].s == 'test_module'
-        assert isinstance(inst_module.body[3].test.args[2], ast.Str)
-        assert inst_module.body[3].test.args[2].s == '1.1'
+        assert isinstance(inst_module.body[3].test.args[1], ast.Num)
+        cid = self.recorder.metadata['test_module'].construct_ids['1.1']
+        assert inst_module.body[3].test.args[1].n == cid
         assert not inst_module.body[3].test.keywords
         assert not hasattr(inst_module.body[3].test, 'starargs')
         assert not hasattr(inst_module.body[3].test, 'kwargs')
@@ -569,3 +567,152 @@ else:
             assert isinstance(inst_module.body[3].finalbody[1], ast.Expr)
             assert isinstance(inst_module.body[3].finalbody[1].value, ast.Call)
 
+
+class TestDisarmedStatements(InstrumentationTestCase):
+    
+    def setup(self):
+        super(TestDisarmedStatements, self).setup()
+        self.config.disarm_statement_probes = True
+    
+    def test_guarded_marker(self):
+        def test_module():
+            a = 1
+        inst_module = self._instrument_module(test_module)
+        
+        assert isinstance(inst_module.body[2], ast.Assign)
+        assert inst_module.body[2].targets[0].id == '_xxx_lines_xxx_'
+        assert inst_module.body[2].value.value.id == '_xxx_recorder_xxx_'
+        assert inst_module.body[2].value.attr == 'lines'
+        
+        guard = inst_module.body[3]
+        assert isinstance(guard, ast.If)
+        assert isinstance(guard.test, ast.UnaryOp)
+        assert isinstance(guard.test.op, ast.Not)
+        assert guard.test.operand.value.id == '_xxx_lines_xxx_'
+        assert not guard.orelse
+        self._assert_record_statement(guard.body[0], 'test_module', 1)
+        assert isinstance(inst_module.body[4], ast.Assign)
+    
+    def test_recorder_called_once(self):
+        def test_module():
+            for i in range(5):
+                a = i
+        inst_module = self._instrument_module(test_module)
+        code = compile(inst_module, '<string>', 'exec')
+        
+        module_recorder = self.recorder.module_recorder('test_module')
+        calls = []
+        record_statement = module_recorder.record_statement
+        def counting_record_statement(slot):
+            calls.append(slot)
+            record_statement(slot)
+        module_recorder.record_statement = counting_record_statement
+        
+        self.recorder.start()
+        try:
+            exec_f(code, {})
+        finally:
+            self.recorder.stop()
+        
+        lines = self.recorder.metadata['test_module'].lines
+        assert sorted(calls) == [lines.slots[1], lines.slots[2]], calls
+        assert lines[1] and lines[2]
+
+    def test_not_disarmed_when_counting(self):
+        def test_module():
+            a = 1
+        self.recorder.counting = True
+        inst_module = self._instrument_module(test_module)
+        
+        assert not [node for node in inst_module.body
+                    if isinstance(node, ast.Assign)
+                    and node.targets[0].id == '_xxx_lines_xxx_']
+        self._assert_record_statement(inst_module.body[2], 'test_module', 1)
+
+class FakeMonitor(object):
+    
+    def __init__(self, statements=True, decisions=False):
+        self.statements = statements
+        self.decisions = decisions
+
+class TestMonitoredStatements(InstrumentationTestCase):
+    
+    def setup(self):
+        super(TestMonitoredStatements, self).setup()
+        self.recorder.monitor = FakeMonitor()
+    
+    def test_no_statement_markers(self):
+        def test_module():
+            a = 1
+            if a:
+                b = 2
+        inst_module = self._instrument_module(test_module)
+        
+        monitor_setup = inst_module.body[2]
+        assert isinstance(monitor_setup, ast.Expr)
+        assert monitor_setup.value.func.attr == 'monitor_module'
+        assert monitor_setup.value.args[0].s == 'test_module'
+        assert not monitor_setup.value.args[1].elts
+        
+        assert isinstance(inst_module.body[3], ast.Assign)
+        assert isinstance(inst_module.body[4], ast.If)
+        assert isinstance(inst_module.body[4].body[0], ast.Assign)
+        assert len(inst_module.body) == 5
+    
+    def test_Global_keeps_marker(self):
+        def test_module():
+            def foo():
+                global a
+        inst_module = self._instrument_module(test_module)
+        
+        defn = inst_module.body[3]
+        assert isinstance(defn, ast.FunctionDef)
+        self._assert_record_statement(defn.body[0], 'test_module', 2)
+        assert isinstance(defn.body[1], ast.Global)
+
+if monitoring.available():
+    class TestMonitoredDecisions(InstrumentationTestCase):
+        
+        def setup(self):
+            super(TestMonitoredDecisions, self).setup()
+            self.recorder.monitor = FakeMonitor(statements=False,
+                                                decisions=True)
+        
+        def _monitored(self, inst_module):
+            monitor_setup = inst_module.body[2]
+            assert monitor_setup.value.func.attr == 'monitor_module'
+            return ast.literal_eval(monitor_setup.value.args[1])
+        
+        def test_branch_tests_are_not_probed(self):
+            def test_module():
+                if a:
+                    pass
+                while b < 3:
+                    pass
+            inst_module = self._instrument_module(test_module)
+            
+            metadata = self.recorder.metadata['test_module']
+            decisions = dict(self._monitored(inst_module))
+            if_cid = metadata.construct_ids['1.1']
+            while_cid = metadata.construct_ids['3.1']
+            assert decisions == {if_cid: (1, 1, 3, 4),
+                                 while_cid: (3, 3, 6, 11)}, decisions
+            assert isinstance(inst_module.body[4].test, ast.Name)
+            # the comparison is still recorded as a comparison
+            assert inst_module.body[6].test.func.attr == 'record_decision'
+            cid = inst_module.body[6].test.args[1].n
+            assert cid == metadata.construct_ids['3.2']
+        
+        def test_unreadable_tests_are_probed(self):
+            def test_module():
+                if not a:
+                    pass
+                while True:
+                    pass
+                if a or b:
+                    pass
+            inst_module = self._instrument_module(test_module)
+            
+            assert not self._monitored(inst_module)
+            for stmt in inst_module.body[4::2]:
+                assert stmt.test.func.attr == 'record_decision'
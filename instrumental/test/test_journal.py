@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+
+from instrumental.journal import HitJournal
+from instrumental.metadata import analyze_source
+from instrumental.recorder import ExecutionRecorder
+from instrumental.storage import JOURNAL_BATCH
+from instrumental.storage import ResultStore
+from instrumental.storage import replay_journal
+from instrumental.test import DummyConfig
+
+SOURCE = """\
+def f(a, b):
+    if a and b:
+        return a
+    return b
+"""
+
+class TestHitJournal(object):
+    
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ResultStore(self.directory)
+        self.recorder = ExecutionRecorder()
+        self.recorder.add_metadata(
+            analyze_source(DummyConfig(), 'somemodule', SOURCE))
+        self.journal = HitJournal(self.recorder,
+                                  self.store.journal_filename(1234),
+                                  self.store.metadata_store,
+                                  interval=60)
+        self.journal.start()
+    
+    def teardown(self):
+        self.journal.stop()
+        shutil.rmtree(self.directory)
+    
+    def _hit(self, lineno, condition, tag):
+        metadata = self.recorder.metadata['somemodule']
+        metadata.lines[lineno] = True
+        metadata.constructs['2.2'].conditions[condition].add(tag)
+    
+    def test_replay(self):
+        self._hit(3, 1, 'X')
+        self.journal.flush()
+        self._hit(4, 0, 'sometag')
+        self.journal.stop()
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: True}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(['sometag']), 1: set(['X']), 2: set()}
+        assert got_metadata.constructs['2.1'].conditions == {
+            False: set(), True: set()}
+    
+    def test_replay_onto_saved_results(self):
+        self._hit(3, 1, 'X')
+        self.store.save(self.recorder)
+        self._hit(4, 2, 'X')
+        self.journal.stop()
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: True}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X']), 2: set(['X'])}
+    
+    def test_replay_onto_stale_results(self):
+        stale = ExecutionRecorder()
+        stale.add_metadata(analyze_source(DummyConfig(), 'somemodule',
+                                          'def f(a):\n    return a\n'))
+        stale.metadata['somemodule'].lines[2] = True
+        self.store.save(stale)
+        self._hit(3, 1, 'X')
+        self.journal.stop()
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.source == SOURCE
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: False}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X']), 2: set()}
+    
+    def test_replay_stores_no_metadata(self):
+        self._hit(3, 1, 'X')
+        self.journal.stop()
+        entries = os.listdir(self.store.metadata_store.directory)
+        
+        # The module the journal is replayed onto is another version, which
+        # isn't in the store
+        stale = ExecutionRecorder()
+        stale.add_metadata(analyze_source(DummyConfig(), 'somemodule',
+                                          'def f(a):\n    return a\n'))
+        replay_journal(self.journal.filename, stale, self.store.metadata_store)
+        
+        assert stale.metadata['somemodule'].source == SOURCE
+        assert os.listdir(self.store.metadata_store.directory) == entries
+    
+    def test_only_new_results_written(self):
+        self._hit(3, 1, 'X')
+        self.journal.flush()
+        size = os.path.getsize(self.journal.filename)
+        self.journal.flush()
+        assert os.path.getsize(self.journal.filename) == size
+    
+    def test_incomplete_batch_ignored(self):
+        self._hit(3, 1, 'X')
+        self.journal.stop()
+        with open(self.journal.filename, 'ab') as f:
+            f.write(JOURNAL_BATCH.pack(100) + b'S')
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: False}
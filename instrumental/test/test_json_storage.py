@@ -1,4 +1,8 @@
+import json
 import os
+import shutil
+import stat
+import tempfile
 try:
     from StringIO import StringIO
 except ImportError:
@@ -11,8 +15,18 @@ from instrumental.constructs import Comparison
 from instrumental.constructs import LogicalAnd
 from instrumental.constructs import LogicalOr
 from instrumental.constructs import UnreachableCondition
+from instrumental.metadata import HitCounts
 from instrumental.metadata import ModuleMetadata
+from instrumental.metadata import analyze_source
 from instrumental.recorder import ExecutionRecorder
+from instrumental.test import DummyConfig
+
+SOURCE = """\
+def f(a, b):
+    if a and b:
+        return a
+    return b
+"""
 
 class TestObjectEncoder(object):
     
@@ -445,6 +459,12 @@ class TestObjectDecoder(object):
 
 class TestResultStore(object):
     
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def teardown(self):
+        shutil.rmtree(self.directory)
+    
     def _makeOne(self, base, label, filename):
         from instrumental.storage import ResultStore
         return ResultStore(base, label, filename)
@@ -459,6 +479,17 @@ class TestResultStore(object):
         expected_filename = './.instrumental.p99999.cov'
         assert store.filename == expected_filename
     
+    def test_saved_file_mode(self):
+        from instrumental.storage import FILE_MODE
+        
+        store = self._makeOne(self.directory, None, None)
+        store.save(self._make_recorder(3, 'X'))
+        assert stat.S_IMODE(os.stat(store.filename).st_mode) == FILE_MODE
+        
+        os.chmod(store.filename, 0o640)
+        store.save(self._make_recorder(4, 'X'))
+        assert stat.S_IMODE(os.stat(store.filename).st_mode) == 0o640
+    
     def test_with_filename(self):
         base = '.'
         label = None
@@ -480,44 +511,356 @@ class TestResultStore(object):
         assert store.filename == expected_filename
     
     def test_roundtrip(self):
-        from instrumental.storage import ResultStore
-        
-        node = ast.BoolOp(op=ast.Or(),
-                          values=[ast.Name(id='a'), ast.Name(id='b')],
-                          lineno=4)
-        construct = LogicalOr('somemodule', '4.2', node, [])
-        construct.conditions = {0: set(), 1: set(['X']),
-                                2: set([UnreachableCondition])}
-        metadata = ModuleMetadata('somemodule', 'somesource', [])
-        metadata.lines = {1: False, 2: False, 4: True}
-        metadata.constructs = {'4.2': construct}
+        metadata = analyze_source(DummyConfig(), 'somemodule', SOURCE)
+        metadata.lines[3] = True
+        metadata.constructs['2.2'].conditions[1].add('X')
         recorder = ExecutionRecorder()
         recorder.add_metadata(metadata)
         
-        store = self._makeOne('.', 'testing', None)
+        store = self._makeOne(self.directory, 'testing', None)
         store.save(recorder)
         got_recorder = store.load()
-        os.remove(store.filename)
         
         got_metadata = got_recorder.metadata['somemodule']
         assert got_metadata.modulename == 'somemodule'
-        assert got_metadata.source == 'somesource'
-        assert got_metadata.lines == {1: False, 2: False, 4: True},(
+        assert got_metadata.source == SOURCE
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: False},(
             got_metadata.lines)
         
-        got_construct = got_metadata.constructs['4.2']
+        got_construct = got_metadata.constructs['2.2']
+        assert isinstance(got_construct, LogicalAnd)
         assert got_construct.modulename == 'somemodule'
-        assert got_construct.label == '4.2'
+        assert got_construct.label == '2.2'
         assert got_construct.conditions == {0: set(),
                                             1: set(['X']),
-                                            2: set([UnreachableCondition])}
+                                            2: set()}
         
         got_node = got_construct.node
-        assert isinstance(got_node.op, ast.Or)
-        assert isinstance(got_node.values[0], ast.Name)
+        assert isinstance(got_node.op, ast.And)
         assert got_node.values[0].id == 'a'
-        assert isinstance(got_node.values[1], ast.Name)
         assert got_node.values[1].id == 'b'
-        assert got_node.lineno == 4
+        assert got_node.lineno == 2
 
+    def test_load_json_format(self):
+        from instrumental.storage import JSONSerializer
 
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id='a'), ast.Name(id='b')],
+                          lineno=4)
+        construct = LogicalOr('somemodule', '4.2', node, [])
+        construct.conditions = {0: set(), 1: set(['X']), 2: set()}
+        metadata = ModuleMetadata('somemodule', 'somesource', [])
+        metadata.lines = {1: False, 4: True}
+        metadata.constructs = {'4.2': construct}
+        recorder = ExecutionRecorder()
+        recorder.add_metadata(metadata)
+        
+        store = self._makeOne(self.directory, 'testing', None)
+        with open(store.filename, 'w') as f:
+            JSONSerializer.dump(recorder, f)
+        got_recorder = store.load()
+        
+        got_metadata = got_recorder.metadata['somemodule']
+        assert got_metadata.lines == {1: False, 4: True}
+        got_construct = got_metadata.constructs['4.2']
+        assert got_construct.conditions == {0: set(), 1: set(['X']), 2: set()}
+        assert got_construct.node.values[1].id == 'b'
+    
+    def _make_recorder(self, hit_lineno, tag):
+        metadata = analyze_source(DummyConfig(), 'somemodule', SOURCE)
+        metadata.lines[hit_lineno] = True
+        metadata.constructs['2.2'].conditions[1].add(tag)
+        recorder = ExecutionRecorder()
+        recorder.add_metadata(metadata)
+        return recorder
+    
+    def test_static_metadata_shared(self):
+        first = self._makeOne(self.directory, 'first', None)
+        first.save(self._make_recorder(3, 'X'))
+        second = self._makeOne(self.directory, 'second', None)
+        second.save(self._make_recorder(4, 'X'))
+        
+        metadata_directory = os.path.join(self.directory,
+                                          '.instrumental.metadata')
+        assert len(os.listdir(metadata_directory)) == 1
+        with open(second.filename) as f:
+            run = json.load(f)
+        module = run['metadata']['somemodule']
+        assert sorted(module) == ['conditions', 'lines', 'static', 'tags']
+        assert module['static'] == os.listdir(metadata_directory)[0][:-5]
+    
+    def test_metadata_file_mode(self):
+        from instrumental.storage import FILE_MODE
+        
+        store = self._makeOne(self.directory, None, None)
+        store.save(self._make_recorder(3, 'X'))
+        metadata_directory = store.metadata_store.directory
+        for name in os.listdir(metadata_directory):
+            path = os.path.join(metadata_directory, name)
+            assert stat.S_IMODE(os.stat(path).st_mode) == FILE_MODE
+    
+    def test_tag_table_written_once(self):
+        recorder = self._make_recorder(3, 'sometag')
+        recorder.metadata['somemodule'].constructs['2.2'].conditions[0].add(
+            'sometag')
+        store = self._makeOne(self.directory, None, None)
+        store.save(recorder)
+        
+        with open(store.filename) as f:
+            run = json.load(f)
+        assert run['tags'] == ['sometag']
+        assert run['metadata']['somemodule']['tags'] == {'2': [0], '3': [0]}
+    
+    def test_many_tags(self):
+        recorder = self._make_recorder(3, 'X')
+        construct = recorder.metadata['somemodule'].constructs['2.2']
+        conditions = construct.conditions
+        tags = ['test%d' % i for i in range(20000)]
+        for tag in tags:
+            conditions[0].add(tag)
+        conditions[2].add(tags[-1])
+        store = self._makeOne(self.directory, None, None)
+        store.save(recorder)
+        
+        got_metadata = store.load().metadata['somemodule']
+        got_conditions = got_metadata.constructs['2.2'].conditions
+        assert got_conditions[0] == set(tags)
+        assert got_conditions[2] == set([tags[-1]])
+    
+    def test_load_run_format_3(self):
+        store = self._makeOne(self.directory, None, None)
+        store.save(self._make_recorder(3, 'X'))
+        with open(store.filename) as f:
+            run = json.load(f)
+        run['format'] = 3
+        del run['tags']
+        run['metadata']['somemodule']['tags'] = {'4': ['sometag']}
+        with open(store.filename, 'w') as f:
+            json.dump(run, f)
+        
+        got_metadata = store.load().metadata['somemodule']
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X']), 2: set(['sometag'])}
+    
+    def _make_counted_recorder(self, count):
+        recorder = self._make_recorder(3, 'X')
+        metadata = recorder.metadata['somemodule']
+        metadata.counts = HitCounts(len(metadata.lines.hits), 5)
+        metadata.counts.lines[metadata.lines.slots[3]] = count
+        metadata.counts.conditions[3] = count
+        return recorder
+    
+    def test_hit_counts(self):
+        first = self._makeOne(self.directory, 'first', None)
+        first.save(self._make_counted_recorder(2))
+        got_counts = first.load().metadata['somemodule'].counts
+        assert list(got_counts.lines) == [0, 0, 2, 0]
+        assert list(got_counts.conditions) == [0, 0, 0, 2, 0]
+        
+        second = self._makeOne(self.directory, 'second', None)
+        second.save(self._make_counted_recorder(3))
+        combined = self._makeOne(self.directory, None, None)
+        combined.combine([first, second])
+        got_counts = combined.load().metadata['somemodule'].counts
+        assert list(got_counts.lines) == [0, 0, 5, 0]
+        assert list(got_counts.conditions) == [0, 0, 0, 5, 0]
+    
+    def test_resave_only_encodes_changed_modules(self):
+        from instrumental.storage import RunEncoder
+        
+        recorder = self._make_recorder(3, 'X')
+        other = analyze_source(DummyConfig(), 'othermodule', SOURCE)
+        recorder.add_metadata(other)
+        store = self._makeOne(self.directory, None, None)
+        store.save(recorder)
+        sections = dict(store._sections)
+        
+        recorder.metadata['somemodule'].constructs['2.2'].conditions[0].add(
+            'sometag')
+        recorder.metadata['somemodule'].changed()
+        store.save(recorder)
+        
+        assert store._sections['othermodule'] is sections['othermodule']
+        assert store._sections['somemodule'] is not sections['somemodule']
+        expected = RunEncoder(store.metadata_store).encode(recorder)
+        with open(store.filename) as f:
+            assert f.read() == json.dumps(expected, sort_keys=True)
+        got_metadata = store.load().metadata['somemodule']
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(['sometag']), 1: set(['X']), 2: set()}
+    
+    def test_combine(self):
+        first = self._makeOne(self.directory, 'first', None)
+        first.save(self._make_recorder(3, 'X'))
+        second = self._makeOne(self.directory, 'second', None)
+        second.save(self._make_recorder(4, 'sometag'))
+        
+        out_directory = os.path.join(self.directory, 'out')
+        os.mkdir(out_directory)
+        combined = self._makeOne(out_directory, None, None)
+        combined.combine([first, second])
+        
+        got_metadata = combined.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: True}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X', 'sometag']), 2: set()}
+    
+    def test_combine_tree(self):
+        stores = []
+        for i, (lineno, tag) in enumerate([(1, 'X'), (2, 'a'), (3, 'X'),
+                                           (4, 'b'), (3, 'a')]):
+            store = self._makeOne(self.directory, 'p%s' % i, None)
+            store.save(self._make_recorder(lineno, tag))
+            stores.append(store)
+        
+        serial = self._makeOne(self.directory, None, 'serial.cov')
+        serial.combine(stores, fan_in=2)
+        parallel = self._makeOne(self.directory, None, 'parallel.cov')
+        parallel.combine(stores, workers=2, fan_in=2)
+        
+        with open(serial.filename) as f:
+            serial_content = f.read()
+        with open(parallel.filename) as f:
+            assert f.read() == serial_content
+        got_metadata = parallel.load().metadata['somemodule']
+        assert got_metadata.lines == {1: True, 2: True, 3: True, 4: True}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X', 'a', 'b']), 2: set()}
+        assert sorted(os.listdir(self.directory)) == [
+            '.instrumental.metadata',
+            '.instrumental.p0.cov',
+            '.instrumental.p1.cov',
+            '.instrumental.p2.cov',
+            '.instrumental.p3.cov',
+            '.instrumental.p4.cov',
+            'parallel.cov',
+            'serial.cov']
+    
+    def test_combine_json_format(self):
+        from instrumental.storage import JSONSerializer
+        
+        first = self._makeOne(self.directory, 'first', None)
+        with open(first.filename, 'w') as f:
+            JSONSerializer.dump(self._make_recorder(3, 'X'), f)
+        second = self._makeOne(self.directory, 'second', None)
+        second.save(self._make_recorder(4, 'sometag'))
+        
+        combined = self._makeOne(self.directory, None, None)
+        combined.combine([first, second])
+        
+        got_metadata = combined.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: True}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X', 'sometag']), 2: set()}
+
+class TestCompactSerializer(object):
+    
+    def _make_recorder(self, *modulenames):
+        recorder = ExecutionRecorder()
+        for modulename in modulenames:
+            recorder.add_metadata(
+                analyze_source(DummyConfig(), modulename, SOURCE))
+        return recorder
+    
+    def test_encode(self):
+        from instrumental.storage import CompactEncoder
+        from instrumental.storage import source_hash
+        
+        recorder = self._make_recorder('somemodule', 'othermodule')
+        recorder.metadata['somemodule'].lines[3] = True
+        
+        result = CompactEncoder().encode(recorder)
+        
+        digest = source_hash(SOURCE)
+        assert result['sources'] == {digest: SOURCE}
+        encoded = result['metadata']['somemodule']
+        assert encoded['source'] == digest
+        assert encoded['lines'] == [1, 2, 3, 4]
+        assert encoded['hits'] == 'AAABAA==', encoded['hits']
+        
+        decision, and_ = encoded['constructs']
+        assert decision['kind'] == 'BooleanDecision'
+        assert decision['label'] == '2.1'
+        assert decision['conditions'] == [[], []]
+        assert and_['kind'] == 'LogicalAnd'
+        assert and_['label'] == '2.2'
+        assert and_['span'][:3] == ['BoolOp', 2, 7]
+        assert and_['pins'] == 2
+        assert and_['literals'] == {}
+        assert and_['conditions'] == [[], [], []]
+        assert 'node' not in and_
+    
+    def test_roundtrip(self):
+        from instrumental.storage import CompactSerializer
+        
+        recorder = self._make_recorder('somemodule')
+        metadata = recorder.metadata['somemodule']
+        metadata.lines[4] = True
+        metadata.constructs['2.1'].conditions[False].add('X')
+        metadata.constructs['2.2'].conditions[2].add(UnreachableCondition)
+        
+        got_recorder = CompactSerializer.loads(
+            CompactSerializer.dumps(recorder))
+        
+        got_metadata = got_recorder.metadata['somemodule']
+        assert got_metadata.source == SOURCE
+        assert got_metadata.lines == metadata.lines
+        assert got_metadata.construct_ids == metadata.construct_ids
+        
+        got_decision = got_metadata.constructs['2.1']
+        assert isinstance(got_decision, BooleanDecision)
+        assert got_decision.conditions == {False: set(['X']), True: set()}
+        assert got_decision.source == metadata.constructs['2.1'].source
+        
+        got_and = got_metadata.constructs['2.2']
+        assert got_and.conditions == {0: set(), 1: set(),
+                                      2: set([UnreachableCondition])}
+        assert got_and.node.col_offset == 7
+        assert got_and.pins == 2
+    
+    def test_nodes_found_when_needed(self):
+        from instrumental.storage import CompactSerializer
+        
+        recorder = self._make_recorder('somemodule')
+        got_recorder = CompactSerializer.loads(
+            CompactSerializer.dumps(recorder))
+        
+        and_ = recorder.metadata['somemodule'].constructs['2.2']
+        got_and = got_recorder.metadata['somemodule'].constructs['2.2']
+        assert got_and._node is None
+        assert got_and.source == and_.source, got_and.source
+        assert isinstance(got_and.node, ast.BoolOp)
+        assert got_and.lineno == 2
+    
+    def test_nodes_at_the_same_position(self):
+        from instrumental.storage import CompactSerializer
+        
+        recorder = ExecutionRecorder()
+        recorder.add_metadata(analyze_source(
+            DummyConfig(), 'somemodule',
+            'def f(a, b, c):\n    return a and b or c\n'))
+        got_recorder = CompactSerializer.loads(
+            CompactSerializer.dumps(recorder))
+        
+        constructs = recorder.metadata['somemodule'].constructs
+        got_constructs = got_recorder.metadata['somemodule'].constructs
+        assert sorted(got_constructs) == sorted(constructs)
+        for label, construct in constructs.items():
+            assert got_constructs[label].source == construct.source, label
+    
+    def test_missing_node(self):
+        from instrumental.storage import CompactEncoder
+        from instrumental.storage import CompactSerializer
+        
+        recorder = self._make_recorder('somemodule')
+        encoded = CompactEncoder().encode(recorder)
+        encoded['metadata']['somemodule']['constructs'][0]['span'][1] = 99
+        got_recorder = CompactSerializer.loads(json.dumps(encoded))
+        got_decision = got_recorder.metadata['somemodule'].constructs['2.1']
+        
+        try:
+            got_decision.source
+        except ValueError:
+            pass
+        else:
+            assert False, "expected a ValueError"
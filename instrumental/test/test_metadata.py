@@ -103,6 +103,22 @@ class TestMetadataGatheringVisitor(object):
         decision = metadata.constructs["3.1"]
         assert isinstance(decision, constructs.BooleanDecision)
 
+    def test_analyze_source__leaves_tree_unchanged(self):
+        from astkit import ast
+        from instrumental.metadata import analyze_source
+        def test_module():
+            """ module docstring """
+            def f(a):
+                """ function docstring """
+                return a or b
+        module, source = load_module(test_module)
+        before = ast.dump(module)
+        
+        metadata = analyze_source(DummyConfig(), 'modname', source, module)
+        assert before == ast.dump(module)
+        assert set([2, 4]) == set(metadata.lines), set(metadata.lines)
+        assert "4.1" in metadata.constructs, metadata.constructs
+    
     def test_visit_Assert(self):
         def test_module():
             assert a or b
@@ -144,3 +160,89 @@ class TestMetadataGatheringVisitor(object):
         boolop = metadata.constructs["1.2"]
         assert isinstance(boolop, constructs.LogicalOr)
 
+class TestStatementHits(object):
+    
+    def _make_one(self, lines=None):
+        from instrumental.metadata import StatementHits
+        return StatementHits(lines)
+    
+    def test_slots_are_assigned_in_order(self):
+        hits = self._make_one()
+        assert 0 == hits.add(4)
+        assert 1 == hits.add(2)
+        assert 0 == hits.add(4)
+        assert [4, 2] == hits.linenos
+        assert bytearray(2) == hits.hits
+    
+    def test_behaves_like_a_dict(self):
+        hits = self._make_one({1: False, 2: True, 4: False})
+        assert 3 == len(hits)
+        assert 2 in hits
+        assert 3 not in hits
+        assert hits[2]
+        assert not hits[4]
+        assert [1, 2, 4] == sorted(hits)
+        assert {1: False, 2: True, 4: False} == hits
+        assert {1: False, 2: True, 4: False} == dict(hits.items())
+        assert [False, False, True] == sorted(hits.values())
+    
+    def test_mark(self):
+        hits = self._make_one({1: False, 2: False})
+        hits.mark(2)
+        hits.mark(3)
+        assert {1: False, 2: True} == hits
+    
+    def test_merge(self):
+        hits = self._make_one({1: True, 2: False, 4: False})
+        other = self._make_one({1: False, 2: False, 4: True})
+        original_hits = hits.hits
+        hits.merge(other)
+        assert {1: True, 2: False, 4: True} == hits
+        assert original_hits is hits.hits
+    
+    def test_merge_with_different_slots(self):
+        hits = self._make_one()
+        hits[4] = False
+        hits[1] = False
+        other = self._make_one({1: True, 4: False})
+        hits.merge(other)
+        assert {1: True, 4: False} == hits
+    
+    def test_pickle(self):
+        import pickle
+        from instrumental.metadata import ModuleMetadata
+        metadata = ModuleMetadata('modname', '', {})
+        metadata.lines = {1: True, 3: False}
+        unpickled = pickle.loads(pickle.dumps(metadata))
+        assert {1: True, 3: False} == unpickled.lines
+
+class TestGatherMetadata(object):
+    TARGETS = ['instrumental.test.samples.pragmas',
+               'instrumental.test.samples.docstring']
+    
+    def _gather(self, workers):
+        from instrumental.metadata import gather_metadata
+        from instrumental.recorder import ExecutionRecorder
+        config = DummyConfig()
+        config.metadata_workers = workers
+        recorder = ExecutionRecorder()
+        gather_metadata(config, recorder, self.TARGETS, [])
+        return recorder.metadata
+    
+    def test_gather_metadata(self):
+        metadata = self._gather(1)
+        assert set(['instrumental.test.samples.pragmas',
+                    'instrumental.test.samples.pragmas.simple',
+                    'instrumental.test.samples.docstring']) == set(metadata)
+        assert "8.2" in metadata['instrumental.test.samples.pragmas.simple'].constructs
+    
+    def test_gather_metadata__in_parallel(self):
+        serial = self._gather(1)
+        parallel = self._gather(2)
+        assert sorted(serial) == sorted(parallel)
+        for modulename in serial:
+            assert serial[modulename].source == parallel[modulename].source
+            assert (dict(serial[modulename].lines.items())
+                    == dict(parallel[modulename].lines.items()))
+            assert (serial[modulename].construct_ids
+                    == parallel[modulename].construct_ids)
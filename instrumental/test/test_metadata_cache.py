@@ -1,82 +1,127 @@
-import contextlib
-import datetime
 import os
 import shutil
-import time
+import sqlite3
+import tempfile
 
-from instrumental import util
-from instrumental.metadata import FileBackedMetadataCache
-from instrumental.metadata import ModuleMetadata
+from instrumental.cache import CacheDatabase
+from instrumental.cache import MetadataCache
+from instrumental.metadata import analyze_source
+from instrumental.pragmas import PragmaNoCondition
+from instrumental.pragmas import PragmaNoCover
+from instrumental.test import DummyConfig
 
-@contextlib.contextmanager
-def monkeypatch_now(when):
-    old_now = util.now
-    util.now = lambda: when
-    yield
-    util.now = old_now
+SOURCE = """\
+def f(a, b):
+    if a and b: # pragma: no cond(T T)
+        return 1
+    if b:
+        return 2 # pragma: no cover
+    return 3
+"""
 
-class TestFileBackedMetadataCache(object):
-    CACHE_PATH = '.instrumental.cache'
+class TestCacheDatabase(object):
     
     def setup(self):
-        self._dirty_paths = []# self.CACHE_PATH]
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache', 'cache.sqlite')
     
     def teardown(self):
-        for path in self._dirty_paths:
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            else:
-                os.remove(path)
+        shutil.rmtree(self.directory)
     
-    def _make_one(self):
-        return FileBackedMetadataCache()
+    def test_get_missing(self):
+        database = CacheDatabase(self.filename, 1024)
+        assert database.get('key') is None
+        assert os.path.exists(self.filename)
     
-    def _make_metadata(self, filepath):
-        return ModuleMetadata(filepath,
-                              source = "",
-                              pragmas = {})
-
-    def _touch_file(self, filepath):
-        if not os.path.exists(os.path.dirname(filepath)):
-            os.makedirs(os.path.dirname(filepath))
-        open(filepath, 'w').close()
+    def test_put_and_get(self):
+        database = CacheDatabase(self.filename, 1024)
+        database.put('key', b'value')
+        assert database.get('key') == b'value'
+        assert database.size() == 5
     
-    def test_new_cache(self):
-        cache = self._make_one()
+    def test_shared_between_instances(self):
+        CacheDatabase(self.filename, 1024).put('key', b'value')
+        assert CacheDatabase(self.filename, 1024).get('key') == b'value'
     
-    def test_initialize(self):
-        cache = self._make_one()
-        cache.initialize()
+    def test_evicts_least_recently_used(self):
+        database = CacheDatabase(self.filename, 10)
+        database.put('a', b'aaaa')
+        database.put('b', b'bbbb')
+        database.get('a')
+        database.put('c', b'cccc')
         
-        assert os.path.exists(self.CACHE_PATH)
+        assert database.get('a') == b'aaaa'
+        assert database.get('b') is None
+        assert database.get('c') == b'cccc'
+        assert database.size() == 8
+
+    def _used(self, key):
+        connection = sqlite3.connect(self.filename)
+        try:
+            used, = connection.execute('SELECT used FROM entries'
+                                       ' WHERE key = ?', (key,)).fetchone()
+        finally:
+            connection.close()
+        return used
     
-    def test_item_presence_when_present_and_valid(self):
-        cache = self._make_one()
-        cache.initialize()
+    def test_use_written_on_close(self):
+        database = CacheDatabase(self.filename, 1024)
+        database.put('key', b'value')
+        database.close()
+        connection = sqlite3.connect(self.filename)
+        connection.execute('UPDATE entries SET used = 0')
+        connection.commit()
+        connection.close()
         
-        filepath = os.path.join(os.getcwd(), 'path/to/module.py')
-        self._touch_file(filepath)
-        self._dirty_paths.append(filepath)
+        database.get('key')
+        database.get('key')
+        assert self._used('key') == 0
+        database.close()
+        assert self._used('key') > 0
+
+class TestMetadataCache(object):
+    
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.sqlite')
+        self.config = DummyConfig()
+    
+    def teardown(self):
+        shutil.rmtree(self.directory)
+    
+    def _make_one(self):
+        return MetadataCache(CacheDatabase(self.filename, 1024 * 1024),
+                             self.config)
+    
+    def test_fetch_missing(self):
+        assert self._make_one().fetch('modname', SOURCE) is None
+    
+    def test_store_and_fetch(self):
+        metadata = analyze_source(self.config, 'modname', SOURCE)
+        self._make_one().store('modname', SOURCE, metadata)
         
-        meta = self._make_metadata(filepath)
-        timestamp = datetime.datetime.now() + datetime.timedelta(seconds=1)
-        with monkeypatch_now(timestamp):
-            cache.store(filepath, meta)
-        cached_metadata = cache.fetch(filepath)
-        assert cached_metadata
+        cached = self._make_one().fetch('modname', SOURCE)
+        assert cached.modulename == 'modname'
+        assert cached.source == SOURCE
+        assert cached.lines.linenos == metadata.lines.linenos
+        assert cached.construct_ids == metadata.construct_ids
+        assert sorted(cached.constructs) == sorted(metadata.constructs)
+        for label, construct in metadata.constructs.items():
+            assert cached.constructs[label].conditions == construct.conditions
+        assert isinstance(list(cached.pragmas[2])[0], PragmaNoCondition)
+        assert list(cached.pragmas[2])[0].conditions == ['T T']
+        assert isinstance(list(cached.pragmas[5])[0], PragmaNoCover)
     
-    def test_item_absence_when_present_and_stale(self):
+    def test_source_changes_key(self):
+        metadata = analyze_source(self.config, 'modname', SOURCE)
         cache = self._make_one()
-        cache.initialize()
-        
-        filepath = os.path.join(os.getcwd(), 'path/to/module.py')
-        self._touch_file(filepath)
-        self._dirty_paths.append(filepath)
-        
-        meta = self._make_metadata(filepath)
-        timestamp = datetime.datetime.now() + datetime.timedelta(seconds=-2)
-        with monkeypatch_now(timestamp):
-            cache.store(filepath, meta)
-        self._touch_file(filepath)
-        cached_metadata = cache.fetch(filepath)
-        assert not cached_metadata
+        cache.store('modname', SOURCE, metadata)
+        assert cache.fetch('modname', SOURCE + "\n") is None
+        assert cache.fetch('othername', SOURCE) is None
+    
+    def test_config_changes_key(self):
+        metadata = analyze_source(self.config, 'modname', SOURCE)
+        cache = self._make_one()
+        cache.store('modname', SOURCE, metadata)
+        self.config.instrument_comparisons = False
+        assert cache.fetch('modname', SOURCE) is None
@@ -0,0 +1,128 @@
+import sys
+
+from instrumental import monitoring
+from instrumental.compat import exec_f
+from instrumental.metadata import StatementHits
+from instrumental.monitoring import ExecutionMonitor
+from instrumental.test import InstrumentationTestCase
+
+class FakeRecorder(object):
+    recording = True
+
+class TestExecutionMonitor(object):
+    
+    def setup(self):
+        self.recorder = FakeRecorder()
+        self._old_available = monitoring.available
+    
+    def teardown(self):
+        monitoring.available = self._old_available
+    
+    def test_create_without_sys_monitoring(self):
+        monitoring.available = lambda: False
+        assert ExecutionMonitor.create(self.recorder) is None
+    
+    def test_iter_code(self):
+        def outer():
+            def inner():
+                pass
+            return lambda: inner
+        names = set(code.co_name for code in monitoring.iter_code(outer.__code__))
+        assert names == set(['outer', 'inner', '<lambda>']), names
+    
+    if monitoring.available():
+        def test_record_lines(self):
+            lines = StatementHits()
+            for lineno in [3, 4, 5, 6, 7, 9]:
+                lines.add(lineno)
+            monitor = ExecutionMonitor.create(self.recorder)
+            def register():
+                monitor.add_code(sys._getframe(1).f_code, lines)
+            source = "\n".join(["",
+                                "register()",
+                                "a = 1",
+                                "def f(x):",
+                                "    if x:",
+                                "        return 1",
+                                "    return 2",
+                                "for i in range(10):",
+                                "    f(0)",
+                                ])
+            try:
+                exec_f(compile(source, '<string>', 'exec'),
+                       {'register': register})
+            finally:
+                monitor.stop()
+            assert dict(lines.items()) == {3: True, 4: True, 5: True,
+                                           6: False, 7: True, 9: True}
+        
+        def test_not_recording(self):
+            self.recorder.recording = False
+            lines = StatementHits()
+            lines.add(3)
+            monitor = ExecutionMonitor.create(self.recorder)
+            def register():
+                monitor.add_code(sys._getframe(1).f_code, lines)
+            try:
+                exec_f(compile("\nregister()\na = 1", '<string>', 'exec'),
+                       {'register': register})
+            finally:
+                monitor.stop()
+            assert not lines[3]
+
+if monitoring.available():
+    class TestMonitoredModule(InstrumentationTestCase):
+        
+        def setup(self):
+            super(TestMonitoredModule, self).setup()
+            self.recorder.monitor = ExecutionMonitor.create(self.recorder,
+                                                            statements=True,
+                                                            decisions=True)
+        
+        def teardown(self):
+            self.recorder.monitor.stop()
+        
+        def test_statements_and_decisions(self):
+            def test_module():
+                def f(x):
+                    if x:
+                        return 1
+                    return 2
+                for i in range(10):
+                    f(i % 2)
+                while False:
+                    pass
+            inst_module = self._instrument_module(test_module)
+            code = compile(inst_module, '<string>', 'exec')
+            self.recorder.start()
+            try:
+                exec_f(code, {})
+            finally:
+                self.recorder.stop()
+            
+            metadata = self.recorder.metadata['test_module']
+            assert dict(metadata.lines.items()) == {1: True, 2: True,
+                                                    3: True, 4: True,
+                                                    5: True, 6: True,
+                                                    7: True, 8: False}
+            decision = metadata.constructs['2.1']
+            assert decision.conditions == {True: set(['X']),
+                                           False: set(['X'])}
+            # `while False` has no jump to monitor so it is probed
+            assert metadata.constructs['7.1'].conditions == {True: set(),
+                                                             False: set(['X'])}
+        
+        def test_statement_after_docstring(self):
+            def test_module():
+                "A docstring"
+                a = 1
+            inst_module = self._instrument_module(test_module)
+            code = compile(inst_module, '<string>', 'exec')
+            self.recorder.start()
+            try:
+                exec_f(code, {})
+            finally:
+                self.recorder.stop()
+            
+            metadata = self.recorder.metadata['test_module']
+            assert dict(metadata.lines.items()) == {2: True}
@@ -63,6 +63,19 @@ def somefunc(args): # pragma: nocover
         assert pragmas[3], pragmas
         assert isinstance(list(pragmas[3])[0], PragmaNoCover)
     
+    def test_pragma_no_cover_on_FunctionDefn__with_tree(self):
+        from instrumental.pragmas import PragmaNoCover
+        source = """
+def somefunc(args): # pragma: nocover
+    return 'howdy'
+"""
+        tree = ast.parse(source)
+        pragmas = self.finder.find_pragmas(source, tree)
+        assert 3 == len(pragmas), pragmas
+        assert not pragmas[1]
+        assert isinstance(list(pragmas[2])[0], PragmaNoCover)
+        assert isinstance(list(pragmas[3])[0], PragmaNoCover)
+    
     def test_pragma_no_cond_T(self):
         from instrumental.pragmas import PragmaNoCondition
         source = """
@@ -1,5 +1,11 @@
+import threading
+
 from astkit import ast
 
+from instrumental.constructs import BooleanDecision
+from instrumental.constructs import LogicalOr
+from instrumental.metadata import MAX_COUNT
+from instrumental.metadata import ModuleMetadata
 from instrumental.recorder import ExecutionRecorder
 
 class KnownValue(object):
@@ -10,6 +16,17 @@ class TestRecorder(object):
         # Reset recorder
         ExecutionRecorder.reset()
     
+    def _make_metadata(self, node):
+        node = ast.BoolOp(op=node.op,
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=node.lineno,
+                          col_offset=node.col_offset)
+        metadata = ModuleMetadata('somemodule', '', [])
+        metadata.add_construct('1.1',
+                               LogicalOr('somemodule', '1.1', node, []))
+        return metadata
+    
     def test_construct_with_literal(self):
         recorder = ExecutionRecorder.get()
         node = ast.BoolOp(op=ast.Or(),
@@ -17,7 +34,22 @@ class TestRecorder(object):
                                   ast.Str(s='""')],
                           lineno=1,
                           col_offset=0)
+        recorder.add_metadata(self._make_metadata(node))
         recorder.add_BoolOp('somemodule', '1.1', node, [], None)
+        assert node.values[0].args[1].n == 0
+        assert node.values[1].args[2].n == 1
+    
+    def test_unknown_construct_is_not_instrumented(self):
+        recorder = ExecutionRecorder.get()
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        recorder.add_metadata(ModuleMetadata('somemodule', '', []))
+        result = recorder.add_BoolOp('somemodule', '1.1', node, [], None)
+        assert result is node
+        assert isinstance(node.values[0], ast.Name)
     
     def test_add_a_non_BoolOp(self):
         recorder = ExecutionRecorder.get()
@@ -31,3 +63,265 @@ class TestRecorder(object):
         except TypeError as exc:
             assert "BoolOp" in str(exc), exc
 
+    def test_module_recorder(self):
+        recorder = ExecutionRecorder.get()
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        decision = BooleanDecision('somemodule', '2.1',
+                                   ast.Name(id="baz", lineno=2, col_offset=0),
+                                   [])
+        assert metadata.add_construct('2.1', decision) == 1
+        slot = metadata.lines.add(2)
+        recorder.add_metadata(metadata)
+        
+        module_recorder = recorder.module_recorder('somemodule')
+        assert recorder.module_recorder('somemodule') is module_recorder
+        
+        # nothing is recorded until the recorder is started
+        module_recorder.record_pin(True, 0, 0)
+        module_recorder.record_statement(slot)
+        assert not metadata.constructs['1.1'].conditions[0]
+        assert not metadata.lines[2]
+        
+        recorder.start()
+        assert module_recorder.record_pin(True, 0, 0) is True
+        assert module_recorder.record_decision(False, 1) is False
+        module_recorder.record_statement(slot)
+        module_recorder.record_pin(True, 0, 0)
+        assert metadata.constructs['1.1'].conditions[0] == set(['X'])
+        assert metadata.constructs['2.1'].conditions[False] == set(['X'])
+        assert not metadata.constructs['2.1'].conditions[True]
+        assert metadata.lines[2]
+        
+        recorder.tag = 'tagged'
+        module_recorder.record_decision(True, 1)
+        assert metadata.constructs['2.1'].conditions[True] == set(['tagged'])
+    
+    def test_tags_are_per_thread(self):
+        recorder = ExecutionRecorder.get()
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        recorder.add_metadata(metadata)
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.start()
+        assert not recorder.tagging
+        
+        def record_tagged(tag, value, pin):
+            recorder.tag = tag
+            module_recorder.record_pin(value, 0, pin)
+        threads = [threading.Thread(target=record_tagged,
+                                    args=('first', True, 0)),
+                   threading.Thread(target=record_tagged,
+                                    args=('second', False, 1))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        module_recorder.record_pin(True, 0, 0)
+        
+        assert recorder.tagging
+        assert recorder.tag is None
+        assert metadata.constructs['1.1'].conditions == {
+            0: set(['first', 'X']), 1: set(), 2: set(['second'])}
+    
+    def test_new_results_change_generation(self):
+        recorder = ExecutionRecorder.get()
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        slot = metadata.lines.add(2)
+        recorder.add_metadata(metadata)
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.start()
+        
+        generation = metadata.generation
+        module_recorder.record_pin(True, 0, 0)
+        assert metadata.generation != generation
+        generation = metadata.generation
+        module_recorder.record_pin(True, 0, 0)
+        assert metadata.generation == generation
+        
+        module_recorder.record_statement(slot)
+        assert metadata.generation != generation
+        generation = metadata.generation
+        module_recorder.record_statement(slot)
+        assert metadata.generation == generation
+        
+        recorder.tag = 'tagged'
+        module_recorder.record_pin(True, 0, 0)
+        assert metadata.generation != generation
+        generation = metadata.generation
+        module_recorder.record_pin(True, 0, 0)
+        assert metadata.generation == generation
+    
+    def test_sharded_module_recorder(self):
+        recorder = ExecutionRecorder.get()
+        recorder.sharded = True
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        decision = BooleanDecision('somemodule', '2.1',
+                                   ast.Name(id="baz", lineno=2, col_offset=0),
+                                   [])
+        metadata.add_construct('2.1', decision)
+        slot = metadata.lines.add(2)
+        recorder.add_metadata(metadata)
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.start()
+        
+        def record(tag):
+            recorder.tag = tag
+            module_recorder.record_pin(True, 0, 0)
+            module_recorder.record_decision(True, 1)
+            module_recorder.record_statement(slot)
+        threads = [threading.Thread(target=record, args=(tag,))
+                   for tag in (None, 'tagged')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        module_recorder.record_decision(False, 1)
+        
+        # Nothing reaches the results until the shards are merged
+        assert not metadata.lines[2]
+        assert not metadata.constructs['2.1'].conditions[False]
+        
+        recorder.merge_shards()
+        assert metadata.lines[2]
+        assert metadata.constructs['1.1'].conditions[0] == set(['X', 'tagged'])
+        assert metadata.constructs['2.1'].conditions == {
+            True: set(['X', 'tagged']), False: set(['X'])}
+        # Only this thread's shard is left
+        assert len(module_recorder._shards) == 1
+        
+        module_recorder.record_pin(True, 0, 1)
+        recorder.merge_shards()
+        assert metadata.constructs['1.1'].conditions[1] == set(['X'])
+    
+    def test_concurrent_merges(self):
+        recorder = ExecutionRecorder.get()
+        recorder.sharded = True
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        recorder.add_metadata(metadata)
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.start()
+        
+        def record(tag):
+            recorder.tag = tag
+            module_recorder.record_pin(True, 0, 0)
+        threads = [threading.Thread(target=record, args=('tag%d' % i,))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        # Merges of the same finished shards must not trip over each other
+        errors = []
+        def merge():
+            try:
+                module_recorder.merge()
+            except Exception as exc:
+                errors.append(exc)
+        mergers = [threading.Thread(target=merge) for i in range(8)]
+        for thread in mergers:
+            thread.start()
+        for thread in mergers:
+            thread.join()
+        assert not errors
+        assert not module_recorder._shards
+        assert metadata.constructs['1.1'].conditions[0] == set(
+            'tag%d' % i for i in range(20))
+    
+    def test_hit_counts(self):
+        recorder = ExecutionRecorder.get()
+        recorder.counting = True
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        decision = BooleanDecision('somemodule', '2.1',
+                                   ast.Name(id="baz", lineno=2, col_offset=0),
+                                   [])
+        metadata.add_construct('2.1', decision)
+        slot = metadata.lines.add(2)
+        recorder.add_metadata(metadata)
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.start()
+        
+        for value in (True, True, False):
+            module_recorder.record_pin(value, 0, 0)
+            module_recorder.record_decision(value, 1)
+            module_recorder.record_statement(slot)
+        metadata.counts.lines[slot] = MAX_COUNT
+        module_recorder.record_statement(slot)
+        
+        assert list(metadata.counts.conditions) == [2, 0, 0, 1, 2]
+        assert metadata.counts.lines[slot] == MAX_COUNT
+        assert metadata.constructs['2.1'].conditions == {
+            True: set(['X']), False: set(['X'])}
+        
+        other = ExecutionRecorder()
+        other.add_metadata(metadata.snapshot())
+        other.merge(recorder)
+        assert list(other.metadata['somemodule'].counts.conditions) == [
+            4, 0, 0, 2, 4]
+        assert other.metadata['somemodule'].counts.lines[slot] == MAX_COUNT
+    
+    def test_module_recorder_rebuilt_for_new_metadata(self):
+        recorder = ExecutionRecorder.get()
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        recorder.add_metadata(self._make_metadata(node))
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.add_metadata(self._make_metadata(node))
+        assert recorder.module_recorder('somemodule') is not module_recorder
+    
+    def test_snapshot(self):
+        recorder = ExecutionRecorder.get()
+        node = ast.BoolOp(op=ast.Or(),
+                          values=[ast.Name(id="foo"),
+                                  ast.Name(id="bar")],
+                          lineno=1,
+                          col_offset=0)
+        metadata = self._make_metadata(node)
+        slot = metadata.lines.add(1)
+        recorder.add_metadata(metadata)
+        module_recorder = recorder.module_recorder('somemodule')
+        recorder.start()
+        module_recorder.record_pin(True, 0, 0)
+        
+        snapshot = recorder.snapshot()
+        module_recorder.record_pin(False, 0, 0)
+        module_recorder.record_statement(slot)
+        
+        got_metadata = snapshot.metadata['somemodule']
+        assert got_metadata.constructs['1.1'].conditions == {
+            0: set(['X']), 1: set(), 2: set()}
+        assert not got_metadata.lines[1]
+        assert got_metadata.construct_ids == metadata.construct_ids
+        assert metadata.lines[1]
@@ -0,0 +1,69 @@
+import os
+
+from instrumental.metadata import analyze_source
+from instrumental.recorder import ExecutionRecorder
+from instrumental.shared import SharedHits
+from instrumental.test import DummyConfig
+
+SOURCE = """\
+def f(a, b):
+    if a and b:
+        return a
+    return b
+"""
+
+class TestSharedHits(object):
+    
+    def setup(self):
+        self.recorder = ExecutionRecorder()
+        self.metadata = analyze_source(DummyConfig(), 'somemodule', SOURCE)
+        self.metadata.lines[1] = True
+        self.recorder.add_metadata(self.metadata)
+        self.shared = SharedHits(self.recorder).allocate()
+        self.recorder.start()
+    
+    def _in_child(self, func):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                func()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+    
+    def test_allocate_keeps_hits(self):
+        assert self.recorder.shared is self.shared
+        assert self.metadata.lines == {1: True, 2: False, 3: False, 4: False}
+    
+    def test_hits_from_child(self):
+        if not hasattr(os, 'fork'):
+            return
+        
+        def record():
+            module_recorder = self.recorder.module_recorder('somemodule')
+            module_recorder.record_statement(self.metadata.lines.slots[3])
+            module_recorder.record_pin(True, 1, 1)
+        self._in_child(record)
+        self.recorder.module_recorder('somemodule').record_decision(False, 0)
+        
+        assert self.metadata.lines == {1: True, 2: False, 3: True, 4: False}
+        assert self.metadata.constructs['2.2'].conditions[0] == set()
+        self.shared.merge()
+        assert self.metadata.constructs['2.2'].conditions == {
+            0: set(['X']), 1: set(), 2: set()}
+        assert self.metadata.constructs['2.1'].conditions == {
+            False: set(['X']), True: set()}
+    
+    def test_covers(self):
+        module_recorder = self.recorder.module_recorder('somemodule')
+        module_recorder.record_pin(True, 1, 1)
+        assert self.shared.covers(self.recorder)
+        
+        self.recorder.tag = 'sometag'
+        module_recorder.record_pin(False, 1, 0)
+        assert not self.shared.covers(self.recorder)
+    
+    def test_covers_unshared_module(self):
+        self.recorder.add_metadata(
+            analyze_source(DummyConfig(), 'othermodule', SOURCE))
+        assert not self.shared.covers(self.recorder)
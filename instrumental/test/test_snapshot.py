@@ -0,0 +1,96 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from instrumental.metadata import analyze_source
+from instrumental.recorder import ExecutionRecorder
+from instrumental.snapshot import Snapshotter
+from instrumental.storage import ResultStore
+from instrumental.test import DummyConfig
+
+SOURCE = """\
+def f(a, b):
+    if a and b:
+        return a
+    return b
+"""
+
+class TestSnapshotter(object):
+    
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ResultStore(self.directory)
+        self.recorder = ExecutionRecorder()
+        self.recorder.add_metadata(
+            analyze_source(DummyConfig(), 'somemodule', SOURCE))
+        self.snapshotter = None
+    
+    def teardown(self):
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+        shutil.rmtree(self.directory)
+    
+    def _start(self, interval=None):
+        self.snapshotter = Snapshotter(self.recorder, self.store, interval)
+        self.snapshotter.start()
+    
+    def _hit(self, lineno, condition, tag):
+        metadata = self.recorder.metadata['somemodule']
+        metadata.lines[lineno] = True
+        metadata.constructs['2.2'].conditions[condition].add(tag)
+        metadata.changed()
+    
+    def test_request(self):
+        self._start()
+        self._hit(3, 1, 'X')
+        self.snapshotter.request()
+        self._hit(4, 0, 'X')
+        self.snapshotter.stop()
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines == {1: False, 2: False, 3: True, 4: False}
+        assert got_metadata.constructs['2.2'].conditions == {
+            0: set(), 1: set(['X']), 2: set()}
+    
+    def test_nothing_saved_without_request(self):
+        self._start()
+        self._hit(3, 1, 'X')
+        self.snapshotter.stop()
+        assert not os.path.exists(self.store.filename)
+    
+    def test_interval(self):
+        self._start(interval=0.01)
+        self._hit(3, 1, 'X')
+        deadline = time.time() + 10
+        while not os.path.exists(self.store.filename):
+            assert time.time() < deadline
+            time.sleep(0.01)
+        self.snapshotter.stop()
+        
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines[3]
+    
+    def test_signal(self):
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        previous = signal.getsignal(signal.SIGUSR1)
+        threads = []
+        snapshot = self.recorder.snapshot
+        def snapshot_in_thread():
+            threads.append(threading.current_thread())
+            return snapshot()
+        self.recorder.snapshot = snapshot_in_thread
+        self._start()
+        assert self.snapshotter.install_signal_handler()
+        self._hit(3, 1, 'X')
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.snapshotter.stop()
+        
+        # The handler leaves taking the snapshot to the snapshot thread
+        assert threads and threading.current_thread() not in threads
+        assert signal.getsignal(signal.SIGUSR1) == previous
+        got_metadata = self.store.load().metadata['somemodule']
+        assert got_metadata.lines[3]
@@ -0,0 +1,61 @@
+import pickle
+
+from instrumental.tags import TagSet
+from instrumental.tags import TagTable
+
+class TestTagTable(object):
+    
+    def test_ids_in_order_seen(self):
+        table = TagTable(['first'])
+        assert table.id('second') == 1
+        assert table.id('first') == 0
+        assert table.ids(['second', 'first', 'second']) == [0, 1]
+        assert table.names([1]) == ['second']
+        assert len(table) == 2
+
+class TestTagSet(object):
+    
+    def test_behaves_like_a_set(self):
+        tags = TagSet(['a'])
+        tags.add('b')
+        tags.add('b')
+        assert tags == set(['a', 'b'])
+        assert set(['a', 'b']) == tags
+        assert tags != set(['a'])
+        assert len(tags) == 2
+        assert 'a' in tags
+        assert 'c' not in tags
+        assert tags - set(['a']) == set(['b'])
+        assert not TagSet()
+        
+        tags.update(TagSet(['c']))
+        tags.discard('a')
+        assert sorted(tags) == ['b', 'c']
+    
+    def test_high_ids(self):
+        from instrumental.tags import WORD_BITS
+        from instrumental.tags import tag_table
+        
+        tags = TagSet(['a'])
+        high = 'high%d' % len(tag_table)
+        for i in range(2 * WORD_BITS):
+            tag_table.id('filler%d.%d' % (len(tag_table), i))
+        tags.add(high)
+        assert len(tags.words) == 2
+        assert high in tags
+        assert sorted(tags) == ['a', high]
+        assert tags == TagSet([high, 'a'])
+        
+        tags.discard(high)
+        assert tags == TagSet(['a'])
+        assert len(tags.words) == 1
+    
+    def test_copy_is_independent(self):
+        tags = TagSet(['a'])
+        copied = tags.copy()
+        tags.add('b')
+        assert copied == set(['a'])
+    
+    def test_pickled_by_name(self):
+        tags = TagSet(['a', 'b'])
+        assert pickle.loads(pickle.dumps(tags)) == tags
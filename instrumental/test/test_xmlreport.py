@@ -3,16 +3,15 @@ import os
 import sys
 from xml.etree import ElementTree
 
+from instrumental.test import DummyConfig as BaseDummyConfig
+
 ZERO = '0.000000'
 ONE = '1.000000'
 
 if sys.version_info.major == 3:
     from imp import reload
 
-class DummyConfig(object):
-    instrument_assertions = True
-    instrument_comparisons = True
-    use_metadata_cache = False
+class DummyConfig(BaseDummyConfig):
     report_conditions_with_literals = False
 
 class TestXMLReport(object):
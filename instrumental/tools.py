@@ -17,38 +17,68 @@
 #
 from optparse import OptionParser
 import os
+import signal
 import sys
 
-from instrumental.recorder import ExecutionRecorder
+from instrumental.collector import Collector
 from instrumental.storage import ResultStore
 
 usage = """instrumental-tools [options] COMMAND ARG1 ARG2 ...
 
 Commands:
+- collect: collect results sent to a socket args: socket [outfile]
 - combine: combine coverage files args: outfile infiles+
 - list: list available commands args:
 """
 parser = OptionParser(usage=usage)
+parser.add_option('-w', '--workers',
+                  dest='workers',
+                  type='int', default=1,
+                  help=('The number of processes to use to combine coverage'
+                        ' files'))
+parser.add_option('--grace',
+                  dest='grace',
+                  type='float', default=5.0,
+                  help=('The number of seconds the collector waits for'
+                        ' connected processes to finish when it is stopped'))
+
+def exit_on_signal(signum, frame):
+    raise SystemExit(0)
 
 class Commands(object):
     
     @staticmethod
-    def list():
+    def list(**options):
         commands = [attr for attr in dir(Commands)
                     if not attr.startswith('__')]
         sys.stdout.write("\n".join(commands) + "\n")
     
     @staticmethod
-    def combine(outfile, *infiles):
-        combined = ExecutionRecorder()
-        for filename in infiles:
-            store = ResultStore(os.path.dirname(filename), None,
-                                os.path.basename(filename))
-            single = store.load()
-            combined.merge(single)
+    def collect(address, outfile='.instrumental.cov', **options):
+        store = ResultStore(os.path.dirname(outfile), None,
+                            os.path.basename(outfile))
+        collector = Collector(address, store)
+        collector.bind()
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        try:
+            collector.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
+            if not collector.wait(options.get('grace', 5.0)):
+                sys.stderr.write("Saving before every process has finished"
+                                 " sending its results\n")
+            collector.save()
+    
+    @staticmethod
+    def combine(outfile, *infiles, **options):
+        stores = [ResultStore(os.path.dirname(filename), None,
+                              os.path.basename(filename))
+                  for filename in infiles]
         combined_store = ResultStore(os.path.dirname(outfile), None,
                                      os.path.basename(outfile))
-        combined_store.save(combined)
+        combined_store.combine(stores, workers=options.get('workers', 1))
 
 def main():
     opts, args = parser.parse_args(sys.argv[1:])
@@ -59,6 +89,6 @@ def main():
     command, args = args[0], args[1:]
     
     if hasattr(Commands, command):
-        getattr(Commands, command)(*args)
+        getattr(Commands, command)(*args, **vars(opts))
     else:
         parser.print_help()